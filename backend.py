@@ -1,24 +1,99 @@
+import ctypes
+import gc
+import itertools
 import json
 import math
 import os
 import time
+import urllib.parse
+from dataclasses import replace
+from typing import Callable
 import numpy as np
-from udata import UData, UEntity, UHeaderType, UJointType, UMaterial, UMesh, UJoint, ULink, UVisual, UVisualType
+from udata import UBuffer, UData, UEntity, UHeaderType, UJointType, UMaterial, UMesh, UJoint, ULink, UShape, UShapeType, UTexture, UVisual, UVisualType
 from scipy.spatial.transform import Rotation as R
 from print_color import print as cprint
-from parsers.urdf_parser import URDFJoint, URDFLink, URDFVisual, URDFData 
+from parsers.urdf_parser import URDFCollision, URDFGeometry, URDFJoint, URDFLink, URDFOrigin, URDFVisual, URDFData 
+from parsers.xacro_parser import find_package
+from mesh_cache import MeshCache
+from mesh_store import MeshStore
+from snapshot import Snapshot, SnapshotError, write_snapshot
+from joint_state import JointStatePublisher
+from lod import build_lods
+from textures import encode_texture, load_image, material_files, pack_atlas, read_image, texture_key, tiles
+from primitives import level_segments, tessellate
+from collision import convex_hulls, scene_arrays
+from kinematics import KinematicModel, origin_matrix
+from spatial import SpatialIndex
+from serializer import FORMATS, BinaryEncoder, serialize
+from framing import CODECS, HEADER, Assembler, FramingError, compress, frame, frames
+from metrics import metrics
+from hot_reload import EntityDiff, FileWatcher, diff_entities
+from scene import SceneEntity, load_manifest, parse_scene
 import trimesh
 import trimesh.visual.material as TriMat
 import websockets
 import asyncio
+import contextlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 FILE_PATH = "res/models/pybullet/robots/panda_arm_hand_without_cam.urdf"
-FOLDER = os.path.dirname(FILE_PATH)
+SCENE = None # manifest of several urdfs and their placement (e.g. "res/scenes/workcell.json"), None serves FILE_PATH alone
+BINARY_MESHES = False # send the mesh arrays as one little endian binary BUFFER next to the json instead of as text
+QUANTIZED_MESHES = False # send vertices as int16 steps of their bounding box and normals octahedral encoded (json and binary)
+
+CACHE_FOLDER = ".cache/meshes" # converted meshes are kept here between runs, None disables the cache
+CACHE_MAX_BYTES = 2**30
+CONVERTER_VERSION = 2 # bump when convert_mesh changes its output, this invalidates the cache
+MESH_STORE = True # keep the converted meshes and the encoded json messages in a memory mapped temporary file instead of the heap
+SNAPSHOT = None # compiled scene (e.g. ".cache/scene.snapshot") mapped and served without parsing or converting, written again once a source changed
+
+MESH_WORKERS = 0 # processes the mesh files are converted in (e.g. os.cpu_count()), 0 or 1 converts them in this process
+
+STREAMING = False # serve the link/joint tree as ENTITY right away and every visual as its own MESH once it is converted
+
+UPDATE_RATE = 250.0 # joint state UPDATE frames per second
+UPDATE_EPSILON = 1e-4 # joints that moved less are not sent
+
+COMPRESSION_LEVEL = 6 # deflate level of the messages of clients that ask for it with ?compression=deflate
+COMPRESSION_THRESHOLD = 2**14 # smaller payloads are sent uncompressed
+PERMESSAGE_DEFLATE = False # let websockets deflate every frame per connection too, this costs cpu per client and byte
+
+LOD_RATIOS = (0.25, 0.05) # triangle counts of the coarser levels of detail relative to the full mesh, level 0 is the full mesh
+
+TEXTURE_SIZES = (2048, 512, 128) # longest side in pixels a texture is sent at, a client asks with ?texture=N for the largest up to N, the default is the largest
+TEXTURE_QUALITY = 85 # jpeg quality of opaque textures, textures with transparent pixels are sent as png
+ATLAS_SIZE = 4096 # longest side of the atlas the textures of an entity are packed into, 0 sends every texture on its own
+
+PRIMITIVE_SEGMENTS = 32 # segments around tessellated cylinders and spheres, their coarser levels of detail have fewer, clients asking with ?primitives=native build them themselves
+PRIMITIVE_COLOR = [0.7, 0.7, 0.7, 1.0] # rgba of box, sphere and cylinder visuals whose urdf material has no color
+
+COLLISION_MAX_HULLS = 8 # convex hulls a collision mesh is decomposed into at most, 1 gives its convex hull
+COLLISION_MAX_VERTICES = 64 # vertices of a hull at most, physics engines cap convex meshes at 255
+COLLISION_CONCAVITY = 0.05 # parts are cut until their hull strays less than this from them, relative to the size of the mesh
+COLLISION_VERSION = 1 # bump when the decomposition changes its output, this invalidates the cache
+
+IK_RESTARTS = 8 # seeds every ik target is solved from, the published joint positions and random configurations
+IK_ITERATIONS = 100 # damped least squares steps at most, a target stops once one of its seeds reaches it
+IK_TOLERANCE = 1e-4 # meters a solution may be off the target position
+IK_ROTATION_TOLERANCE = 1e-3 # radians a solution may be off the target rotation
+
+WATCH = False # reload the urdf and its mesh files when they change and push only the differences to the clients
+WATCH_INTERVAL = 0.5 # seconds between checks for changed files
+
+METRICS_SINKS = [] # e.g. ["log", "json:.cache/metrics.json", "prometheus:9464"], no sink disables the metrics
+METRICS_BREAKDOWN = False # also time every mesh file and visual on its own
+METRICS_INTERVAL = 10.0 # seconds between writes to the log and json sinks
 
 
 def mj2unity_pos(pos): return [-pos[1], pos[2], pos[0]]
 def mj2unity_euler(rot): return [rot[1], -rot[2], -rot[0]]
+def mj2unity_points(points : np.ndarray) -> np.ndarray: return points[:, [1, 2, 0]] * [-1, 1, 1]
+def unity2mj_points(points : np.ndarray) -> np.ndarray: return points[:, [2, 0, 1]] * [1, -1, 1]
+def unity2mj_rotations(quaternions : np.ndarray) -> np.ndarray: # (x, y, z, w), the frames mirror each other so the matrices are conjugated
+  mirror = mj2unity_points(np.eye(3)).T
+  return mirror.T @ R.from_quat(quaternions).as_matrix() @ mirror
 
 def decompose_transform_matrix(matrix):
     u, sigma, vt = np.linalg.svd(matrix[:3, :3])
@@ -26,10 +101,46 @@ def decompose_transform_matrix(matrix):
     return rot.tolist(), matrix[:3, 3].tolist()
 
 _meshes = {}
+_loading : dict[str, asyncio.Future] = {} # conversion of every mesh file of the scene, done once it is in _meshes
+_stages : dict[str, asyncio.Future] = {} # how far the scene is loaded, see stage()
+_mesh_messages : dict[tuple[str, str, int, str, bool], tuple[list[str], list[str], str | BinaryEncoder]] = {} # geometries, textures and MESH message per entity, visual, level of detail, format and primitives
+_geometries : dict[str, UMesh] = {} # every geometry referenced by a MESH message
+_geometry_messages : dict[tuple[str, str], tuple[UBuffer, str | BinaryEncoder | bytes | memoryview]] = {} # GEOMETRY messages per geometry and format
+_data_messages : dict[tuple[int, str, bool], tuple[UBuffer, str | BinaryEncoder | bytes | memoryview, list[str]]] = {} # DATA message and its geometries per level of detail, format and primitives, encoded json from a snapshot
+_compressed : dict[tuple, asyncio.Future] = {} # compressed payloads of the memoized messages per key and codec, shared by all clients
+_hulls : dict[str, list[UMesh]] = {} # convex decomposition of every collision mesh file
+_shape_messages : dict[tuple[str, str], tuple[list[str], str | BinaryEncoder]] = {} # geometries and SHAPE message per entity and format
+_shape_lock = threading.Lock() # the SHAPE messages are packaged on executor threads, every mesh file is decomposed once
+_surfaces : dict[str, tuple[np.ndarray, np.ndarray]] = {} # vertices and faces of every visual mesh file in its urdf frame
+_spatial : SpatialIndex = None # ray casts and nearest points against the scene, built on the first query
+_spatial_lock = threading.Lock() # queries run on executor threads and move the links of the one index
+_models : dict[str, KinematicModel] = {} # compiled kinematic tree of every entity, for queries and ik
+_textures : dict[str, np.ndarray] = {} # pixels of every texture and atlas by key
+_texture_files : dict[str, str] = {} # key of the texture of every image file a urdf material names
+_atlases : dict[tuple[str, ...], dict[str, dict]] = {} # texture, textureOffset and textureScale per texture packed into an atlas, by the keys of the packed textures
+_entity_textures : dict[str, dict[str, dict]] = {} # the atlas of every entity, MESH messages map the textures like the DATA message does
+_encoded_textures : dict[tuple[str, int], UTexture] = {} # every texture encoded per size
+_texture_messages : dict[tuple[str, int, str], tuple[UBuffer, str | BinaryEncoder]] = {} # TEXTURE messages per texture, size and format
+_primitives : dict[tuple[str, tuple[float, ...], int], UMesh] = {} # tessellated box, sphere and cylinder with its levels of detail by type, dimensions and segments
+_materials : dict[str, list[str]] = {} # the material and image files of every mesh file
+_cache = MeshCache(CACHE_FOLDER, CACHE_MAX_BYTES) if CACHE_FOLDER is not None else None
+_store : MeshStore = None # created by the server, the mesh workers import this module too
+_clients : set = set() # send_diff of every connected client
+_memos = [_meshes, _loading, _stages, _mesh_messages, _geometries, _geometry_messages, _data_messages, _compressed, _hulls, _shape_messages, _surfaces, _models,
+  _textures, _texture_files, _atlases, _entity_textures, _encoded_textures, _texture_messages, _primitives, _materials] # everything loaded for the scene, a new memo goes here too
+
 
+def convert_material(material : TriMat.PBRMaterial | TriMat.SimpleMaterial, images : dict[int, tuple[str, np.ndarray]] = None) -> tuple[UMaterial, np.ndarray | None]:
+  """ The material and the pixels of its diffuse map. images holds the key and pixels of every image read already (the
+  meshes of a file share them), without images the texture is left out (the mesh has no uvs) """
+  if isinstance(material, TriMat.PBRMaterial): material = material.to_simple() # obj files come with simple materials already
 
-def convert_material(material : TriMat.PBRMaterial) -> UMaterial:
-  material : TriMat.SimpleMaterial = material.to_simple() 
+  key, pixels = None, None
+  if images is not None:
+    if id(material.image) not in images:
+      pixels = read_image(material.image)
+      images[id(material.image)] = (texture_key(pixels) if pixels is not None else None, pixels)
+    key, pixels = images[id(material.image)]
 
   return UMaterial(
     name=material.name,
@@ -37,22 +148,26 @@ def convert_material(material : TriMat.PBRMaterial) -> UMaterial:
     ambient=material.ambient.tolist(),
     diffuse=material.diffuse.tolist(),
     glossiness=material.glossiness,
-  )
+    texture=key,
+  ), pixels
 
-def convert_mesh(mesh : trimesh.base.Trimesh, matrix : np.ndarray, name : str) -> UMesh:
+def convert_mesh(mesh : trimesh.base.Trimesh, matrix : np.ndarray, name : str, images : dict[int, tuple[str, np.ndarray]] = None) -> UMesh:
 
 
-  verts = np.around(mesh.vertices, decimals=5) # load vertices with max 5 decimal points
+  verts = np.array(mesh.vertices, dtype=np.float32) # float32 is all unity can use anyway
   verts[:, 0] *= -1 # reverse x pos of every vertex
-  verts = verts.tolist()
 
-  norms = np.around(mesh.vertex_normals, decimals=5) # load normals with max 5 decimal points
+  norms = np.array(mesh.vertex_normals, dtype=np.float32)
   norms[:, 0] *= -1 # reverse x pos of every normal
-  norms = norms.tolist()
 
-  indices = mesh.faces[:, [2, 1, 0]].flatten().tolist() # reverse winding order 
+  indices = mesh.faces[:, [2, 1, 0]].flatten() # reverse winding order 
 
-  rot, pos = decompose_transform_matrix(matrix) # decompose matrix 
+  material, image, uvs = None, None, None
+  if isinstance(mesh.visual, trimesh.visual.TextureVisuals): # stl files only have colors
+    uvs = np.array(mesh.visual.uv, dtype=np.float32) if mesh.visual.uv is not None else None # the mirrored x leaves the uvs as they are
+    material, image = convert_material(mesh.visual.material, (images if images is not None else {}) if uvs is not None else None)
+
+  with metrics.timer("decompose"): rot, pos = decompose_transform_matrix(matrix) # decompose matrix 
 
   # this needs to be tested
   pos = [-pos[1], pos[2], -pos[0]]
@@ -67,21 +182,223 @@ def convert_mesh(mesh : trimesh.base.Trimesh, matrix : np.ndarray, name : str) -
     indices=indices, 
     vertices=verts, 
     normals=norms, 
-    material=convert_material(mesh.visual.material)
+    uvs=uvs,
+    material=material,
+    image=image
   )
 
 
-def convert_visual(visual : URDFVisual) -> UVisual:
+def convert_scene(scene : trimesh.Scene) -> list[UMesh]:
+  images = {} # meshes with the same material image share its pixels
+  return [convert_mesh(scene.geometry[item['geometry']], item['matrix'], item['geometry'], images) for item in scene.graph.transforms.edge_data.values()] # TODO: refine this
+
+
+def load_meshes(file : str) -> list[UMesh]:
+
+  if _cache is not None:
+    key = _cache.key(file, { "converter" : CONVERTER_VERSION, "trimesh" : trimesh.__version__, "lods" : LOD_RATIOS }, mesh_materials(file))
+    with metrics.timer("cache_load", item=file): meshes = _cache.load(key)
+    metrics.count("cache_hits" if meshes is not None else "cache_misses")
+    if meshes is not None: return meshes
+
+  with metrics.timer("mesh_load", item=file): scene = trimesh.load(file, force='scene')
+  with metrics.timer("conversion", item=file): meshes = convert_scene(scene)
+  with metrics.timer("lod", item=file):
+    for mesh in meshes: mesh.lods = build_lods(mesh, LOD_RATIOS)
+  metrics.count("meshes_loaded", len(meshes))
+
+  if _cache is not None:
+    with metrics.timer("cache_store", item=file): _cache.store(key, meshes)
+  return meshes
+
+
+def convert_hull(vertices : np.ndarray, faces : np.ndarray, name : str) -> UMesh:
+  """ A hull in the unity frame of its mesh file, unlike the visual meshes it needs no pose of its own """
+  verts = np.array([mj2unity_pos(vertex) for vertex in vertices], dtype=np.float32).reshape(-1, 3)
+  faces = faces[:, [2, 1, 0]] # the frame is mirrored, the winding order has to be reversed too
+  norms = np.array(trimesh.Trimesh(verts, faces, process=False).vertex_normals, dtype=np.float32)
+  return UMesh(name=name, position=[0.0, 0.0, 0.0], rotation=[0.0, 0.0, 0.0], scale=[1.0, 1.0, 1.0], indices=faces.flatten(), vertices=verts, normals=norms)
+
+
+def load_hulls(file : str) -> list[UMesh]:
+  """ The convex hulls of a collision mesh file, cached on disk like the visual meshes """
+  if file in _hulls: return _hulls[file]
+
+  if _cache is not None:
+    key = _cache.key(file, { "collision" : COLLISION_VERSION, "trimesh" : trimesh.__version__, "max_hulls" : COLLISION_MAX_HULLS, "max_vertices" : COLLISION_MAX_VERTICES, "concavity" : COLLISION_CONCAVITY })
+    with metrics.timer("cache_load", item=file): hulls = _cache.load(key)
+    metrics.count("cache_hits" if hulls is not None else "cache_misses")
+    if hulls is not None:
+      _hulls[file] = hulls
+      return hulls
+
+  with metrics.timer("mesh_load", item=file): vertices, faces = scene_arrays(trimesh.load(file, force="scene"))
+  with metrics.timer("decomposition", item=file): parts = convex_hulls(vertices, faces, COLLISION_MAX_HULLS, COLLISION_MAX_VERTICES, COLLISION_CONCAVITY)
+  hulls = [convert_hull(part_vertices, part_faces, f"hull_{i}") for i, (part_vertices, part_faces) in enumerate(parts)]
+  metrics.count("hulls", len(hulls))
+
+  if _cache is not None:
+    with metrics.timer("cache_store", item=file): _cache.store(key, hulls)
+  _hulls[file] = hulls
+  return hulls
+
+
+def release_memory():
+  """ Hands the heap the conversion freed back to the system, glibc keeps it for later allocations otherwise """
+  gc.collect()
+  try: ctypes.CDLL(None).malloc_trim(0)
+  except (OSError, AttributeError, TypeError): pass # no glibc
+
+
+def add_meshes(file : str, meshes : list[UMesh]):
+  """ Keeps the converted meshes of a file, in the mesh store if there is one """
+  if _store is not None:
+    with metrics.timer("store", item=file): meshes = _store.store(meshes)
+  _meshes[file] = meshes
+
+
+def load_mesh_files(files : list[str]):
+  """ Loads every file not in _meshes yet, spread over MESH_WORKERS processes. The workers send back the numpy
+  arrays of the converted meshes, the result is the same as loading them one after another """
+
+  missing = [file for file in dict.fromkeys(files) if file not in _meshes]
+
+  if MESH_WORKERS <= 1 or len(missing) <= 1:
+    for file in missing: add_meshes(file, load_meshes(file))
+    return
+
+  missing.sort(key=os.path.getsize, reverse=True) # start with the big ones so no worker is left alone at the end
+  with metrics.timer("mesh_workers"), ProcessPoolExecutor(min(MESH_WORKERS, len(missing))) as pool:
+    for file, meshes in zip(missing, pool.map(load_meshes, missing)): add_meshes(file, meshes)
+
+
+def mesh_file(visual : URDFVisual | URDFCollision, folder : str) -> str:
+  return urdf_file(visual.geometry.fileName, folder) # file specified in the urdf, origin different fot every urdf file
+
+
+def urdf_file(file : str, folder : str) -> str:
+  """ Path of a file a urdf in folder names, a package:// url is looked up in the ros packages above it """
+  if file.startswith("package://"):
+    package, _, path = file[len("package://"):].partition("/")
+    root = find_package(package, folder) # a ros package above the urdf, e.g. the description of a xacro robot
+    if root is not None: return os.path.normpath(os.path.join(root, path))
+    file = file[len("package://"):]
+  return os.path.normpath(os.path.join(folder, file.lstrip("/"))) # relative to the folder of the urdf, the same file used by several urdfs gets the same path
+
 
-  file = visual.geometry.fileName.replace("package:/", FOLDER) # file specified in the urdf, origin different fot every urdf file 
-  if FOLDER not in file: file = FOLDER + file # sometimes there is no "package:/" in the name 
+def entity_mesh_files(entity : SceneEntity) -> list[str]:
+  return list(dict.fromkeys(mesh_file(visual, entity.folder) for visual in entity.visuals().values() if visual.geometry.type == "mesh"))
 
-  if file not in _meshes: # so we dont load one mesh twice (gripper fingers)
-    scene = trimesh.load(file, force='scene')
-    meshes = [convert_mesh(scene.geometry[item['geometry']], item['matrix'], item['geometry']) for item in scene.graph.transforms.edge_data.values()] # TODO: refine this
-    _meshes[file] = meshes
 
-  meshes = _meshes[file]
+def mesh_materials(file : str) -> list[str]:
+  """ The material and image files trimesh reads along with a mesh file, looked up once per file """
+  if file not in _materials:
+    try: _materials[file] = material_files(file)
+    except (OSError, ValueError): _materials[file] = [] # loading the mesh file reports it
+  return _materials[file]
+
+
+def entity_texture_files(entity : SceneEntity) -> list[str]:
+  return list(dict.fromkeys(urdf_file(visual.material.fileName, entity.folder) for visual in entity.visuals().values() if visual.material is not None and visual.material.fileName))
+
+
+def entity_dependencies(entity : SceneEntity) -> list[str]:
+  """ The files the conversion of the entity reads besides its urdf and mesh files, the files a xacro includes, the
+  materials and images of the meshes and the textures of the urdf materials """
+  return list(dict.fromkeys([*entity.data.includes, *(material for file in entity_mesh_files(entity) for material in mesh_materials(file)), *entity_texture_files(entity)]))
+
+
+def stage(name : str) -> asyncio.Future:
+  """ Done once loading the scene got that far, "scene" once the urdfs are parsed and "data" once the DATA message is
+  packaged (without streaming). Clients that connect earlier wait for it """
+  if name not in _stages: _stages[name] = asyncio.get_event_loop().create_future()
+  return _stages[name]
+
+
+async def load_mesh_file(file : str, executor):
+  loop = asyncio.get_running_loop()
+  meshes = await loop.run_in_executor(executor, load_meshes, file)
+  await loop.run_in_executor(None, add_meshes, file, meshes) # copying them into the store writes the file
+
+
+def start_loading(entities : list[SceneEntity], executor):
+  """ Schedules the conversion of every mesh file of the entities on executor without waiting for it """
+  for file in dict.fromkeys(file for entity in entities for file in entity_mesh_files(entity)):
+    if file not in _meshes and file not in _loading: _loading[file] = asyncio.ensure_future(load_mesh_file(file, executor))
+
+
+async def wait_for_visual(entity : SceneEntity, visual : URDFVisual) -> tuple[SceneEntity, URDFVisual]:
+  if visual.geometry.type != "mesh": return entity, visual # primitives are tessellated when converted
+  file = mesh_file(visual, entity.folder)
+  if file not in _meshes: await _loading[file]
+  return entity, visual
+
+
+def visual_texture(visual : URDFVisual, folder : str) -> str | None:
+  """ Key of the texture of the urdf material of the visual, every image file is read once """
+  if visual.material is None or not visual.material.fileName: return None
+  file = urdf_file(visual.material.fileName, folder)
+  if file not in _texture_files:
+    try: pixels = load_image(file)
+    except OSError as error: # the visual keeps its colors
+      cprint(f"Texture {file} of {visual.name} can not be read, {error}", tag="TEXTURE", tag_color="red", color="white")
+      pixels = None
+    key = texture_key(pixels) if pixels is not None else None
+    if key is not None: _textures[key] = pixels
+    _texture_files[file] = key
+  return _texture_files[file]
+
+
+def primitive_dimensions(geometry : URDFGeometry) -> tuple[float, ...]:
+  return {
+    "box" : lambda: tuple(geometry.size),
+    "sphere" : lambda: (geometry.radius,),
+    "cylinder" : lambda: (geometry.radius, geometry.length),
+  }[geometry.type]()
+
+
+def primitive_mesh(type : str, dimensions : tuple[float, ...]) -> UMesh:
+  """ The tessellation of a primitive with its levels of detail, computed once per type, dimensions and segments and
+  shared by every visual of that shape. It goes through convert_mesh like the meshes of a file in the urdf frame """
+  key = (type, dimensions, PRIMITIVE_SEGMENTS)
+  if key not in _primitives:
+    with metrics.timer("tessellate", item=type):
+      mesh = previous = convert_mesh(tessellate(type, dimensions, PRIMITIVE_SEGMENTS), np.eye(4), type)
+      for segments in level_segments(type, PRIMITIVE_SEGMENTS, LOD_RATIOS):
+        level = convert_mesh(tessellate(type, dimensions, segments), np.eye(4), type)
+        previous = level if level.geometry != previous.geometry else previous # a level that would not be smaller is the finer one
+        mesh.lods.append(previous)
+    _primitives[key] = _store.store([mesh])[0] if _store is not None else mesh
+  return _primitives[key]
+
+
+def painted(mesh : UMesh, material : UMaterial) -> UMesh:
+  """ The mesh and its levels of detail with material, the arrays and geometries stay the same """
+  copies = { id(level) : replace(level, material=material, lods=[]) for level in [mesh, *mesh.lods] }
+  copies[id(mesh)].lods = [copies[id(level)] for level in mesh.lods]
+  return copies[id(mesh)]
+
+
+def primitive_material(visual : URDFVisual) -> UMaterial:
+  """ The color of the urdf material, primitives have no other """
+  color = visual.material.color if visual.material is not None and visual.material.color is not None else PRIMITIVE_COLOR
+  return convert_material(TriMat.SimpleMaterial(name=f"{visual.name}_material", diffuse=np.round(np.multiply(color, 255)).astype(np.uint8)))[0]
+
+
+def convert_visual(visual : URDFVisual, folder : str, meshes : list[UMesh] = None) -> UVisual:
+
+  primitive = visual.geometry.type != "mesh"
+  if meshes is None and primitive: meshes = [painted(primitive_mesh(visual.geometry.type, primitive_dimensions(visual.geometry)), primitive_material(visual))]
+  elif meshes is None:
+    file = mesh_file(visual, folder)
+
+    if file not in _meshes: # so we dont load one mesh twice (gripper fingers)
+      with metrics.timer("visual_load", item=visual.name): add_meshes(file, load_meshes(file))
+
+    meshes = _meshes[file]
+
+  for mesh in meshes:
+    if mesh.image is not None: _textures.setdefault(mesh.material.texture, mesh.image)
 
   hasOrigin = visual.origin is not None
   return UVisual(
@@ -89,10 +406,39 @@ def convert_visual(visual : URDFVisual) -> UVisual:
     type = UVisualType(visual.geometry.type.upper()),
     position=visual.origin.position if hasOrigin else [0.0, 0.0, 0.0],
     rotation= [visual.origin.rotation[0], visual.origin.rotation[2], visual.origin.rotation[1]] if hasOrigin else [0.0, 0.0, 0.0], # TODO: WTF ??
-    scale = visual.geometry.scale,
-    meshes = meshes
+    scale = visual.geometry.scale if not primitive else [1.0, 1.0, 1.0],
+    meshes = meshes,
+    texture = visual_texture(visual, folder),
+    size = [float(value) for value in primitive_dimensions(visual.geometry)] if primitive else None,
+  )
+
+def convert_collision(collision : URDFCollision, link : str, index : int, folder : str) -> UShape:
+  """ Boxes, spheres and cylinders stay primitives, meshes become their convex hulls """
+  geometry = collision.geometry
+  type = UShapeType.HULLS if geometry.type == "mesh" else UShapeType(geometry.type.upper())
+  size = {
+    UShapeType.BOX : lambda: [abs(value) for value in mj2unity_pos(geometry.size)],
+    UShapeType.SPHERE : lambda: [geometry.radius],
+    UShapeType.CYLINDER : lambda: [geometry.radius, geometry.length], # the z axis of the urdf is the y axis of unity
+    UShapeType.HULLS : lambda: [abs(value) for value in mj2unity_pos(geometry.scale)],
+  }[type]()
+
+  hasOrigin = collision.origin is not None
+  return UShape(
+    name=collision.name or f"{link}_collision_{index}",
+    link=link,
+    type=type,
+    position=mj2unity_pos(collision.origin.position) if hasOrigin else [0.0, 0.0, 0.0],
+    rotation=mj2unity_euler(collision.origin.rotation) if hasOrigin else [0.0, 0.0, 0.0],
+    size=[float(value) for value in size],
+    hulls=load_hulls(mesh_file(collision, folder)) if type == UShapeType.HULLS else [],
   )
 
+
+def convert_shapes(entity : SceneEntity) -> list[UShape]:
+  return [convert_collision(collision, link.name, i, entity.folder) for link in entity.data.links for i, collision in enumerate(link.collisions)]
+
+
 def convert_link(link : URDFLink) -> ULink:
   hasOrigin = link.origin is not None
   hasVisual = link.visual is not None
@@ -119,36 +465,476 @@ def convert_joint(joint : URDFJoint) -> UJoint:
   )
 
 
-def convert_urdf(data : URDFData) -> UEntity:
+def convert_urdf(entity : SceneEntity, skeleton : bool = False) -> UEntity:
+  """ Converts the whole urdf, as skeleton the visuals come without meshes and no mesh file is loaded """
+  data = entity.data
+  if not skeleton: load_mesh_files(entity_mesh_files(entity))
+  visuals = [convert_visual(link.visual, entity.folder, [] if skeleton else None) for link in data.links if link.visual is not None]
+  if not skeleton: _entity_textures[entity.name] = pack_textures(visuals)
+
   return UEntity (
-    name = data.name,
+    name = entity.name,
     links=[convert_link(link) for link in data.links],
     joints=[convert_joint(joint) for joint in data.joints],
-    visuals=[convert_visual(link.visual) for link in data.links if link.visual is not None],
-    manipulable = False
+    visuals=visuals,
+    manipulable = False,
+    position = mj2unity_pos(entity.position),
+    rotation = mj2unity_euler(entity.rotation),
+    textures = _entity_textures.get(entity.name, {}),
   )
 
-start = time.monotonic()
 
-data = URDFData.from_file(FILE_PATH)
+def pack_textures(visuals : list[UVisual]) -> dict[str, dict]:
+  """ Packs the textures of the meshes into one atlas if at least two of them fit, the texture, textureOffset and
+  textureScale of the materials of the packed ones. Tiling textures are sent alone, entities with the same textures
+  share the atlas """
+  if ATLAS_SIZE <= 0: return {}
+  meshes = [mesh for visual in visuals for mesh in visual.meshes if mesh.image is not None]
+  tiling = { mesh.material.texture for mesh in meshes if tiles(mesh.uvs) }
+  images = { mesh.material.texture : mesh.image for mesh in meshes if mesh.material.texture not in tiling }
+  if len(images) < 2: return {}
+
+  keys = tuple(sorted(images))
+  if keys not in _atlases:
+    with metrics.timer("atlas"): atlas = pack_atlas(images, ATLAS_SIZE)
+    if atlas is not None: _textures[atlas[0]] = atlas[1]
+    _atlases[keys] = atlas[2] if atlas is not None else {}
+  return _atlases[keys]
+
+
+def convert_entities(entities : list[SceneEntity]) -> list[UEntity]:
+  """ Loads the mesh files of all entities in one go, so MESH_WORKERS convert the files of different robots side by
+  side and a file used by several entities is converted once """
+  load_mesh_files([file for entity in entities for file in entity_mesh_files(entity)])
+  return [convert_urdf(entity) for entity in entities]
+
+
+def link_surfaces(entity : SceneEntity) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+  """ The visual triangles of every link in the urdf frame of the link, unlike the converted meshes in the frame of the
+  urdf and with the transforms of the mesh files applied """
+  surfaces = {}
+  for link in entity.data.links:
+    visual = link.visual
+    if visual is None: continue
+    geometry = visual.geometry
+    if geometry.type == "mesh":
+      file = mesh_file(visual, entity.folder)
+      if file not in _surfaces: _surfaces[file] = scene_arrays(trimesh.load(file, force="scene"))
+      vertices, faces = _surfaces[file]
+      vertices = vertices * geometry.scale
+    else: # the triangles the clients render
+      mesh = tessellate(geometry.type, primitive_dimensions(geometry), PRIMITIVE_SEGMENTS)
+      vertices, faces = mesh.vertices, mesh.faces
+    surfaces[link.name] = (trimesh.transform_points(vertices, origin_matrix(visual.origin)), faces)
+  return surfaces
+
 
-header = UData([convert_urdf(data)])
-data = header.package()
-string_data = json.dumps(data, separators=(',', ':'))
+def kinematic_model(entity : SceneEntity) -> KinematicModel:
+  model = _models.get(entity.name)
+  if model is None: model = _models[entity.name] = KinematicModel(entity.data)
+  return model
 
-dia_start = time.monotonic()
-# with open("test.json", "w") as fp: json.dump(data, fp=fp, separators=(',', ':'))
 
-end = time.monotonic()
-cprint(f"Compiling took {dia_start - start :.2f}s (debugging {end - dia_start:.2f})", tag="TIME", tag_color="blue", color='white')
+def spatial_index() -> SpatialIndex:
+  """ The index of the scene with the links where the joint positions of the publisher put them """
+  global _spatial
+  index = _spatial # a reload may drop it meanwhile
+  if index is None:
+    index = SpatialIndex()
+    for entity in scene.values():
+      placement = origin_matrix(URDFOrigin(entity.position, entity.rotation))
+      with metrics.timer("spatial_index", item=entity.name): index.add_entity(entity.name, kinematic_model(entity), placement, link_surfaces(entity))
+    _spatial = index
+  for name, joints, positions in zip(publisher.entities, publisher.joints, publisher.positions): index.set_positions(name, joints, positions)
+  return index
+
+
+def run_query(command : dict) -> dict:
+  """ Answers a raycast or nearest CMD with a RESULT. Points and directions are in the unity frame, link indexes the
+  links of the RESULT, -1 (and distance -1) where nothing was hit or near enough """
+  max_distance = float(command.get("max_distance", np.inf))
+  with _spatial_lock, metrics.timer("query", command=command["command"]):
+    index = spatial_index()
+    if command["command"] == "raycast":
+      origins, directions = [unity2mj_points(np.asarray(command[name], dtype=np.float64).reshape(-1, 3)) for name in ("origins", "directions")]
+      result = index.raycast(origins, directions, max_distance)
+    else:
+      result = index.nearest(unity2mj_points(np.asarray(command["points"], dtype=np.float64).reshape(-1, 3)), max_distance)
+
+  hit = result["link"] >= 0
+  answer = {
+    "id" : command.get("id"),
+    "command" : command["command"],
+    "links" : [{ "entity" : entity, "link" : link } for entity, link in index.links],
+    "link" : result["link"].astype(np.int32),
+    "distance" : np.where(hit, result["distance"], -1.0).astype(np.float32),
+    "point" : mj2unity_points(result["point"]).astype(np.float32),
+  }
+  if "normal" in result: answer["normal"] = mj2unity_points(result["normal"]).astype(np.float32)
+  return answer
+
+
+def run_ik(command : dict) -> dict:
+  """ Answers an ik CMD with a RESULT. The targets of link are unity frame positions and optional rotations as
+  quaternions, every one is solved from the published joint positions and restarts - 1 random configurations """
+  if command.get("entity") not in scene: raise ValueError(f"There is no entity {command.get('entity')!r} in the scene")
+  entity = scene[command["entity"]]
+  model = kinematic_model(entity)
+  if command.get("link") not in model.link_index: raise ValueError(f"{entity.name} has no link {command.get('link')!r}")
+  targets = np.asarray(command.get("targets", []), dtype=np.float64)
+  if targets.size == 0 or targets.ndim > 2 or targets.shape[-1] != 3: raise ValueError("targets has to be a list of [x, y, z]")
+  quaternions = np.asarray(command["rotations"], dtype=np.float64) if "rotations" in command else None
+  if quaternions is not None and (quaternions.ndim > 2 or quaternions.shape[-1] != 4 or quaternions.size // 4 != targets.size // 3):
+    raise ValueError("rotations has to be a list of [x, y, z, w], one per target")
+
+  base = np.linalg.inv(origin_matrix(URDFOrigin(entity.position, entity.rotation))) # the targets relative to the placement of the entity
+  positions = unity2mj_points(targets.reshape(-1, 3)) @ base[:3, :3].T + base[:3, 3]
+  rotations = base[:3, :3] @ unity2mj_rotations(quaternions.reshape(-1, 4)) if quaternions is not None else None
+
+  index = publisher.entities.index(entity.name)
+  published = dict(zip(publisher.joints[index], publisher.positions[index]))
+  current = np.array([published.get(name, 0.0) for name in model.dof])
+  restarts = max(int(command.get("restarts", IK_RESTARTS)), 1)
+  seeds = model.seeds(current, len(positions), restarts)
+  with metrics.timer("ik", entity=entity.name):
+    result = model.inverse(command["link"], positions, rotations, seeds, IK_ITERATIONS, tolerance=IK_TOLERANCE, rotation_tolerance=IK_ROTATION_TOLERANCE)
+
+  return {
+    "id" : command.get("id"),
+    "command" : "ik",
+    "entity" : entity.name,
+    "joints" : model.dof,
+    "positions" : result["q"].astype(np.float32),
+    "positionError" : result["position_error"].astype(np.float32),
+    "rotationError" : result["rotation_error"].astype(np.float32),
+    "converged" : result["converged"].tolist(),
+  }
+
+
+def pick_level(triangles : Callable[[int], int], budget : int | None) -> int:
+  """ The finest level of detail whose triangles fit into budget, the coarsest one if none does """
+  if budget is None: return 0
+  for level in range(len(LOD_RATIOS)):
+    if triangles(level) <= budget: return level
+  return len(LOD_RATIOS)
+
+
+def client_options(path : str) -> tuple[int | None, str, str | None, int, bool]:
+  """ Triangle budget, message format, compression codec, texture size and whether it builds primitives itself a
+  client asks for in its url, e.g. ws://localhost:8053/?budget=50000&format=binary&compression=deflate&texture=512&primitives=native
+  (format=binary is for Python clients, the Unity client only reads json) """
+  query = urllib.parse.parse_qs(urllib.parse.urlparse(path).query)
+  budget = int(query["budget"][0]) if "budget" in query else None
+  format = query.get("format", ["json"])[0]
+  codec = query.get("compression", [None])[0]
+  fitting = [size for size in TEXTURE_SIZES if "texture" not in query or size <= int(query["texture"][0])]
+  texture = max(fitting) if fitting else min(TEXTURE_SIZES)
+  primitives = query.get("primitives", ["mesh"])[0] == "native"
+  return budget, format if format in FORMATS else "json", codec if codec in CODECS else None, texture, primitives
+
+
+def compress_payload(pieces : list, codec : str, key : tuple = None) -> asyncio.Future:
+  """ Compresses on an executor thread (zlib releases the gil). Payloads with a key are compressed once, every client
+  awaits the same future """
+  compressing = lambda: asyncio.get_running_loop().run_in_executor(None, timed_compress, list(pieces), codec)
+  if key is None: return compressing()
+  key = key + (codec,)
+  if key not in _compressed: _compressed[key] = compressing()
+  return _compressed[key]
+
+
+def timed_compress(pieces : list, codec : str) -> bytes:
+  with metrics.timer("compress", codec=codec): return compress(pieces, codec, COMPRESSION_LEVEL)
+
+
+def snapshot_config() -> dict:
+  """ What a snapshot depends on besides its source files """
+  return {
+    "scene" : SCENE if SCENE is not None else FILE_PATH,
+    "converter" : CONVERTER_VERSION,
+    "trimesh" : trimesh.__version__,
+    "lods" : list(LOD_RATIOS),
+    "binary_meshes" : BINARY_MESHES,
+    "quantized_meshes" : QUANTIZED_MESHES,
+    "atlas" : ATLAS_SIZE,
+    "primitive_segments" : PRIMITIVE_SEGMENTS, # the DATA message holds the tessellated primitives
+    "primitive_color" : list(PRIMITIVE_COLOR),
+  }
+
+
+def open_snapshot(path : str) -> Snapshot | None:
+  """ The snapshot at path if it still matches its sources and the configuration """
+  try: snapshot = Snapshot(path)
+  except FileNotFoundError: reason, snapshot = "there is none yet", None
+  except (OSError, SnapshotError) as error: reason, snapshot = str(error), None
+  else: reason = snapshot.stale(snapshot_config())
+  if reason is None: return snapshot
+  cprint(f"Compiling the scene into {path}, {reason}", tag="SNAPSHOT", tag_color="blue", color="white")
+  return None
+
+
+def save_snapshot(entities : list[SceneEntity], meshes : dict[str, list[UMesh]], messages : dict[tuple[int, str], tuple[list[str], bytes]]):
+  dependencies = [file for entity in entities for file in entity_dependencies(entity) if os.path.isfile(file)] # a missing texture has no stamp
+  with metrics.timer("snapshot_write"): write_snapshot(SNAPSHOT, entities, meshes, messages, snapshot_config(), ([SCENE] if SCENE is not None else []) + dependencies)
+
+
+async def compile_snapshot(entities : list[SceneEntity]):
+  """ Writes the snapshot once the streamed mesh files are converted """
+  await asyncio.gather(*_loading.values())
+  meshes = { file : _meshes[file] for entity in entities for file in entity_mesh_files(entity) }
+  await asyncio.get_running_loop().run_in_executor(None, save_snapshot, entities, meshes, {})
+
+
+def keep_message(message : str | BinaryEncoder) -> str | BinaryEncoder | bytes | memoryview:
+  """ A memoized json message is kept encoded in the mesh store, as text it would stay on the heap and be encoded for every send """
+  if _store is None or not isinstance(message, str): return message
+  return _store.payload(message.encode())
+
+
+def package_data_message(level : int, format : str = "json", primitives : bool = False) -> tuple[UBuffer, str | BinaryEncoder | bytes | memoryview, list[str]]:
+  if (level, format, primitives) not in _data_messages: # packaged once per level and shared by all clients
+    buffer = UBuffer() if BINARY_MESHES and format == "json" else None # the binary format holds the arrays itself
+    with metrics.timer("package", message="DATA"): package = header.package(buffer, level, QUANTIZED_MESHES, primitives)
+    with metrics.timer("serialize", message="DATA", format=format): message = keep_message(serialize(package, format))
+    _data_messages[level, format, primitives] = (buffer, message, list(package["geometries"]))
+  return _data_messages[level, format, primitives]
+
+
+def package_mesh_message(entity : SceneEntity, visual : URDFVisual, level : int = 0, format : str = "json", primitives : bool = False) -> tuple[list[str], list[str], str | BinaryEncoder]:
+  """ The geometries and textures the MESH message of a visual refers to and the message """
+  key = (entity.name, visual.name, level, format, primitives)
+  if key not in _mesh_messages: # packaged once and shared by all clients
+    geometries, textures = {}, _entity_textures.get(entity.name, {})
+    converted = convert_visual(visual, entity.folder)
+    primitive = converted.primitive() if primitives else None
+    message = {
+      "entity" : entity.name,
+      "visual" : visual.name,
+      "meshes" : [mesh.level(level).package(geometries, textures, primitive) for mesh in converted.meshes]
+    }
+    _geometries.update(geometries)
+    with metrics.timer("serialize", message="MESH", format=format): encoded = serialize(message, format)
+    _mesh_messages[key] = (list(geometries), converted.texture_keys(textures), encoded)
+  return _mesh_messages[key]
+
+
+def package_shape_message(entity : SceneEntity, format : str = "json") -> tuple[list[str], str | BinaryEncoder]:
+  """ The collision shapes of an entity, packaged on the first request (decomposing meshes takes a while) """
+  with _shape_lock:
+    if (entity.name, format) not in _shape_messages:
+      geometries = {}
+      with metrics.timer("collision", item=entity.name): message = { "entity" : entity.name, "shapes" : [shape.package(geometries) for shape in convert_shapes(entity)] }
+      _geometries.update(geometries)
+      with metrics.timer("serialize", message="SHAPE", format=format): encoded = serialize(message, format)
+      _shape_messages[entity.name, format] = (list(geometries), encoded)
+    return _shape_messages[entity.name, format]
+
+
+def package_entity_messages() -> dict[tuple[str, str], str | BinaryEncoder]:
+  """ The ENTITY message of every entity in the scene per format, the kinematic tree without meshes """
+  return { (name, format) : serialize(convert_urdf(entity, skeleton=True).package({}), format) for name, entity in scene.items() for format in FORMATS }
+
+
+def package_geometry_message(key : str, format : str = "json") -> tuple[UBuffer, str | BinaryEncoder | bytes | memoryview]:
+  if (key, format) not in _geometry_messages:
+    buffer = UBuffer() if BINARY_MESHES and format == "json" else None
+    with metrics.timer("package", message="GEOMETRY"): package = _geometries[key].package_geometry(buffer, QUANTIZED_MESHES)
+    with metrics.timer("serialize", message="GEOMETRY", format=format): message = keep_message(serialize(package, format))
+    _geometry_messages[key, format] = (buffer, message)
+  return _geometry_messages[key, format]
+
+
+def encoded_texture(key : str, size : int) -> UTexture:
+  """ The texture at most size pixels on a side, encoded once per size and kept in the mesh cache by its content
+  address, so a restart does not encode it again either """
+  if (key, size) not in _encoded_textures:
+    cache_key = _cache.key(None, { "texture" : key, "size" : size, "quality" : TEXTURE_QUALITY }) if _cache is not None else None
+    cached = _cache.load_blob(cache_key) if _cache is not None else None
+    if cached is not None: meta, data = cached
+    else:
+      with metrics.timer("texture_encode", item=key): data, format, width, height = encode_texture(_textures[key], size, TEXTURE_QUALITY)
+      meta = { "format" : format, "width" : width, "height" : height }
+      if _cache is not None: _cache.store_blob(cache_key, meta, data)
+    _encoded_textures[key, size] = UTexture(key, data=_store.payload(data) if _store is not None else data, **meta)
+  return _encoded_textures[key, size]
+
+
+def package_texture_message(key : str, size : int, format : str = "json") -> tuple[UBuffer, str | BinaryEncoder]:
+  if (key, size, format) not in _texture_messages:
+    buffer = UBuffer() if format == "json" else None # json has no bytes, the image is the BUFFER before the message
+    texture = encoded_texture(key, size)
+    with metrics.timer("serialize", message="TEXTURE", format=format): message = serialize(texture.package(buffer), format)
+    _texture_messages[key, size, format] = (buffer, message)
+  return _texture_messages[key, size, format]
+
+
+def reload_entities(entities : list[SceneEntity], changed : list[str]) -> list[tuple[URDFData, UEntity]]:
+  """ Parses the changed urdfs again and converts only the changed mesh files again (or those with changed materials or
+  images), the others come from _meshes """
+  retextured = [file for entity in entities for file in entity_mesh_files(entity) if any(material in changed for material in mesh_materials(file))]
+  for file in [*changed, *retextured]:
+    _meshes.pop(file, None)
+    _materials.pop(file, None)
+  for file in changed:
+    _hulls.pop(file, None)
+    _surfaces.pop(file, None)
+    _texture_files.pop(file, None)
+  parse = lambda entity: any(file in changed for file in [entity.file, *entity.data.includes])
+  reloaded = [replace(entity, data=URDFData.from_file(entity.file, entity.args) if parse(entity) else entity.data) for entity in entities]
+  return [(entity.data, convert_urdf(entity)) for entity in reloaded]
+
+
+def read_scene(snapshot : Snapshot | None) -> list[SceneEntity]:
+  """ The parsed entities of the scene, from the snapshot if there is one """
+  with metrics.timer("parse"):
+    if snapshot is not None: entities = snapshot.entities()
+    else:
+      entities = load_manifest(SCENE) if SCENE is not None else [SceneEntity(FILE_PATH)]
+      parse_scene(entities)
+  if snapshot is not None: # the meshes and the full detail json DATA are views of the mapped file
+    _meshes.update(snapshot.meshes())
+    _data_messages.update({ (level, format, False) : (None, payload, geometries) for (level, format), (geometries, payload) in snapshot.messages().items() })
+  return entities
+
+
+def compile_data(entities : list[SceneEntity], save : bool):
+  """ Converts the scene once its mesh files are loaded and packages the full detail DATA message most clients get,
+  with save the snapshot is written too """
+  global header
+  with metrics.timer("convert_urdf"): header = UData(convert_entities(entities))
+  buffer, message, geometries = package_data_message(0)
+  if save:
+    files = dict.fromkeys(file for entity in entities for file in entity_mesh_files(entity))
+    save_snapshot(entities, { file : _meshes[file] for file in files }, { (0, "json") : (geometries, message) } if buffer is None else {}) # the json arrays take long to encode
+
+
+async def load_scene():
+  """ Loads the scene while the server already accepts clients, every blocking step runs on an executor. The urdfs
+  are parsed first (stage "scene", streaming clients get their ENTITY messages), then the mesh files are converted side
+  by side on MESH_WORKERS and streamed as they are done. Without streaming DATA is packaged once all are (stage "data") """
+  global scene, entity_messages
+  loop = asyncio.get_running_loop()
+  start = time.monotonic()
+  try:
+    snapshot = await loop.run_in_executor(None, open_snapshot, SNAPSHOT) if SNAPSHOT is not None else None
+    compile = SNAPSHOT is not None and snapshot is None
+    entities = await loop.run_in_executor(None, read_scene, snapshot)
+    scene = { entity.name : entity for entity in entities } # by unique name, in manifest order
+    for entity in entities: publisher.add_entity(entity.name, entity.movable_joints())
+    if STREAMING: entity_messages = await loop.run_in_executor(None, package_entity_messages)
+    executor = ProcessPoolExecutor(MESH_WORKERS) if MESH_WORKERS > 1 else ThreadPoolExecutor(1)
+    start_loading(entities, executor)
+    stage("scene").set_result(None)
+
+    if STREAMING and compile: await compile_snapshot(entities)
+    await asyncio.gather(*_loading.values())
+    executor.shutdown(wait=False)
+    if not STREAMING:
+      await loop.run_in_executor(None, compile_data, entities, compile)
+      stage("data").set_result(None)
+  except Exception as error: # nothing to serve, the server stops as it did when compiling failed before it listened
+    cprint(f"Loading the scene failed: {error!r}", tag="LOAD", tag_color="red", color="white")
+    loop.stop()
+    raise
+
+  await loop.run_in_executor(None, release_memory)
+  metrics.flush()
+  cprint(f"Loading took {time.monotonic() - start:.2f}s", tag="TIME", tag_color="blue", color='white')
+  if WATCH: loop.create_task(watch_files())
+
+
+async def watch_files():
+  """ Polls the urdfs, mesh files and textures of the scene, on a change the entities using them are converted again and every
+  client gets a DIFF per changed entity """
+  global header, entity_messages, _spatial
+
+  for entity in scene.values():
+    for visual in entity.visuals().values(): await wait_for_visual(entity, visual) # streaming, the first conversion has to be done
+  converted = { name : convert_urdf(entity) for name, entity in scene.items() }
+  sources = lambda entity: [entity.file, *entity_mesh_files(entity), *entity_dependencies(entity)]
+  watched = lambda: [file for entity in scene.values() for file in sources(entity)]
+  watcher = FileWatcher(watched())
+  loop = asyncio.get_event_loop()
+
+  while True:
+    await asyncio.sleep(WATCH_INTERVAL)
+    changed = watcher.changed()
+    if not changed: continue
+
+    start = time.monotonic()
+    affected = [entity for entity in scene.values() if any(file in changed for file in sources(entity))]
+    try:
+      with metrics.timer("reload"): reloaded = await loop.run_in_executor(None, reload_entities, affected, changed)
+    except Exception as error: # e.g. a file saved halfway, the next save triggers another reload
+      cprint(f"Reloading {', '.join(changed)} failed: {error!r}", tag="RELOAD", tag_color="red", color="white")
+      continue
+
+    diffs = []
+    for entity, (data, new_entity) in zip(affected, reloaded):
+      diff = diff_entities(converted[entity.name], new_entity)
+      entity.data, converted[entity.name] = data, new_entity
+      _models.pop(entity.name, None)
+      layout_changed = entity.movable_joints() != publisher.joints[publisher.entities.index(entity.name)]
+      if layout_changed: publisher.set_joints(entity.name, entity.movable_joints())
+      if diff: diffs.append((diff, layout_changed))
+
+    header = UData(list(converted.values()))
+    watcher.watch(watched())
+    _data_messages.clear()
+    _mesh_messages.clear()
+    _shape_messages.clear()
+    _compressed.clear()
+    _spatial = None
+    if STREAMING: entity_messages = package_entity_messages()
+
+    for diff, layout_changed in diffs: # the tasks are queued on the connection locks before the publisher can send a frame of the new layout
+      await asyncio.gather(*[asyncio.create_task(send_diff(diff, layout_changed)) for send_diff in list(_clients)], return_exceptions=True)
+      publisher.resend(diff.entity) # clients may have spawned the entity again
+    cprint(f"Reloaded {', '.join(changed)} in {time.monotonic() - start:.2f}s, " + "; ".join(f"{diff.entity}: {diff.summary()}" for diff, _ in diffs), tag="RELOAD", tag_color="blue", color="white")
+
 
 async def ws_server(websocket, path):
 
-  async def send(type : UHeaderType, data : str):
-    data = type + ":::" + data + "</>"      
-    MAX_SIZE : int = 2**20
-    parts = len(data) // MAX_SIZE + (1 if len(data) % MAX_SIZE else 0)
-    for i in range(parts): await websocket.send(data[i * MAX_SIZE:(i + 1) * MAX_SIZE].encode())
+  MAX_RECEIVE : int = 2**24 # largest message a client may send
+  lock = asyncio.Lock() # one message (and its BUFFER) at a time, no frame ends up between their chunks
+  client = ":".join(map(str, websocket.remote_address or ()))
+  message_ids = itertools.count()
+  loop = asyncio.get_running_loop() # packaging and queries run on its executor, the other clients go on meanwhile
+
+  @contextlib.asynccontextmanager
+  async def sending(type : UHeaderType, size : int):
+    metrics.gauge("send_queue", 1, add=True, client=client)
+    async with lock:
+      metrics.gauge("send_queue", -1, add=True, client=client)
+      with metrics.timer("send", message=type.value): yield
+    metrics.count("bytes_sent", size, client=client)
+    metrics.count("messages_sent", client=client, message=type.value)
+
+  async def encode(type : UHeaderType, pieces : list, size : int, key : tuple = None) -> tuple[UHeaderType, int, list, int]:
+    """ The type, flags, pieces and size of a part of a message as it is framed """
+    if codec is None or size < COMPRESSION_THRESHOLD: return type, 0, pieces, size
+    data = await compress_payload(pieces, codec, key)
+    metrics.count("bytes_compressed", size - len(data), client=client)
+    return type, CODECS[codec], [data], len(data)
+
+  async def send_message(type : UHeaderType, message : str | BinaryEncoder | bytes | memoryview, buffer : UBuffer = None, key : tuple = None):
+    """ Sends the message right after the BUFFER it refers to. The binary format has the encoded message as BUFFER of an
+    empty message. A key names a memoized message, it is compressed once for all clients """
+    parts = []
+    if isinstance(message, BinaryEncoder): buffer, message = message, ""
+    if buffer is not None: parts.append(await encode(UHeaderType.BUFFER, buffer.chunks, buffer.size, key and ("BUFFER", *key)))
+    data = message.encode() if isinstance(message, str) else message # the only copy, the frames are views into it (a stored or mapped message needs none)
+    parts.append(await encode(type, [data], len(data), key))
+
+    async with sending(type, sum(part[3] for part in parts)):
+      for part_type, flags, pieces, size in parts:
+        for fragments in frames(part_type, next(message_ids) & 0xFFFFFFFF, pieces, size, flags):
+          await websocket.send(fragments if len(fragments) > 1 else fragments[0]) # a list goes out as one fragmented frame
+
+  async def send_update(update : bytes):
+    try:
+      async with sending(UHeaderType.UPDATE, len(update) + HEADER.size): await websocket.send(frame(UHeaderType.UPDATE, next(message_ids) & 0xFFFFFFFF, update))
+    except websockets.exceptions.ConnectionClosed: pass # unsubscribed once the receive loop notices
   
 
   colors = {
@@ -158,22 +944,142 @@ async def ws_server(websocket, path):
 
   fprint = lambda y, x: cprint(x, tag=y, tag_color=colors[y][0], color=colors[y][1])
 
+  sent = set() # every geometry is sent once per client, no matter how many visuals or levels use it
+
+  async def send_geometries(keys : list[str]):
+    for key in keys:
+      if key in sent: continue
+      geometry_buffer, geometry = await loop.run_in_executor(None, package_geometry_message, key, format)
+      await send_message(UHeaderType.GEOMETRY, geometry, geometry_buffer, ("GEOMETRY", key, format))
+      sent.add(key)
+
+  sent_textures = set()
+
+  async def send_textures(keys : list[str]):
+    for key in keys:
+      if key in sent_textures: continue
+      texture_buffer, texture = await loop.run_in_executor(None, package_texture_message, key, texture_size, format)
+      await send_message(UHeaderType.TEXTURE, texture, texture_buffer, ("TEXTURE", key, texture_size, format))
+      sent_textures.add(key)
+
+  async def send_visual(entity : SceneEntity, visual : URDFVisual, level : int):
+    geometries, textures, message = await loop.run_in_executor(None, package_mesh_message, entity, visual, level, format, primitives)
+    await send_textures(textures)
+    await send_geometries(geometries)
+    await send_message(UHeaderType.MESH, message, key=("MESH", entity.name, visual.name, level, format, primitives))
+
+  async def send_diff(diff : EntityDiff, layout_changed : bool):
+    if layout_changed: await send_message(UHeaderType.JOINTS, serialize(publisher.layout(), format))
+    geometries = {}
+    message = serialize(diff.package(geometries, pick_level(header.triangles, budget), primitives), format)
+    _geometries.update(geometries)
+    await send_textures([key for visual in [*diff.visuals.added.values(), *diff.visuals.changed.values()] for key in visual.texture_keys()])
+    await send_geometries(list(geometries))
+    await send_message(UHeaderType.DIFF, message)
+
+  async def stream_meshes():
+    waiting = [wait_for_visual(entity, visual) for entity in scene.values() for visual in entity.visuals().values()]
+    share = budget // max(len(waiting), 1) if budget is not None else None # every visual gets the same part of the budget
+    for visual in asyncio.as_completed(waiting):
+      entity, visual = await visual
+      await send_visual(entity, visual, pick_level(convert_visual(visual, entity.folder).triangles, share))
+
+  async def send_error(kind : UHeaderType, request, error : Exception):
+    """ Answers a message that could not be handled with an ERR, commands with their id so the client can match it """
+    command = request if isinstance(request, dict) else {}
+    text = f"{type(error).__name__}: {error}"
+    fprint("ERR", f"{kind.value} {command['command']} failed, {text}" if "command" in command else f"{kind.value} failed, {text}")
+    await send_message(UHeaderType.ERR, serialize({ "id" : command.get("id"), "command" : command.get("command"), "message" : kind.value, "error" : text }, format))
+
+  async def run_command(command : dict):
+    if command["command"] == "lod": # { "command" : "lod", "entity" : name, "visual" : name, "level" : level }, answered with a MESH
+      entity = scene[command["entity"]]
+      entity, visual = await wait_for_visual(entity, entity.visuals()[command["visual"]])
+      await send_visual(entity, visual, min(max(int(command["level"]), 0), len(LOD_RATIOS)))
+    elif command["command"] == "collision": # { "command" : "collision", "entity" : name }, every entity without one, answered with a SHAPE per entity
+      for entity in [scene[command["entity"]]] if "entity" in command else scene.values():
+        geometries, message = await loop.run_in_executor(None, package_shape_message, entity, format)
+        await send_geometries(geometries)
+        await send_message(UHeaderType.SHAPE, message, key=("SHAPE", entity.name, format))
+    elif command["command"] in ("raycast", "nearest"): # { "command" : "raycast", "id" : id, "origins" : [[x, y, z]], "directions" : [[x, y, z]] } or "points" for nearest, max_distance is optional
+      result = await loop.run_in_executor(None, run_query, command)
+      await send_message(UHeaderType.RESULT, serialize(result, format))
+    elif command["command"] == "ik": # { "command" : "ik", "id" : id, "entity" : name, "link" : name, "targets" : [[x, y, z]] }, optional "rotations" : [[x, y, z, w]], "restarts" and "apply"
+      result = await loop.run_in_executor(None, run_ik, command)
+      if command.get("apply", False): # the entity moves to the solution of the last target, every client sees it with the next UPDATE
+        publisher.set_positions(result["entity"], kinematic_model(scene[result["entity"]]).joint_positions(result["positions"][-1]))
+      await send_message(UHeaderType.RESULT, serialize(result, format))
+    else:
+      raise ValueError(f"Unknown command {command['command']}")
+
   cprint("WebSocket: Server Started.", tag="INFO", tag_color="blue", color='white')
-  await send(UHeaderType.DATA, string_data)
+  metrics.gauge("clients", 1, add=True)
 
+  budget, format, codec, texture_size, primitives = client_options(path)
+  await stage("scene" if STREAMING else "data") # connected while the scene is still loading
+  streaming = None
+  if STREAMING:
+    for name in scene: await send_message(UHeaderType.ENTITY, entity_messages[name, format], key=("ENTITY", name, format))
+    streaming = asyncio.create_task(stream_meshes())
+  else:
+    level = pick_level(header.triangles, budget)
+    data_buffer, data_message, geometries = await loop.run_in_executor(None, package_data_message, level, format, primitives)
+    await send_textures(header.texture_keys())
+    await send_message(UHeaderType.DATA, data_message, data_buffer, ("DATA", level, format, primitives))
+    sent.update(geometries)
+
+  await send_message(UHeaderType.JOINTS, serialize(publisher.layout(), format))
+  updates = publisher.subscribe(send_update, client)
+  _clients.add(send_diff)
+
+  assembler = Assembler(MAX_RECEIVE)
   try:
-    async for message in websocket:
-      fprint(*message.split(":::"))
+    async for data in websocket:
+      if isinstance(data, str): raise FramingError("Text frames are not part of the protocol")
+      received = assembler.feed(data)
+      if received is None: continue # more chunks to come
+      kind, request = received[0], None
+      try:
+        content = bytes(received[1]).decode()
+        if kind == UHeaderType.UPDATE: # joint positions from a robot, { "entity" : name, "positions" : { joint : value } }
+          update = json.loads(content)
+          if not isinstance(update, dict) or set(update) != { "entity", "positions" }: raise ValueError('An UPDATE has to be { "entity" : name, "positions" : { joint : value } }')
+          publisher.set_positions(update["entity"], update["positions"])
+        elif kind == UHeaderType.CMD:
+          request = json.loads(content)
+          await run_command(request)
+        else:
+          fprint(kind.value if kind.value in colors else "MSG", content)
+      except (KeyError, ValueError, TypeError, json.JSONDecodeError) as error: # a malformed message fails alone, the connection stays open
+        await send_error(kind, request, error)
+  except FramingError as error:
+    fprint("ERR", f"Closing the connection, {error}")
+    await websocket.close(1002) # protocol error
   except websockets.exceptions.ConnectionClosedError:
     print("Client disconneted abnormaly")
+  finally:
+    publisher.unsubscribe(updates)
+    _clients.discard(send_diff)
+    if streaming is not None: streaming.cancel()
+    metrics.gauge("clients", -1, add=True)
+    metrics.forget(client=client) # a reconnecting client comes back on another port, its old series would stay forever
   
 
 
-# Start the WebSocket server
-start_server = websockets.serve(ws_server, "localhost", 8053)
-try:
-  cprint("Waiting for connection", tag="SERVER", tag_color="blue", color='white')
-  asyncio.get_event_loop().run_until_complete(start_server)
-  asyncio.get_event_loop().run_forever()
-except KeyboardInterrupt:
-  print("Closing app")
+if __name__ == "__main__": # the mesh workers import this module, so nothing may run on import
+
+  metrics.configure(METRICS_SINKS, METRICS_BREAKDOWN)
+  if MESH_STORE: _store = MeshStore()
+  publisher = JointStatePublisher(UPDATE_RATE, UPDATE_EPSILON) # the entities are added once parsed
+
+  # Start the WebSocket server, the scene is loaded while it runs
+  start_server = websockets.serve(ws_server, "localhost", 8053, compression="deflate" if PERMESSAGE_DEFLATE else None)
+  try:
+    cprint("Waiting for connection", tag="SERVER", tag_color="blue", color='white')
+    asyncio.get_event_loop().run_until_complete(start_server)
+    asyncio.get_event_loop().create_task(load_scene())
+    asyncio.get_event_loop().create_task(publisher.run())
+    asyncio.get_event_loop().create_task(metrics.run(METRICS_INTERVAL))
+    asyncio.get_event_loop().run_forever()
+  except KeyboardInterrupt:
+    print("Closing app")
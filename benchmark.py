@@ -0,0 +1,219 @@
+""" Benchmarks every stage of serving the bundled robots, from parsing the urdf to delivering DATA over a websocket.
+
+  python benchmark.py                                  # all models, results in benchmark.json
+  python benchmark.py --models T12 --repeat 5
+  python benchmark.py --output new.json --compare benchmark.json
+
+Mesh conversion runs cold (no mesh cache). Timings are the median of --repeat runs, the peak memory of a stage is
+measured in one extra run under tracemalloc, so it does not slow down the timed runs """
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import trimesh
+import websockets
+import backend
+from framing import Assembler
+from joint_state import JointStatePublisher
+from lod import build_lods
+from parsers.urdf_parser import URDFData
+from scene import SceneEntity
+from serializer import serialize
+from snapshot import Snapshot, write_snapshot
+from udata import UBuffer, UData, UHeaderType
+
+MODELS = {
+  "panda_pybullet" : "res/models/pybullet/robots/panda_arm_hand_without_cam.urdf",
+  "panda_mujoco" : "res/models/pybullet/robots/panda_arm_hand_without_cam_inertia_from_mujoco.urdf",
+  "panda_test" : "res/models/test/panda.urdf",
+  "panda_xacro" : "res/models/test/franka_description/robots/panda/panda.urdf.xacro",
+  "T12" : "res/models/T12/urdf/T12.URDF",
+  "TriATHLETE" : "res/models/TriATHLETE/urdf/TriATHLETE.URDF",
+  "TriATHLETE_Climbing" : "res/models/TriATHLETE_Climbing/urdf/TriATHLETE.URDF",
+}
+
+RESULTS_VERSION = 1
+NOISE_SECONDS = 0.025 # differences below this are never reported as regressions
+
+
+def measure(function, repeat : int, memory : bool) -> tuple[object, dict]:
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = function()
+    times.append(time.perf_counter() - start)
+
+  stats = { "seconds" : statistics.median(times), "min_seconds" : min(times) }
+  if memory:
+    tracemalloc.start()
+    function()
+    stats["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  return result, stats
+
+
+async def receive_initial(port : int, query : str) -> int:
+  """ Connects like a client and returns the bytes received until the JOINTS message after DATA is complete, after that
+  the server only sends UPDATE frames """
+  assembler = Assembler()
+  async with websockets.connect(f"ws://localhost:{port}/?{query}", max_size=None) as websocket:
+    received = 0
+    async for message in websocket:
+      received += len(message)
+      complete = assembler.feed(message)
+      if complete is not None and complete[0] == UHeaderType.JOINTS: return received
+
+
+def reset_backend():
+  """ The backend serves its scene through module globals, these are cleared for the model under test """
+  backend._cache, backend._spatial = None, None
+  for memo in backend._memos: memo.clear()
+
+
+def run_model(path : str, repeat : int, memory : bool) -> dict:
+  result = { "path" : path, "status" : "ok", "stages" : {} }
+  stages = result["stages"]
+
+  def run(name : str, function):
+    value, stages[name] = measure(function, repeat, memory)
+    return value
+
+  reset_backend()
+  data = run("parse", lambda: URDFData.from_file(path))
+  entity = SceneEntity(path, data.name, data=data)
+  files = backend.entity_mesh_files(entity)
+
+  scenes = run("mesh_load", lambda: { file : trimesh.load(file, force="scene") for file in files })
+  meshes = run("conversion", lambda: { file : backend.convert_scene(scene) for file, scene in scenes.items() })
+  lods = run("lod", lambda: [[build_lods(mesh, backend.LOD_RATIOS) for mesh in file_meshes] for file_meshes in meshes.values()])
+  for file_meshes, file_lods in zip(meshes.values(), lods):
+    for mesh, mesh_lods in zip(file_meshes, file_lods): mesh.lods = mesh_lods
+
+  backend._meshes.update(meshes)
+  with tempfile.TemporaryDirectory() as folder: # what a server starting from a compiled snapshot does instead of the stages above
+    path = os.path.join(folder, "scene.snapshot")
+    write_snapshot(path, [entity], meshes, {}, backend.snapshot_config())
+    run("snapshot_load", lambda: (lambda snapshot: (snapshot.entities(), snapshot.meshes()))(Snapshot(path)))
+  header = UData([backend.convert_urdf(entity)])
+  run("packaging", lambda: header.package(UBuffer() if backend.BINARY_MESHES else None, 0, backend.QUANTIZED_MESHES))
+
+  package = header.package(None, 0, backend.QUANTIZED_MESHES)
+  encoded = { format : run(f"serialize_{format}", lambda: serialize(package, format)) for format in ("json", "binary") }
+  result["bytes"] = { "json" : len(encoded["json"].encode()), "binary" : encoded["binary"].size }
+
+  # the real server handler, with the globals its __main__ would set
+  backend.header, backend.scene = header, { entity.name : entity }
+  backend.publisher = JointStatePublisher(backend.UPDATE_RATE, backend.UPDATE_EPSILON)
+  backend.publisher.add_entity(entity.name, entity.movable_joints())
+
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop) # websockets < 11 binds to the current loop
+  backend.stage("data").set_result(None) # loaded above, the handler does not wait for load_scene
+  server = loop.run_until_complete(websockets.serve(backend.ws_server, "localhost", 0, max_size=None, compression="deflate" if backend.PERMESSAGE_DEFLATE else None))
+  port = server.sockets[0].getsockname()[1]
+  try:
+    with contextlib.redirect_stdout(io.StringIO()): # the handler logs every connection
+      for format in ("json", "binary"):
+        backend.package_data_message(0, format) # packaged above already, only the delivery is timed
+        result["bytes"][f"delivered_{format}"] = run(f"delivery_{format}", lambda: loop.run_until_complete(receive_initial(port, f"format={format}")))
+        loop.run_until_complete(receive_initial(port, f"format={format}&compression=deflate")) # compressed once, shared by the timed runs
+        result["bytes"][f"delivered_{format}_deflate"] = run(f"delivery_{format}_deflate", lambda: loop.run_until_complete(receive_initial(port, f"format={format}&compression=deflate")))
+  finally:
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+  all_meshes = [mesh for file_meshes in meshes.values() for mesh in file_meshes]
+  result.update(
+    links=len(data.links),
+    joints=len(data.joints),
+    mesh_files=len(files),
+    meshes=len(all_meshes),
+    vertices=sum(len(mesh.vertices) for mesh in all_meshes),
+    triangles=sum(mesh.triangles() for mesh in all_meshes),
+  )
+  return result
+
+
+def environment() -> dict:
+  try: commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError): commit = None
+  return {
+    "commit" : commit,
+    "python" : platform.python_version(),
+    "platform" : platform.platform(),
+    "cpus" : os.cpu_count(),
+    "packages" : { "numpy" : np.__version__, "trimesh" : trimesh.__version__, "websockets" : websockets.__version__ },
+  }
+
+
+def compare(results : dict, baseline : dict, threshold : float) -> list[str]:
+  """ Prints the stage times against baseline and returns the stages slower than threshold times the baseline """
+  regressions = []
+  for name, model in results["models"].items():
+    old = baseline["models"].get(name)
+    if old is None or old["status"] != "ok" or model["status"] != "ok": continue
+    for stage, stats in model["stages"].items():
+      if stage not in old["stages"]: continue
+      before, after = old["stages"][stage]["seconds"], stats["seconds"]
+      ratio = after / before if before > 0 else float("inf")
+      slower = ratio > threshold and after - before > NOISE_SECONDS
+      print(f"{name:<20} {stage:<18} {before:9.4f}s -> {after:9.4f}s  x{ratio:5.2f}{'  REGRESSION' if slower else ''}")
+      if slower: regressions.append(f"{name}/{stage}")
+  return regressions
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description="Benchmark the urdf loading pipeline on the bundled models")
+  parser.add_argument("--models", nargs="+", choices=list(MODELS), default=list(MODELS))
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--output", default="benchmark.json")
+  parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+  parser.add_argument("--compare", help="results file of an earlier run")
+  parser.add_argument("--threshold", type=float, default=1.25, help="slowdown factor reported as regression")
+  args = parser.parse_args()
+
+  results = {
+    "version" : RESULTS_VERSION,
+    "created" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "environment" : environment(),
+    "config" : {
+      "repeat" : args.repeat,
+      "memory" : not args.no_memory,
+      "binary_meshes" : backend.BINARY_MESHES,
+      "quantized_meshes" : backend.QUANTIZED_MESHES,
+      "lod_ratios" : list(backend.LOD_RATIOS),
+      "compression_level" : backend.COMPRESSION_LEVEL,
+    },
+    "models" : {},
+  }
+
+  for name in args.models:
+    start = time.monotonic()
+    try: results["models"][name] = run_model(MODELS[name], args.repeat, not args.no_memory)
+    except Exception as error: # a model that fails is recorded, the others still run
+      results["models"][name] = { "path" : MODELS[name], "status" : "error", "error" : f"{type(error).__name__}: {error}" }
+    print(f"{name:<20} {results['models'][name]['status']:<6} {time.monotonic() - start:6.1f}s", file=sys.stderr)
+
+  with open(args.output, "w") as fp: json.dump(results, fp, indent=2)
+
+  if args.compare is None: return 0
+  with open(args.compare) as fp: baseline = json.load(fp)
+  regressions = compare(results, baseline, args.threshold)
+  if regressions: print(f"{len(regressions)} regressions: {', '.join(regressions)}", file=sys.stderr)
+  return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,127 @@
+import heapq
+import itertools
+import numpy as np
+import trimesh
+from scipy.spatial import ConvexHull, QhullError, cKDTree
+from trimesh.intersections import slice_faces_plane
+
+
+CUTS = (0.25, 0.5, 0.75) # where a part may be cut, as fraction of its extent along an axis
+SAMPLES = 4096 # points sampled on the surface to measure how far a hull strays from it
+
+
+def _hull(points : np.ndarray) -> ConvexHull | None:
+  """ None for flat or degenerate point sets, they have no volume """
+  if len(points) < 4: return None
+  try: return ConvexHull(points)
+  except (QhullError, ValueError): return None
+
+
+def _sample_surface(vertices : np.ndarray, faces : np.ndarray, count : int) -> tuple[np.ndarray, float]:
+  """ count points spread over the triangles by their area, the same on every run, and the surface area """
+  corners = vertices[faces]
+  areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1) / 2
+  if areas.sum() <= 0: return np.zeros((0, 3)), 0.0
+  random = np.random.default_rng(0)
+  corners = corners[random.choice(len(faces), count, p=areas / areas.sum())]
+  weights = random.random((count, 2))
+  flip = weights.sum(axis=1) > 1 # folds the square onto the triangle
+  weights[flip] = 1 - weights[flip]
+  return corners[:, 0] + weights[:, :1] * (corners[:, 1] - corners[:, 0]) + weights[:, 1:] * (corners[:, 2] - corners[:, 0]), float(areas.sum())
+
+
+def convex_parts(vertices : np.ndarray, faces : np.ndarray, max_hulls : int, concavity : float) -> list[np.ndarray]:
+  """ Approximate convex decomposition, the points of every part. The concavity of a part is how far the surface of
+  its hull gets from its surface (or the planes it was cut off at). The most concave part is cut in two by an axis
+  aligned plane as long as this is more than concavity relative to the size of the mesh. Of the planes at CUTS of
+  every axis the one whose halves have the smallest hulls together is taken. The hulls cover the whole surface """
+  samples, area = _sample_surface(vertices, faces, SAMPLES)
+  tolerance = max(concavity * float(np.linalg.norm(np.ptp(vertices, axis=0))), np.sqrt(area / SAMPLES)) # not below the distance of the samples
+  count = itertools.count() # orders parts of the same concavity
+
+  def part(vertices : np.ndarray, faces : np.ndarray, samples : np.ndarray, planes : list[tuple[int, float]]) -> tuple:
+    hull = _hull(vertices)
+    if hull is None: return (0.0, next(count), vertices, faces, samples, planes, None)
+    centers = vertices[hull.simplices].mean(axis=1)
+    distances = cKDTree(np.concatenate([vertices, samples])).query(centers)[0]
+    for axis, position in planes: distances = np.minimum(distances, np.abs(centers[:, axis] - position))
+    return (-float(distances.max()), next(count), vertices, faces, samples, planes, hull.volume)
+
+  def cut(piece : tuple, axis : int, position : float) -> tuple[tuple, tuple]:
+    _, _, vertices, faces, samples, planes, _ = piece
+    halves = []
+    for side in (1.0, -1.0):
+      normal = np.zeros(3)
+      normal[axis] = side
+      half_vertices, half_faces = slice_faces_plane(vertices, faces, normal, normal * position * side)[:2]
+      half_samples = samples[side * (samples[:, axis] - position) >= 0]
+      halves.append(part(half_vertices, half_faces, half_samples, planes + [(axis, position)]))
+    return tuple(halves)
+
+  parts = [part(vertices, faces, samples, [])] # heap of the most concave part first
+  done = []
+  while parts and len(parts) + len(done) < max_hulls:
+    piece = heapq.heappop(parts)
+    candidates = []
+    if -piece[0] > tolerance:
+      low, high = piece[2].min(axis=0), piece[2].max(axis=0)
+      for axis in range(3):
+        for fraction in CUTS:
+          halves = cut(piece, axis, low[axis] + fraction * (high[axis] - low[axis]))
+          if halves[0][6] and halves[1][6]: candidates.append((halves[0][6] + halves[1][6], axis, fraction, halves))
+
+    best = min(candidates, key=lambda candidate: candidate[:3], default=None)
+    if best is None: done.append(piece[2])
+    else:
+      for half in best[3]: heapq.heappush(parts, half)
+
+  return done + [piece[2] for piece in parts]
+
+
+def reduce_points(points : np.ndarray, count : int) -> np.ndarray:
+  """ count of the points spread over them by farthest point sampling, starting with the one farthest from the center """
+  if len(points) <= count: return points
+  chosen = [np.argmax(np.linalg.norm(points - points.mean(axis=0), axis=1))]
+  distances = np.linalg.norm(points - points[chosen[0]], axis=1)
+  for _ in range(count - 1):
+    chosen.append(np.argmax(distances))
+    distances = np.minimum(distances, np.linalg.norm(points - points[chosen[-1]], axis=1))
+  return points[chosen]
+
+
+def scene_arrays(scene : trimesh.Scene) -> tuple[np.ndarray, np.ndarray]:
+  """ Vertices and faces of every geometry of the scene moved to where the scene graph puts them, in one array each """
+  vertices, faces, count = [], [], 0
+  for node in scene.graph.nodes_geometry:
+    matrix, name = scene.graph[node]
+    geometry = scene.geometry[name]
+    if not isinstance(geometry, trimesh.Trimesh): continue # points and paths have no volume
+    vertices.append(trimesh.transform_points(geometry.vertices, matrix))
+    faces.append(geometry.faces + count)
+    count += len(geometry.vertices)
+  if not vertices: return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+  return np.concatenate(vertices), np.concatenate(faces)
+
+
+def hull_mesh(points : np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+  """ Vertices and counter clockwise (seen from outside) faces of the convex hull of points """
+  hull = _hull(points)
+  if hull is None: return None
+  faces = hull.simplices.copy()
+  corners = points[faces]
+  inward = np.einsum("ij,ij->i", np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), hull.equations[:, :3]) < 0
+  faces[inward] = faces[inward][:, ::-1]
+  used, faces = np.unique(faces, return_inverse=True) # only the points on the hull
+  return points[used], faces.reshape(-1, 3)
+
+
+def convex_hulls(vertices : np.ndarray, faces : np.ndarray, max_hulls : int, max_vertices : int, concavity : float) -> list[tuple[np.ndarray, np.ndarray]]:
+  """ Vertices and faces of the hulls of the convex decomposition of a mesh, every hull with at most max_vertices
+  vertices (physics engines cap convex meshes at 255). Parts too flat for a hull are dropped """
+  hulls = []
+  if len(faces) == 0: return hulls
+  for points in convex_parts(vertices, faces, max_hulls, concavity):
+    hull = hull_mesh(points)
+    if hull is not None and len(hull[0]) > max_vertices: hull = hull_mesh(reduce_points(hull[0], max_vertices))
+    if hull is not None: hulls.append(hull)
+  return hulls
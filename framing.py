@@ -0,0 +1,112 @@
+import struct
+import zlib
+from typing import Iterable, Iterator
+from udata import UHeaderType
+
+# Every websocket message is one binary frame, a fixed header followed by a chunk of the payload, little endian:
+# uint8 type (index in TYPES), uint8 flags, uint16 reserved, uint32 message id, uint32 chunk index, uint64 payload length.
+# A payload is split into chunks of CHUNK_SIZE bytes, every chunk but the last is full and they arrive in order.
+# The flags are the codec the payload is compressed with, the length is the one of the compressed payload
+HEADER = struct.Struct("<BBHIIQ")
+CHUNK_SIZE = 2**20
+TYPES = list(UHeaderType)
+CODECS = { "deflate" : 1 } # raw deflate (no zlib header), what the DeflateStream of the clients reads
+COALESCE_BYTES = 4096 # pieces of a chunk smaller than this are joined, larger ones are sent as their own fragment
+
+
+class FramingError(ValueError): pass
+
+
+def chunks(pieces : Iterable[memoryview], size : int = CHUNK_SIZE) -> Iterator[list[memoryview]]:
+  """ Cuts the payload pieces (e.g. the chunks of an encoder) into lists of views of at most size bytes, nothing is copied """
+  chunk, free = [], size
+  for piece in pieces:
+    piece = memoryview(piece).cast("B")
+    offset = 0
+    while offset < piece.nbytes:
+      view = piece[offset:offset + free]
+      chunk.append(view)
+      offset += view.nbytes
+      free -= view.nbytes
+      if free == 0:
+        yield chunk
+        chunk, free = [], size
+  if chunk: yield chunk
+
+
+def frames(type : UHeaderType, message_id : int, pieces : Iterable[memoryview], size : int, flags : int = 0) -> Iterator[list[bytes | memoryview]]:
+  """ The websocket messages of a payload of size bytes, each as the fragments that make up the frame. Small pieces
+  (and the header) are joined, large views are sent as they are, so no more than a chunk is ever copied """
+  index = -1
+  for index, chunk in enumerate(chunks(pieces)):
+    yield _coalesce([HEADER.pack(TYPES.index(type), flags, 0, message_id, index, size), *chunk])
+  if index < 0: yield [HEADER.pack(TYPES.index(type), flags, 0, message_id, 0, size)] # empty payloads still have a frame
+
+
+def _coalesce(pieces : list) -> list[bytes | memoryview]:
+  fragments, small = [], []
+  for piece in pieces:
+    if len(piece) < COALESCE_BYTES: # the views are cast to bytes, their len is their size
+      small.append(piece)
+      continue
+    if small: fragments.append(b"".join(small))
+    small = []
+    fragments.append(piece)
+  if small: fragments.append(b"".join(small))
+  return fragments
+
+
+def frame(type : UHeaderType, message_id : int, payload : bytes) -> bytes:
+  """ A payload that fits into one chunk as a single frame """
+  assert len(payload) <= CHUNK_SIZE
+  return HEADER.pack(TYPES.index(type), 0, 0, message_id, 0, len(payload)) + payload
+
+
+def compress(pieces : Iterable[memoryview], codec : str, level : int) -> bytes:
+  """ Compresses the payload piece by piece, the uncompressed payload is never joined """
+  assert CODECS[codec] == CODECS["deflate"]
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+  return b"".join([compressor.compress(piece) for piece in pieces] + [compressor.flush()])
+
+
+def decompress(payload : memoryview, flags : int, limit : int = None) -> memoryview:
+  if flags == 0: return payload
+  if flags != CODECS["deflate"]: raise FramingError(f"Unknown codec {flags}")
+  decompressor = zlib.decompressobj(-15)
+  try: data = decompressor.decompress(payload, limit + 1 if limit is not None else 0)
+  except zlib.error as error: raise FramingError(f"Payload does not inflate, {error}")
+  if limit is not None and len(data) > limit: raise FramingError(f"Message inflates to more than the limit of {limit} bytes")
+  return memoryview(data)
+
+
+class Assembler:
+  """ Puts the chunks of the received messages back together. The payload is allocated once at its announced length
+  and filled in place, a message larger than limit bytes is refused before anything is allocated """
+
+  def __init__(self, limit : int = None):
+    self.limit = limit
+    self.partial : dict[int, list] = {} # message id to type, payload, offset and next chunk index
+
+  def feed(self, data : bytes) -> tuple[UHeaderType, memoryview] | None:
+    """ Takes one frame, returns type and payload once the message is complete """
+    if len(data) < HEADER.size: raise FramingError(f"Frame of {len(data)} bytes is shorter than its header")
+    code, flags, _, message_id, index, size = HEADER.unpack_from(data)
+    if code >= len(TYPES): raise FramingError(f"Unknown message type {code}")
+    chunk = memoryview(data)[HEADER.size:]
+
+    if index == 0:
+      if self.limit is not None and size > self.limit: raise FramingError(f"Message of {size} bytes exceeds the limit of {self.limit}")
+      if message_id in self.partial: raise FramingError(f"Message {message_id} started twice")
+      if chunk.nbytes == size: return TYPES[code], decompress(chunk, flags, self.limit) # fits into one frame, the common case
+      self.partial[message_id] = [TYPES[code], bytearray(size), 0, 0]
+
+    message = self.partial.get(message_id)
+    if message is None or message[3] != index: raise FramingError(f"Chunk {index} of message {message_id} out of order")
+    type, payload, offset, _ = message
+    if offset + chunk.nbytes > len(payload) or (offset + chunk.nbytes < len(payload) and chunk.nbytes != CHUNK_SIZE):
+      raise FramingError(f"Chunk {index} of message {message_id} has a wrong length")
+    payload[offset:offset + chunk.nbytes] = chunk
+    message[2:] = offset + chunk.nbytes, index + 1
+    if message[2] < len(payload): return None
+    del self.partial[message_id]
+    return type, decompress(memoryview(payload), flags, self.limit)
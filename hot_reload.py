@@ -0,0 +1,90 @@
+import os
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+from udata import UEntity, UMesh
+
+
+def _stamp(file : str) -> tuple[int, int] | None:
+  try:
+    stat = os.stat(file)
+    return stat.st_mtime_ns, stat.st_size
+  except FileNotFoundError: return None
+
+
+class FileWatcher:
+  """ Polls modification time and size of a set of files, cheap enough to run a few times a second """
+
+  def __init__(self, files : Iterable[str]):
+    self.stamps : dict[str, tuple[int, int] | None] = {}
+    self.watch(files)
+
+  def watch(self, files : Iterable[str]):
+    """ Replaces the watched files, files watched before keep their stamp so no change gets lost """
+    self.stamps = { file : self.stamps[file] if file in self.stamps else _stamp(file) for file in files }
+
+  def changed(self) -> list[str]:
+    changed = []
+    for file, stamp in self.stamps.items():
+      current = _stamp(file)
+      if current != stamp:
+        self.stamps[file] = current
+        changed.append(file)
+    return changed
+
+
+@dataclass
+class ItemDiff:
+  added : dict = field(default_factory=dict)
+  changed : dict = field(default_factory=dict)
+  removed : list[str] = field(default_factory=list)
+
+  def __len__(self) -> int:
+    return len(self.added) + len(self.changed) + len(self.removed)
+
+
+def diff_items(old : dict, new : dict, same : Callable = lambda a, b: a == b) -> ItemDiff:
+  return ItemDiff(
+    added={ name : item for name, item in new.items() if name not in old },
+    changed={ name : item for name, item in new.items() if name in old and not same(old[name], item) },
+    removed=[name for name in old if name not in new],
+  )
+
+
+@dataclass
+class EntityDiff:
+  """ What changed between two conversions of the same entity, links and joints compare by value and visuals by their
+  packaged form, which holds the content addresses of the meshes """
+  entity : str
+  startLink : str
+  links : ItemDiff
+  joints : ItemDiff
+  visuals : ItemDiff
+
+  def __bool__(self) -> bool:
+    return bool(self.links or self.joints or self.visuals)
+
+  def summary(self) -> str:
+    return f"{len(self.links)} links, {len(self.joints)} joints and {len(self.visuals)} visuals differ"
+
+  def package(self, geometries : dict[str, UMesh], level : int = 0, primitives : bool = False) -> dict:
+    return {
+      "entity" : self.entity,
+      "startLink" : self.startLink,
+      "links" : self.links,
+      "joints" : self.joints,
+      "visuals" : {
+        "added" : { name : visual.package(geometries, level, primitives=primitives) for name, visual in self.visuals.added.items() },
+        "changed" : { name : visual.package(geometries, level, primitives=primitives) for name, visual in self.visuals.changed.items() },
+        "removed" : self.visuals.removed,
+      }
+    }
+
+
+def diff_entities(old : UEntity, new : UEntity) -> EntityDiff:
+  return EntityDiff(
+    entity=new.name,
+    startLink=new.links[0].name,
+    links=diff_items({ link.name : link for link in old.links }, { link.name : link for link in new.links }),
+    joints=diff_items({ joint.name : joint for joint in old.joints }, { joint.name : joint for joint in new.joints }),
+    visuals=diff_items({ visual.name : visual for visual in old.visuals }, { visual.name : visual for visual in new.visuals }, lambda a, b: a.package({}) == b.package({})),
+  )
@@ -0,0 +1,110 @@
+import asyncio
+import struct
+from typing import Awaitable, Callable
+import numpy as np
+from metrics import metrics
+
+FLOAT32_MAX = float(np.finfo(np.float32).max) # larger positions turn into inf in the float32 frames
+
+
+class JointStateClient:
+  def __init__(self, send : Callable[[bytes], Awaitable[None]], sent : list[np.ndarray], name : str = ""):
+    self.send = send
+    self.name = name
+    self.sent = sent # positions per entity as of the last frame this client got
+    self.task : asyncio.Task = None
+
+
+class JointStatePublisher:
+  """ Publishes the joint positions of every served entity to the subscribed clients at a fixed rate.
+  A frame only holds the joints that moved more than epsilon since the last frame the client got. A client still busy
+  with its last frame skips ticks, its next frame then carries the newest state of everything that moved meanwhile.
+
+  Frame layout, little endian: uint32 tick (wraps around to 0 after 2**32 - 1), uint16 entity count and per entity uint16 entity index, uint16 joint count,
+  the uint16 joint indices followed by the float32 positions. Indices refer to layout() """
+
+  def __init__(self, rate : float, epsilon : float):
+    self.period = 1.0 / rate
+    self.epsilon = epsilon
+    self.entities : list[str] = []
+    self.joints : list[list[str]] = []
+    self.positions : list[np.ndarray] = []
+    self.clients : list[JointStateClient] = []
+    self.tick = 0
+
+  def add_entity(self, name : str, joints : list[str]):
+    self.entities.append(name)
+    self.joints.append(joints)
+    self.positions.append(np.zeros(len(joints), dtype=np.float32)) # the pose the entities are spawned in
+    for client in self.clients: client.sent.append(np.zeros(len(joints), dtype=np.float32))
+
+  def set_joints(self, entity : str, joints : list[str]):
+    """ Changes the joints of an entity, joints that remain keep their position. The clients need the new layout()
+    before the next frame """
+    index = self.entities.index(entity)
+    positions = dict(zip(self.joints[index], self.positions[index]))
+    self.joints[index] = joints
+    self.positions[index] = np.array([positions.get(joint, 0.0) for joint in joints], dtype=np.float32)
+    self.resend(entity)
+
+  def resend(self, entity : str):
+    """ The next frame holds every joint of the entity away from the spawn pose, e.g. after clients spawned it again """
+    index = self.entities.index(entity)
+    for client in self.clients: client.sent[index] = np.zeros(len(self.joints[index]), dtype=np.float32)
+
+  def set_positions(self, entity : str, positions : dict[str, float]):
+    """ Raises ValueError for an unknown entity or joint or a position that is no finite float32, nothing changes then """
+    if entity not in self.entities: raise ValueError(f"There is no entity {entity!r}")
+    if not isinstance(positions, dict): raise ValueError("positions has to map joint names to values")
+    index = self.entities.index(entity)
+    joints, current = self.joints[index], self.positions[index]
+    unknown = [repr(name) for name in positions if name not in joints]
+    if unknown: raise ValueError(f"{entity} has no movable joint {', '.join(unknown)}")
+    values = { joints.index(name) : value for name, value in positions.items() }
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) and abs(value) <= FLOAT32_MAX for value in values.values()): # nan compares false too
+      raise ValueError(f"The positions of {entity} have to be finite float32 numbers")
+    for joint, value in values.items(): current[joint] = value
+
+  def layout(self) -> list[dict]:
+    return [{ "entity" : name, "joints" : joints } for name, joints in zip(self.entities, self.joints)]
+
+  def subscribe(self, send : Callable[[bytes], Awaitable[None]], name : str = "") -> JointStateClient:
+    client = JointStateClient(send, [np.zeros_like(positions) for positions in self.positions], name)
+    self.clients.append(client)
+    return client
+
+  def unsubscribe(self, client : JointStateClient):
+    self.clients.remove(client)
+    if client.task is not None: client.task.cancel()
+
+  def frame(self, client : JointStateClient) -> bytes | None:
+    parts = []
+    for index, (current, sent) in enumerate(zip(self.positions, client.sent)):
+      changed = np.flatnonzero(np.abs(current - sent) > self.epsilon)
+      if len(changed) == 0: continue
+      sent[changed] = current[changed]
+      parts += [struct.pack("<HH", index, len(changed)), changed.astype("<u2").tobytes(), current[changed].astype("<f4").tobytes()]
+
+    if not parts: return None
+    return struct.pack("<IH", self.tick, len(parts) // 3) + b"".join(parts)
+
+  def publish(self):
+    for client in self.clients:
+      if client.task is not None and not client.task.done(): # still sending, coalesced into the next frame
+        metrics.count("update_frames_skipped", client=client.name)
+        continue
+      frame = self.frame(client)
+      if frame is not None:
+        client.task = asyncio.create_task(client.send(frame))
+        metrics.count("update_frames", client=client.name)
+    self.tick = (self.tick + 1) & 0xFFFFFFFF # the frame has 32 bits for it, compare ticks modulo 2**32
+
+  async def run(self):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time()
+    while True:
+      self.publish()
+      deadline += self.period
+      delay = deadline - loop.time()
+      if delay < -self.period: deadline = loop.time() # fell behind, skip the missed ticks instead of bursting
+      await asyncio.sleep(max(delay, 0.0))
@@ -0,0 +1,260 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+from parsers.urdf_parser import URDFData, URDFOrigin
+
+# joint type codes of a compiled model
+FIXED = 0
+REVOLUTE = 1   # continuous joints are revolute joints without limits
+PRISMATIC = 2
+
+_JOINT_TYPES = { "revolute" : REVOLUTE, "continuous" : REVOLUTE, "prismatic" : PRISMATIC } # floating and planar are not supported and stay fixed
+
+
+def origin_matrix(origin : URDFOrigin) -> np.ndarray:
+  """ 4x4 transform of an urdf origin, rpy are fixed axis rotations about x, y and z in that order """
+  matrix = np.eye(4)
+  if origin is None: return matrix
+
+  roll, pitch, yaw = origin.rotation
+  cr, sr = np.cos(roll), np.sin(roll)
+  cp, sp = np.cos(pitch), np.sin(pitch)
+  cy, sy = np.cos(yaw), np.sin(yaw)
+  matrix[:3, :3] = [
+    [cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr],
+    [sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr],
+    [-sp,     cp * sr,                cp * cr]
+  ]
+  matrix[:3, 3] = origin.position
+  return matrix
+
+
+def _follow_mimics(name : str, mimics : dict, dof_index : dict[str, int]) -> tuple[int, float, float]:
+  """ The configuration index of the joint that name follows through a chain of mimic joints, with the multiplier and
+  offset of the whole chain (a mimic of a mimic composes both) """
+  multiplier, offset, followed = 1.0, 0.0, [name]
+  while name in mimics:
+    mimic = mimics[name]
+    offset += multiplier * mimic.offset
+    multiplier *= mimic.mutiplier
+    name = mimic.joint
+    if name in followed: raise ValueError(f"The mimic joints {' -> '.join(followed + [name])} follow each other in a loop")
+    followed.append(name)
+  if name not in dof_index: raise ValueError(f"Joint {followed[0]} mimics {name}, which is no movable joint")
+  return dof_index[name], multiplier, offset
+
+
+class KinematicModel:
+  """ Kinematic tree of a URDFData compiled into flat numpy arrays. The joints are ordered parents first and grouped by
+  depth, so the poses of all links are computed with one batched matrix product per tree level """
+
+  def __init__(self, data : URDFData):
+    children = { joint.child for joint in data.joints }
+    roots = [link.name for link in data.links if link.name not in children]
+    assert len(roots) == 1, f"{data.name} needs exactly one root link, found {roots}"
+
+    by_parent : dict[str, list] = {}
+    for joint in data.joints: by_parent.setdefault(joint.parent, []).append(joint)
+
+    # breadth first, so every joint comes after the joint of its parent link
+    self.links : list[str] = [roots[0]]
+    link_depths = { roots[0] : 0 }
+    joints, depths = [], []
+    level = [roots[0]]
+    while level:
+      next_level = []
+      for link in level:
+        for joint in by_parent.get(link, []):
+          joints.append(joint)
+          depths.append(link_depths[link])
+          link_depths[joint.child] = link_depths[link] + 1
+          self.links.append(joint.child)
+          next_level.append(joint.child)
+      level = next_level
+
+    self.name = data.name
+    self.joints : list[str] = [joint.name for joint in joints]
+    self.link_index = { name : i for i, name in enumerate(self.links) }
+
+    # movable joints in document order make up the configuration vector
+    self.dof : list[str] = [joint.name for joint in data.joints if _JOINT_TYPES.get(joint.type) is not None and joint.mimic is None]
+    dof_index = { name : i for i, name in enumerate(self.dof) }
+    mimics = { joint.name : joint.mimic for joint in data.joints if joint.mimic is not None }
+
+    count = len(joints)
+    self.types = np.zeros(count, dtype=np.int8)
+    self.parents = np.zeros(count, dtype=np.int32)    # link index
+    self.children = np.zeros(count, dtype=np.int32)   # link index
+    self.origins = np.zeros((count, 4, 4))
+    self.axes = np.zeros((count, 3))
+    self.variables = np.zeros(count, dtype=np.int32)  # index into the configuration, mimic joints use the one of their joint
+    self.multipliers = np.zeros(count)
+    self.offsets = np.zeros(count)
+
+    for i, joint in enumerate(joints):
+      self.types[i] = _JOINT_TYPES.get(joint.type, FIXED)
+      self.parents[i] = self.link_index[joint.parent]
+      self.children[i] = i + 1
+      self.origins[i] = origin_matrix(joint.origin)
+
+      if self.types[i] == FIXED: continue
+      self.axes[i] = np.asarray(joint.axis) / np.linalg.norm(joint.axis)
+      self.variables[i], self.multipliers[i], self.offsets[i] = _follow_mimics(joint.name, mimics, dof_index)
+
+    depths = np.asarray(depths, dtype=np.int32)
+    self.levels = [np.flatnonzero(depths == depth) for depth in range(depths.max() + 1)] if count else []
+
+    # the joints between the root and every link, parents come first so a link extends the chain of its parent
+    self.chains = np.zeros((len(self.links), count), dtype=bool)
+    for i in range(count):
+      self.chains[self.children[i]] = self.chains[self.parents[i]]
+      self.chains[self.children[i], i] = True
+
+    # how fast every joint moves with every degree of freedom, a mimic joint adds to the column of its joint
+    self.coupling = np.zeros((count, len(self.dof)))
+    movable = np.flatnonzero(self.types != FIXED)
+    self.coupling[movable, self.variables[movable]] = self.multipliers[movable]
+
+    limits = { joint.name : joint.limit for joint in data.joints }
+    unlimited = lambda name: limits[name] is None or (limits[name].lower == 0.0 and limits[name].upper == 0.0)
+    self.lower = np.array([-np.inf if unlimited(name) else limits[name].lower for name in self.dof])
+    self.upper = np.array([np.inf if unlimited(name) else limits[name].upper for name in self.dof])
+
+  def joint_transforms(self, q : np.ndarray) -> np.ndarray:
+    """ (N, joints, 4, 4) transforms of every joint from its parent link to its child link """
+    count = len(q), len(self.joints)
+    values = q[:, self.variables] * self.multipliers + self.offsets if self.dof else np.zeros(count) # fixed joints have multiplier 0
+
+    motion = np.broadcast_to(np.eye(4), (*count, 4, 4)).copy()
+
+    revolute = self.types == REVOLUTE
+    if revolute.any(): # rodrigues formula for all revolute joints at once
+      axes = self.axes[revolute]
+      skew = np.zeros((len(axes), 3, 3))
+      skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = -axes[:, 2], axes[:, 1], -axes[:, 0]
+      skew -= skew.transpose(0, 2, 1)
+      angles = values[:, revolute, None, None]
+      motion[:, revolute, :3, :3] += np.sin(angles) * skew + (1 - np.cos(angles)) * (skew @ skew)
+
+    prismatic = self.types == PRISMATIC
+    if prismatic.any():
+      motion[..., :3, 3][:, prismatic] = values[:, prismatic, None] * self.axes[prismatic]
+
+    return self.origins @ motion
+
+  def forward(self, q : np.ndarray) -> np.ndarray:
+    """ World poses of all links (in the order of self.links) for a batch of configurations.
+    q has shape (N, dof) or (dof,), the result (N, links, 4, 4) or (links, 4, 4) """
+    q = np.asarray(q, dtype=np.float64)
+    single = q.ndim == 1
+    q = np.atleast_2d(q)
+    assert q.shape[1] == len(self.dof), f"{self.name} has {len(self.dof)} degrees of freedom, got {q.shape[1]}"
+
+    local = self.joint_transforms(q)
+    poses = np.empty((len(q), len(self.links), 4, 4))
+    poses[:, 0] = np.eye(4)
+    for level in self.levels: # every link of a level only depends on the levels before
+      poses[:, self.children[level]] = poses[:, self.parents[level]] @ local[:, level]
+
+    return poses[0] if single else poses
+
+  def jacobian(self, q : np.ndarray, link : str, poses : np.ndarray = None) -> np.ndarray:
+    """ Geometric jacobians of the origin of link in the base frame, rows are the linear then the angular velocity.
+    q has shape (N, dof) or (dof,), the result (N, 6, dof) or (6, dof). poses are forward(q) if already computed """
+    q = np.asarray(q, dtype=np.float64)
+    single = q.ndim == 1
+    poses = (self.forward(q) if poses is None else poses).reshape(-1, len(self.links), 4, 4)
+
+    # a joint turns its child link about (or moves it along) the axis, which the joint motion leaves where it is
+    chain = self.chains[self.link_index[link]]
+    frames = poses[:, self.children[chain]]
+    axes = np.einsum("njab,jb->nja", frames[..., :3, :3], self.axes[chain])
+    revolute = (self.types[chain] == REVOLUTE)[None, :, None]
+    linear = np.where(revolute, np.cross(axes, poses[:, self.link_index[link], None, :3, 3] - frames[..., :3, 3]), axes)
+    columns = np.concatenate([linear, np.where(revolute, axes, 0.0)], axis=2)
+
+    jacobian = np.einsum("njk,jd->nkd", columns, self.coupling[chain])
+    return jacobian[0] if single else jacobian
+
+  def inverse(self, link : str, positions : np.ndarray, rotations : np.ndarray = None, seeds : np.ndarray = None, iterations : int = 100,
+              damping : float = 0.05, max_step : float = 0.5, tolerance : float = 1e-4, rotation_tolerance : float = 1e-3) -> dict:
+    """ Damped least squares inverse kinematics of link for a batch of targets, every target is solved from several seeds
+    at once. positions (N, 3) are in the base frame, rotations (N, 3, 3) or None to only reach the positions, seeds
+    (N, S, dof) default to one random configuration each. A step moves no joint by more than max_step and ends within
+    the limits. A target is done once one of its seeds reaches it, of those the first one is taken, otherwise the seed
+    that got closest. Returns the configurations (N, dof), their position and rotation error and whether they converged """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    targets = len(positions)
+    seeds = self.sample(targets)[:, None] if seeds is None else np.asarray(seeds, dtype=np.float64).reshape(targets, -1, len(self.dof))
+    count = seeds.shape[1]
+    index = self.link_index[link]
+    rows = 3 if rotations is None else 6
+
+    q = self.clip(seeds.reshape(-1, len(self.dof)))
+    owners = np.repeat(np.arange(targets), count)
+    position_error, rotation_error = np.full(len(q), np.inf), np.zeros(len(q))
+    converged, solved = np.zeros(len(q), dtype=bool), np.zeros(targets, dtype=bool)
+    active = np.arange(len(q))
+
+    for iteration in range(iterations + 1):
+      poses = self.forward(q[active])
+      error = positions[owners[active]] - poses[:, index, :3, 3]
+      position_error[active] = np.linalg.norm(error, axis=1)
+      if rotations is not None: # the rotation from the current to the target orientation, as rotation vector
+        turn = Rotation.from_matrix(rotations[owners[active]] @ poses[:, index, :3, :3].transpose(0, 2, 1)).as_rotvec()
+        rotation_error[active] = np.linalg.norm(turn, axis=1)
+        error = np.concatenate([error, turn], axis=1)
+
+      converged[active] = (position_error[active] < tolerance) & (rotation_error[active] < rotation_tolerance)
+      solved[owners[active[converged[active]]]] = True
+      keep = ~converged[active] & ~solved[owners[active]]
+      active, poses, error = active[keep], poses[keep], error[keep]
+      if len(active) == 0 or iteration == iterations: break
+
+      jacobian = self.jacobian(q[active], link, poses)[:, :rows]
+      transposed = jacobian.transpose(0, 2, 1)
+      step = (transposed @ np.linalg.solve(jacobian @ transposed + damping**2 * np.eye(rows), error[..., None]))[..., 0]
+      step *= np.minimum(1.0, max_step / np.maximum(np.abs(step).max(axis=1, keepdims=True), 1e-12))
+      q[active] = self.clip(q[active] + step)
+
+    score = np.where(converged, 0.0, 1.0 + position_error + rotation_error).reshape(targets, count) # argmin takes the first converged seed
+    best = np.arange(targets) * count + score.argmin(axis=1)
+    return { "q" : q[best], "position_error" : position_error[best], "rotation_error" : rotation_error[best], "converged" : converged[best] }
+
+  def joint_positions(self, q : np.ndarray) -> dict[str, float]:
+    """ Position of every movable joint for one configuration, mimic joints follow their joint """
+    values = np.asarray(q, dtype=np.float64)[self.variables] * self.multipliers + self.offsets
+    return { name : float(value) for name, value, type in zip(self.joints, values, self.types) if type != FIXED }
+
+  def sample(self, count : int, random : np.random.Generator = None) -> np.ndarray:
+    """ count configurations uniformly within the limits, joints without limits within a turn """
+    random = np.random.default_rng() if random is None else random
+    lower, upper = np.where(np.isinf(self.lower), -np.pi, self.lower), np.where(np.isinf(self.upper), np.pi, self.upper)
+    return random.uniform(lower, upper, (count, len(self.dof)))
+
+  def seeds(self, q : np.ndarray, targets : int, count : int, random : np.random.Generator = None) -> np.ndarray:
+    """ (targets, count, dof) seeds for inverse, every target starts from q and count - 1 random configurations """
+    seeds = np.empty((targets, count, len(self.dof)))
+    seeds[:, 0] = q
+    seeds[:, 1:] = self.sample(targets * (count - 1), random).reshape(targets, count - 1, len(self.dof))
+    return seeds
+
+  def clip(self, q : np.ndarray) -> np.ndarray:
+    return np.clip(q, self.lower, self.upper)
+
+  def __repr__(self) -> str:
+    return f"<KinematicModel {self.name} with {len(self.links)} links and {len(self.dof)} degrees of freedom>"
+
+
+if __name__ == "__main__":
+  import time
+  model = KinematicModel(URDFData.from_file("res/models/pybullet/robots/panda_arm_hand.urdf"))
+  print(model)
+  q = model.clip(np.random.uniform(-np.pi, np.pi, (10000, len(model.dof))))
+  start = time.monotonic()
+  poses = model.forward(q)
+  print(f"{len(q)} configurations took {time.monotonic() - start:.3f} sec")
+
+  hand = poses[:100, model.link_index["panda_hand"]]
+  start = time.monotonic()
+  result = model.inverse("panda_hand", hand[:, :3, 3], hand[:, :3, :3], model.sample(800).reshape(100, 8, -1))
+  print(f"ik of 100 poses from 8 seeds each took {time.monotonic() - start:.3f} sec, {result['converged'].mean():.0%} converged")
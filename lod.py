@@ -0,0 +1,75 @@
+import numpy as np
+from udata import UMesh
+
+MIN_TRIANGLES = 64 # meshes this small are never decimated
+SEARCH_STEPS = 8
+
+
+def _cluster(vertices : np.ndarray, normals : np.ndarray, faces : np.ndarray, cell : float, uvs : np.ndarray = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+  """ Merges all vertices within one grid cell of size cell into their mean, faces that collapse are dropped. The uvs
+  are averaged too, across a seam of the texture this smears it a little, which the coarse levels get away with """
+  cells = np.floor((vertices - vertices.min(axis=0)) / cell).astype(np.int64)
+  dims = cells.max(axis=0) + 1
+  _, labels = np.unique(cells[:, 0] + dims[0] * (cells[:, 1] + dims[1] * cells[:, 2]), return_inverse=True)
+  labels = labels.ravel()
+
+  faces = labels[faces]
+  faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+  _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True) # the same triangle can appear several times
+  faces = faces[np.sort(first)]
+  if len(faces) == 0: return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.float32), faces, None if uvs is None else np.zeros((0, 2), dtype=np.float32)
+
+  used, faces = np.unique(faces, return_inverse=True) # clusters no face refers to anymore are dropped
+  faces = faces.reshape(-1, 3)
+  position = np.searchsorted(used, labels) # new index of the cluster of every vertex
+  keep = position < len(used)
+  keep[keep] = used[position[keep]] == labels[keep]
+  position = position[keep]
+
+  sizes = np.bincount(position, minlength=len(used))
+  merged_vertices = np.stack([np.bincount(position, weights=vertices[keep, axis], minlength=len(used)) for axis in range(3)], axis=1) / sizes[:, None]
+  merged_normals = np.stack([np.bincount(position, weights=normals[keep, axis], minlength=len(used)) for axis in range(3)], axis=1)
+  merged_normals /= np.maximum(np.linalg.norm(merged_normals, axis=1, keepdims=True), 1e-12)
+  if uvs is not None: uvs = (np.stack([np.bincount(position, weights=uvs[keep, axis], minlength=len(used)) for axis in range(2)], axis=1) / sizes[:, None]).astype(np.float32)
+
+  return merged_vertices.astype(np.float32), merged_normals.astype(np.float32), faces, uvs
+
+
+def decimate(mesh : UMesh, triangles : int) -> UMesh:
+  """ Vertex clustering decimation of mesh to at most triangles triangles, the cell size is found by bisection """
+  faces = mesh.indices.reshape(-1, 3)
+  if len(faces) <= max(triangles, MIN_TRIANGLES): return mesh
+
+  low, high = 0.0, float(np.linalg.norm(np.ptp(mesh.vertices, axis=0)))
+  best = None
+  for _ in range(SEARCH_STEPS):
+    cell = (low + high) / 2
+    result = _cluster(mesh.vertices, mesh.normals, faces, cell, mesh.uvs)
+    if len(result[2]) > triangles: low = cell
+    else: high, best = cell, result
+
+  if best is None: best = _cluster(mesh.vertices, mesh.normals, faces, high, mesh.uvs)
+  vertices, normals, faces, uvs = best
+
+  return UMesh(
+    name=mesh.name,
+    position=mesh.position,
+    rotation=mesh.rotation,
+    scale=mesh.scale,
+    indices=faces.ravel(),
+    vertices=vertices,
+    normals=normals,
+    uvs=uvs,
+    material=mesh.material,
+    image=mesh.image
+  )
+
+
+def build_lods(mesh : UMesh, ratios : tuple[float, ...]) -> list[UMesh]:
+  """ Coarser versions of mesh, one per ratio of its triangle count. Levels that would not be smaller share the arrays
+  of the previous level and with that its geometry """
+  lods, previous = [], mesh
+  for ratio in ratios:
+    previous = decimate(previous, int(len(mesh.indices) // 3 * ratio))
+    lods.append(previous)
+  return lods
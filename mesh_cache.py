@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import numpy as np
+from udata import UMaterial, UMesh
+
+
+class MeshCache:
+  """ On disk cache of converted meshes and encoded textures. Entries are keyed by the content of the source file (or
+  texture) together with the conversion parameters, so a changed file simply misses and its stale entry is evicted once
+  the cache is full """
+
+  VERSION = 3 # bump when the file layout changes
+
+  def __init__(self, folder : str, max_bytes : int):
+    self.folder = folder
+    self.max_bytes = max_bytes
+    os.makedirs(folder, exist_ok=True)
+
+  def key(self, file : str | None, params : dict, dependencies : list[str] = ()) -> str:
+    """ Without a file the params alone are the key, e.g. the content address of a texture and the size it is encoded at.
+    The content of the dependencies counts too, e.g. the materials and images of an obj, a missing one by its absence """
+    digest = hashlib.sha256(json.dumps([MeshCache.VERSION, params, [os.path.basename(dependency) for dependency in dependencies]], sort_keys=True).encode())
+    if file is None: return digest.hexdigest()
+    for path in [file, *dependencies]:
+      try:
+        with open(path, "rb") as fp:
+          for block in iter(lambda: fp.read(2**20), b""): digest.update(block)
+      except FileNotFoundError:
+        if path == file: raise
+        digest.update(b"missing")
+    return digest.hexdigest()
+
+  def _path(self, key : str) -> str:
+    return os.path.join(self.folder, key + ".npz")
+
+  def load(self, key : str) -> list[UMesh] | None:
+    path = self._path(key)
+    try:
+      with np.load(path, allow_pickle=False) as entry:
+        meta = json.loads(str(entry["meta"]))
+        meshes = []
+        for i, item in enumerate(meta):
+          material = UMaterial(**item["material"]) if item["material"] is not None else None
+          mesh_at = lambda suffix: UMesh(
+            name=item["name"],
+            position=item["position"],
+            rotation=item["rotation"],
+            scale=item["scale"],
+            indices=entry[f"indices_{suffix}"],
+            vertices=entry[f"vertices_{suffix}"],
+            normals=entry[f"normals_{suffix}"],
+            uvs=entry[f"uvs_{suffix}"] if item["uvs"] else None,
+            material=material,
+            image=entry[f"image_{material.texture}"] if material is not None and material.texture is not None else None
+          )
+          mesh = mesh_at(i)
+          mesh.lods = [mesh_at(f"{i}_{level}") for level in range(item["lods"])]
+          meshes.append(mesh)
+    except (OSError, KeyError, ValueError): return None # missing or unreadable entries are treated as a miss
+
+    os.utime(path) # the modification time orders the entries for eviction
+    return meshes
+
+  def store(self, key : str, meshes : list[UMesh]):
+    meta = [{
+      "name" : mesh.name,
+      "position" : mesh.position,
+      "rotation" : mesh.rotation,
+      "scale" : mesh.scale,
+      "material" : vars(mesh.material) if mesh.material is not None else None,
+      "uvs" : mesh.uvs is not None,
+      "lods" : len(mesh.lods)
+    } for mesh in meshes]
+
+    arrays = {}
+    for i, mesh in enumerate(meshes):
+      if mesh.image is not None: arrays[f"image_{mesh.material.texture}"] = mesh.image # once per texture
+      for suffix, level in [(i, mesh)] + [(f"{i}_{l}", lod) for l, lod in enumerate(mesh.lods)]:
+        arrays[f"indices_{suffix}"] = level.indices
+        arrays[f"vertices_{suffix}"] = level.vertices
+        arrays[f"normals_{suffix}"] = level.normals
+        if level.uvs is not None: arrays[f"uvs_{suffix}"] = level.uvs
+
+    self._write(key, meta, arrays)
+
+  def load_blob(self, key : str) -> tuple[dict, bytes] | None:
+    """ The meta data and the bytes stored under key, e.g. an encoded texture """
+    path = self._path(key)
+    try:
+      with np.load(path, allow_pickle=False) as entry: meta, data = json.loads(str(entry["meta"])), entry["data"].tobytes()
+    except (OSError, KeyError, ValueError): return None
+    os.utime(path)
+    return meta, data
+
+  def store_blob(self, key : str, meta : dict, data : bytes):
+    self._write(key, meta, { "data" : np.frombuffer(data, dtype=np.uint8) })
+
+  def _write(self, key : str, meta, arrays : dict[str, np.ndarray]):
+    path = self._path(key)
+    temp = f"{path}.{os.getpid()}.tmp" # write and rename, so readers never see half written entries
+    with open(temp, "wb") as fp: np.savez(fp, meta=json.dumps(meta), **arrays)
+    os.replace(temp, path)
+
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for entry in os.scandir(self.folder):
+      if not entry.name.endswith(".npz"): continue
+      try: stat = entry.stat()
+      except FileNotFoundError: continue # removed by another process
+      entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries): # least recently used first
+      if size <= self.max_bytes: break
+      try: os.remove(path)
+      except FileNotFoundError: pass
+      size -= entry_size
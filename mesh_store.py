@@ -0,0 +1,69 @@
+import mmap
+import tempfile
+import threading
+from dataclasses import replace
+import numpy as np
+from udata import UMesh
+
+ALIGNMENT = 64 # every array starts at a cache line
+MIN_PAYLOAD = 2**16 # smaller payloads stay on the heap, every payload takes a mapping of its own
+
+
+class MeshStore:
+  """ Converted meshes moved out of the heap into one append only file that is memory mapped. Every geometry is
+  written once, the index maps its id (the content address of the arrays) to its indices (uint32), vertices, normals
+  and uvs (float32) as read only views of the mapping, they go to the socket without a copy. The pixels of every
+  texture are written once as well. Encoded payloads (the json messages) can be kept there too. Without a path the file
+  is an anonymous temporary file """
+
+  def __init__(self, path : str = None):
+    self.file = open(path, "w+b") if path is not None else tempfile.TemporaryFile()
+    self.size = 0
+    self.index : dict[str, tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray | None]] = {}
+    self.images : dict[str, np.ndarray] = {} # by texture key
+    self.maps : list[mmap.mmap] = [] # one per append, a mapping starts at a page and the ones before cannot grow while views of them exist
+    self.lock = threading.Lock() # meshes and messages are stored from executor threads, every append moves the end of the file
+
+  def _append(self, arrays : list[np.ndarray]) -> list[np.ndarray]:
+    start = self.size + -self.size % mmap.ALLOCATIONGRANULARITY
+    self.file.seek(start)
+    offsets = []
+    for array in arrays:
+      self.file.write(bytes(-self.file.tell() % ALIGNMENT))
+      offsets.append(self.file.tell() - start)
+      self.file.write(memoryview(array).cast("B"))
+    self.file.flush()
+    if self.file.tell() == start: return arrays # nothing but empty arrays
+
+    self.size = self.file.tell()
+    segment = mmap.mmap(self.file.fileno(), self.size - start, access=mmap.ACCESS_READ, offset=start)
+    self.maps.append(segment)
+    return [np.frombuffer(segment, array.dtype, array.size, offset).reshape(array.shape) for array, offset in zip(arrays, offsets)]
+
+  def store(self, meshes : list[UMesh]) -> list[UMesh]:
+    """ Copies of meshes and their levels of detail whose arrays live in the file """
+    with self.lock: return self._store(meshes)
+
+  def _store(self, meshes : list[UMesh]) -> list[UMesh]:
+    levels = { level.geometry : level for mesh in meshes for level in [mesh, *mesh.lods] if level.geometry not in self.index }
+    images = { mesh.material.texture : mesh.image for mesh in meshes if mesh.image is not None and mesh.material.texture not in self.images }
+    arrays = [[(level.indices, np.uint32), (level.vertices, np.float32), (level.normals, np.float32)] + ([(level.uvs, np.float32)] if level.uvs is not None else []) for level in levels.values()]
+    views = iter(self._append([np.ascontiguousarray(array, dtype) for level in arrays for array, dtype in level] + list(images.values())))
+    for geometry, level in zip(levels, arrays): self.index[geometry] = tuple(next(views) for _ in level) + ((None,) if len(level) == 3 else ())
+    self.images.update(zip(images, views))
+
+    copies : dict[int, UMesh] = {} # a level that would not be smaller is the mesh itself
+    def copy(level : UMesh) -> UMesh:
+      if id(level) not in copies:
+        indices, vertices, normals, uvs = self.index[level.geometry]
+        image = self.images[level.material.texture] if level.image is not None else None
+        copies[id(level)] = replace(level, indices=indices, vertices=vertices, normals=normals, uvs=uvs, image=image, lods=[]) # keeps the geometry, nothing is hashed again
+      return copies[id(level)]
+
+    stored = [copy(mesh) for mesh in meshes]
+    for mesh, copied in zip(meshes, stored): copied.lods = [copy(lod) for lod in mesh.lods]
+    return stored
+
+  def payload(self, data : bytes) -> bytes | memoryview:
+    if len(data) < MIN_PAYLOAD: return data
+    with self.lock: return memoryview(self._append([np.frombuffer(data, dtype=np.uint8)])[0])
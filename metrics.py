@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from print_color import print as cprint
+
+
+class _Timer:
+  __slots__ = ("metrics", "key", "start")
+
+  def __init__(self, metrics : "Metrics", key : tuple):
+    self.metrics = metrics
+    self.key = key
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.metrics.observe(self.key, time.perf_counter() - self.start)
+    return False
+
+
+class _NullTimer:
+  __slots__ = ()
+  def __enter__(self): return self
+  def __exit__(self, *exc): return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+  """ Stage timers, counters and gauges of the compile and serve pipeline. Disabled (the default) every call returns
+  right away, timer() hands out one shared no-op context.
+  Labels tell series apart (e.g. client). The item label is the per mesh file / per link breakdown and is only kept
+  with breakdown enabled. Work done in mesh worker processes is only seen as the time the parent waited for it """
+
+  def __init__(self):
+    self.enabled = False
+    self.breakdown = False
+    self.sinks : list = []
+    self.counters : dict[tuple, float] = {}
+    self.gauges : dict[tuple, float] = {}
+    self.timers : dict[tuple, list[float]] = {} # count, total and max seconds
+    self.lock = threading.Lock() # meshes are converted on executor threads too
+
+  def configure(self, sinks : list[str], breakdown : bool = False):
+    self.sinks = [make_sink(spec) for spec in sinks]
+    self.enabled = bool(self.sinks)
+    self.breakdown = breakdown
+
+  def _key(self, name : str, item : str, labels : dict) -> tuple:
+    if item is not None and self.breakdown: labels["item"] = item
+    return (name, tuple(sorted(labels.items())))
+
+  def timer(self, name : str, item : str = None, **labels):
+    if not self.enabled: return _NULL_TIMER
+    return _Timer(self, self._key(name, item, labels))
+
+  def observe(self, key : tuple, seconds : float):
+    with self.lock:
+      stats = self.timers.get(key)
+      if stats is None: self.timers[key] = [1, seconds, seconds]
+      else:
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+  def count(self, name : str, value : float = 1, item : str = None, **labels):
+    if not self.enabled: return
+    key = self._key(name, item, labels)
+    with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+  def gauge(self, name : str, value : float, add : bool = False, **labels):
+    if not self.enabled: return
+    key = self._key(name, None, labels)
+    with self.lock: self.gauges[key] = self.gauges.get(key, 0) + value if add else value
+
+  def forget(self, **labels):
+    """ Drops every series with these labels, e.g. those of a client once it disconnected """
+    if not self.enabled: return
+    with self.lock:
+      for series in (self.counters, self.gauges, self.timers):
+        for key in [key for key in series if all(label in key[1] for label in labels.items())]: del series[key]
+
+  def snapshot(self) -> dict:
+    with self.lock:
+      return {
+        "time" : time.time(),
+        "counters" : [{ "name" : name, "labels" : dict(labels), "value" : value } for (name, labels), value in self.counters.items()],
+        "gauges" : [{ "name" : name, "labels" : dict(labels), "value" : value } for (name, labels), value in self.gauges.items()],
+        "timers" : [{ "name" : name, "labels" : dict(labels), "count" : count, "total" : total, "max" : peak } for (name, labels), (count, total, peak) in self.timers.items()],
+      }
+
+  def flush(self):
+    if not self.enabled: return
+    snapshot = self.snapshot()
+    for sink in self.sinks: sink.write(snapshot)
+
+  async def run(self, interval : float):
+    """ Starts the sinks that serve themselves and flushes the others every interval seconds """
+    if not self.enabled: return
+    for sink in self.sinks: await sink.start(self)
+    while True:
+      await asyncio.sleep(interval)
+      self.flush()
+
+
+def _labels(labels : dict) -> str:
+  return ",".join(f"{key}={value}" for key, value in labels.items())
+
+
+class LogSink:
+  def write(self, snapshot : dict):
+    for timer in snapshot["timers"]:
+      cprint(f"{timer['name']}[{_labels(timer['labels'])}] {timer['count']}x {timer['total']:.4f}s total {timer['max']:.4f}s max", tag="METRICS", tag_color="magenta", color="white")
+    for kind in ("counters", "gauges"):
+      for metric in snapshot[kind]:
+        cprint(f"{metric['name']}[{_labels(metric['labels'])}] {metric['value']:g}", tag="METRICS", tag_color="magenta", color="white")
+
+  async def start(self, metrics : Metrics): pass
+
+
+class JsonFileSink:
+  def __init__(self, path : str):
+    self.path = path
+
+  def write(self, snapshot : dict):
+    temp = self.path + ".tmp" # readers never see a half written file
+    with open(temp, "w") as fp: json.dump(snapshot, fp, indent=2)
+    os.replace(temp, self.path)
+
+  async def start(self, metrics : Metrics): pass
+
+
+class PrometheusSink:
+  """ Serves the current metrics in the prometheus text format on http://localhost:port/metrics """
+
+  PREFIX = "urdf_"
+
+  def __init__(self, port : int, host : str = "localhost"):
+    self.port = port
+    self.host = host
+    self.metrics : Metrics = None
+
+  def write(self, snapshot : dict): pass # scraped, not pushed
+
+  async def start(self, metrics : Metrics):
+    self.metrics = metrics
+    await asyncio.start_server(self.handle, self.host, self.port)
+
+  async def handle(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+    try:
+      await reader.readuntil(b"\r\n\r\n") # only GET requests are expected, the path is ignored
+      body = self.render(self.metrics.snapshot()).encode()
+      writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+      await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError): pass
+    finally:
+      writer.close()
+
+  def render(self, snapshot : dict) -> str:
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def series(name : str, labels : dict, value : float) -> str:
+      text = ",".join(f'{key}="{escape(label)}"' for key, label in labels.items())
+      return f"{self.PREFIX}{name}{{{text}}} {value}" if text else f"{self.PREFIX}{name} {value}"
+
+    lines = []
+    for counter in snapshot["counters"]: lines.append(series(counter["name"] + "_total", counter["labels"], counter["value"]))
+    for gauge in snapshot["gauges"]: lines.append(series(gauge["name"], gauge["labels"], gauge["value"]))
+    for timer in snapshot["timers"]:
+      lines.append(series(timer["name"] + "_seconds_count", timer["labels"], timer["count"]))
+      lines.append(series(timer["name"] + "_seconds_sum", timer["labels"], timer["total"]))
+      lines.append(series(timer["name"] + "_seconds_max", timer["labels"], timer["max"]))
+    return "\n".join(lines) + "\n"
+
+
+def make_sink(spec : str):
+  """ "log", "json:<path>" or "prometheus:<port>" """
+  kind, _, argument = spec.partition(":")
+  if kind == "log": return LogSink()
+  if kind == "json": return JsonFileSink(argument)
+  if kind == "prometheus": return PrometheusSink(int(argument))
+  raise ValueError(f"Unknown metrics sink {spec}")
+
+
+metrics = Metrics() # the one instance the pipeline reports to
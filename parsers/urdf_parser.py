@@ -1,7 +1,8 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
 from typing import Any, Dict, List, Optional, Self, Tuple, TypeVar
 import xml.etree.ElementTree as ET
+from parsers.xacro_parser import read_xacro
 
 ####### Shared properties #######
 
@@ -143,7 +144,7 @@ class URDFGeometry:
       _load_attrib(child, "length", 1.0) if viztype == "cylinder" else None,
       _load_attrib(child, "radius", 1.0) if viztype in { "sphere", "cylinder" } else None,
       _load_attrib(child, "filename", "") if viztype == "mesh" else None,
-      _load_attrib_array(child, "scales", [1.0, 1.0, 1.0])  if viztype == "mesh" else None,
+      _load_attrib_array(child, "scale", [1.0, 1.0, 1.0])  if viztype == "mesh" else None,
     )
   
   def __repr__(self) -> str:
@@ -155,15 +156,15 @@ class URDFGeometry:
 
 @dataclass
 class URDFMaterial:
-  color : List[float]
-  fileName : str
+  color : List[float]   # rgba, None without a <color> (a reference to a material of the robot)
+  fileName : str        # texture (relative to the parsed file), empty without one
   
   @notnone
   @staticmethod
   def parse( node : XMLNode):
     return URDFMaterial(
-      _load_attrib_array(node, "color", [0.0, 0.0, 0.0]),
-      _load_attrib(node, "filename", "")
+      _load_attrib_array(node.find("color"), "rgba", [0.0, 0.0, 0.0, 1.0]) if node.find("color") is not None else None,
+      _load_attrib(node.find("texture"), "filename", "")
     )
 
 
@@ -180,7 +181,7 @@ class URDFVisual:
     geometry = URDFGeometry.parse(node.find("geometry"))
     origin = URDFOrigin.parse(node.find("origin"))
     assert geometry is not None, "<geometry> is a required field in the field <visual>"
-    name = _load_attrib(node, "name", os.path.basename(geometry.fileName).split(".")[0] + "_" + geometry.type + str(hash(origin))) # TODO this is not unique
+    name = _load_attrib(node, "name", (os.path.basename(geometry.fileName).split(".")[0] + "_" if geometry.fileName else "") + geometry.type + str(hash(origin))) # TODO this is not unique
 
     return URDFVisual(
       name,
@@ -219,7 +220,7 @@ class URDFLink: # DOC: https://wiki.ros.org/urdf/XML/link
   mass : float
   inertia : Dict[str, float]
   visual : URDFVisual
-  collision : URDFCollision
+  collisions : List[URDFCollision]
 
   @notnone
   @staticmethod
@@ -231,7 +232,7 @@ class URDFLink: # DOC: https://wiki.ros.org/urdf/XML/link
       _load_attrib(inertial, "mass", 0.0) if inertial is not None else None,
       { name : float(value) for name, value in inertial.attrib.items() } if inertial is not None else None,  # yeah dont care 
       URDFVisual.parse(node.find("visual")),
-      URDFCollision.parse(node.find("collsion"))
+      [URDFCollision.parse(collision) for collision in node.findall("collision")]
     )
   
   
@@ -282,11 +283,12 @@ class URDFData: # http://wiki.ros.org/urdf/XML/model
   name : str
   joints : List[URDFJoint]
   links : List[URDFLink]
+  includes : List[str] = field(default_factory=list) # files a xacro read besides itself, included xacros and yaml files
   
   @staticmethod
-  def parse(data : str, opt_name : Optional[str]= None) -> Optional[Self]:
+  def parse(data : str | XMLNode, opt_name : Optional[str]= None) -> Optional[Self]:
 
-    robot = ET.XML(data)
+    robot = ET.XML(data) if isinstance(data, str) else data
 
     if not robot: return None
     
@@ -299,8 +301,15 @@ class URDFData: # http://wiki.ros.org/urdf/XML/model
     )  
   
   @staticmethod 
-  def from_file(file_path : str) -> Optional[Self]:
-    with open(file_path, "r") as fp: return URDFData.parse(fp.read(), opt_name=os.path.basename(file_path).split(".")[0]) # if no name specified infere it from the file name
+  def from_file(file_path : str, args : Optional[Dict[str, str]] = None) -> Optional[Self]:
+    """ Parses an urdf or expands a .xacro file with args (the xacro args) first """
+    name = os.path.basename(file_path).split(".")[0] # if no name specified infere it from the file name
+    if file_path.endswith(".xacro"):
+      robot, sources = read_xacro(file_path, args)
+      data = URDFData.parse(robot, opt_name=name)
+      if data is not None: data.includes = sources[1:]
+      return data
+    with open(file_path, "r") as fp: return URDFData.parse(fp.read(), opt_name=name)
 
   def __repr__(self) -> str:
     return f"<URDFData {self.name}, with {len(self.joints)} joints and {len(self.links)} links>"
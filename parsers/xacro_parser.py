@@ -0,0 +1,428 @@
+import builtins
+import copy
+import math
+import os
+import re
+import shlex
+import threading
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Any, Optional
+
+# DOC: http://wiki.ros.org/xacro
+
+_TOKENS = re.compile(r"\$\$(?=[{(])|\$\{([^}]*)\}|\$\(([^)]*)\)") # escaped $, ${expression} and $(extension)
+_EXTENSIONS = re.compile(r"\$\(([^)]*)\)")
+_MISSING = object()
+
+
+class XacroError(Exception):
+  pass
+
+
+@lru_cache(maxsize=None)
+def find_package(name : str, start : str) -> Optional[str]:
+  """ Folder of the ros package name, searched in the folders above start (a package is a folder with a package.xml)
+  so no ros install is needed as long as the package lies next to or above the file using it """
+  folder = os.path.abspath(start)
+  while True:
+    for candidate in (folder, os.path.join(folder, name)):
+      if os.path.basename(candidate) == name and os.path.isfile(os.path.join(candidate, "package.xml")): return candidate
+    parent = os.path.dirname(folder)
+    if parent == folder: return None
+    folder = parent
+
+
+class _YamlDict(dict):
+  """ yaml mappings allow attribute access in expressions, e.g. ${inertial.origin.xyz} """
+  def __getattr__(self, name : str):
+    try: return self[name]
+    except KeyError: raise AttributeError(name) from None
+
+
+def _yaml_value(value):
+  if isinstance(value, dict): return _YamlDict({ key : _yaml_value(item) for key, item in value.items() })
+  if isinstance(value, list): return [_yaml_value(item) for item in value]
+  return value
+
+
+def _literal(value : Any) -> Any:
+  """ Text of properties and parameters is a number or boolean if it reads like one, as in xacro """
+  if not isinstance(value, str): return value
+  if len(value) >= 2 and value[0] == value[-1] == "'": return value[1:-1]
+  if "_" in value: return value # python would drop the underscores of number literals
+  for parse in (int, float):
+    try: return parse(value)
+    except ValueError: pass
+  return { "true" : True, "false" : False }.get(value.lower(), value)
+
+
+def _boolean(value : Any) -> bool:
+  if isinstance(value, (bool, int, float)): return bool(value)
+  value = str(value).strip().lower()
+  if value in ("true", "1"): return True
+  if value in ("false", "0"): return False
+  raise XacroError(f"{value} is not a boolean")
+
+
+def _string(value : Any) -> str:
+  return "" if value is None else str(value)
+
+
+def _freeze(value : Any) -> Any:
+  """ Comparable form of a symbol value, blocks and macros compare by the source elements they stand for """
+  if isinstance(value, dict): return tuple((key, _freeze(item)) for key, item in value.items())
+  if isinstance(value, (list, tuple)): return tuple(_freeze(item) for item in value)
+  if isinstance(value, (_Block, _Macro)): return value.key
+  return value
+
+
+def _xacro_tag(tag : str) -> Optional[str]:
+  if not tag.startswith("{"): return None
+  namespace, _, name = tag[1:].partition("}")
+  return name if namespace.rstrip("/").endswith("xacro") else None
+
+
+def _params(text : str) -> list[tuple[str, str, Optional[str]]]:
+  """ Macro parameters as (name, block prefix "", "*" or "**", default or None) from e.g. "name prefix:=${id}_ **body" """
+  params = []
+  for token in shlex.split(text):
+    stars = len(token) - len(token.lstrip("*"))
+    match = re.match(r"([^:=]+)(:?=)?(.*)", token[stars:])
+    params.append((match.group(1), "*" * stars, match.group(3) if match.group(2) else None))
+  return params
+
+
+def _assemble(element : ET.Element, items : list) -> ET.Element:
+  """ Attaches the expanded items, text between child elements goes to the tail of a copy so shared (memoized) elements
+  stay untouched. Whitespace only text is dropped """
+  for item in items:
+    if isinstance(item, str):
+      if not item.strip(): continue
+      if len(element): element[-1] = copy.copy(element[-1]); element[-1].tail = (element[-1].tail or "") + item
+      else: element.text = (element.text or "") + item
+    else: element.append(item)
+  return element
+
+
+class _Block:
+  __slots__ = ("elements", "key")
+  def __init__(self, elements : list[ET.Element]):
+    self.elements = elements
+    self.key = ("block", tuple(elements))
+
+
+class _Macro:
+  __slots__ = ("name", "params", "body", "key")
+  def __init__(self, name : str, params : list, body : ET.Element):
+    self.name = name
+    self.params = params
+    self.body = body
+    self.key = ("macro", body)
+
+
+class _Lazy:
+  __slots__ = ("text",)
+  def __init__(self, text : str):
+    self.text = text
+
+
+class _Scope:
+  __slots__ = ("parent", "depth", "symbols", "macros")
+  def __init__(self, parent : "_Scope" = None):
+    self.parent = parent
+    self.depth = parent.depth + 1 if parent is not None else 0
+    self.symbols : dict[str, Any] = {}
+    self.macros : dict[str, _Macro] = {}
+
+
+class _Frame:
+  """ A macro expansion in progress, collects what it read from outside its own scope and the files it read """
+  __slots__ = ("depth", "reads", "files", "pure")
+  def __init__(self, depth : int):
+    self.depth = depth
+    self.reads : dict[tuple[str, str], Any] = {}
+    self.files : list[str] = []
+    self.pure = True
+
+
+class _Symbols:
+  """ The scope chain as the locals of an evaluated expression """
+  __slots__ = ("processor", "scope")
+  def __init__(self, processor : "XacroProcessor", scope : _Scope):
+    self.processor = processor
+    self.scope = scope
+
+  def __getitem__(self, name : str):
+    value = self.processor.lookup(self.scope, name)
+    if value is _MISSING: raise KeyError(name)
+    return value
+
+
+class XacroProcessor:
+  """ Expands xacro files to urdf in process: properties, args, macros (with block parameters), includes and
+  conditionals. Parsed files and yaml files are kept until they change on disk. A macro expansion is memoized with its
+  parameters and the outside symbols it read, a later call with the same parameters reuses it as long as those symbols
+  still have the same values, so expanding many variants of a robot only pays for what differs between them """
+
+  def __init__(self, packages : dict[str, str] = None):
+    self.packages = dict(packages or {}) # package folders, found next to the files if missing
+    self.args : dict[str, str] = {}
+    self.hits = 0
+    self.misses = 0
+    self.sources : list[str] = [] # files the last expansion read, the xacro file first, then the included and yaml files
+    self._files : dict[str, tuple[int, ET.Element]] = {}
+    self._yaml : dict[str, tuple[int, Any]] = {}
+    self._code : dict[str, Any] = {}
+    self._expansions : dict[tuple, list[tuple[dict, list, list[str]]]] = {}
+    self._frames : list[_Frame] = []
+    self._stack : list[str] = [] # files being expanded, innermost last
+    self._globals = {
+      "__builtins__" : { name : getattr(builtins, name) for name in ("abs", "all", "any", "bool", "dict", "float", "int", "len", "list", "max", "min", "pow", "range", "round", "sorted", "str", "sum", "tuple", "zip") },
+      **{ name : getattr(math, name) for name in ("pi", "e", "inf", "nan", "sin", "cos", "tan", "asin", "acos", "atan", "atan2", "sqrt", "exp", "log", "floor", "ceil", "fabs", "radians", "degrees", "hypot") },
+      "xacro" : SimpleNamespace(load_yaml=self.load_yaml, warning=lambda *values: print("xacro warning:", *values), message=lambda *values: print(*values), abs_filename=self.abs_filename),
+    }
+
+  def expand(self, file : str, args : dict[str, str] = None) -> ET.Element:
+    """ The expanded robot element, args are the xacro args (as given with name:=value on the command line) """
+    self.args = { name : str(value) for name, value in (args or {}).items() }
+    self._frames, self._stack, self.sources = [], [os.path.abspath(file)], []
+    source = self._parse(self._stack[0])
+    scope = _Scope()
+    return _assemble(ET.Element(source.tag, { key : self._text(value, scope) for key, value in source.attrib.items() }), self._children(source, scope))
+
+  def to_urdf(self, file : str, args : dict[str, str] = None) -> str:
+    return ET.tostring(self.expand(file, args), encoding="unicode")
+
+  def clear(self):
+    self._files.clear()
+    self._yaml.clear()
+    self._expansions.clear()
+
+  # files
+
+  def _parse(self, path : str) -> ET.Element:
+    stamp = os.stat(path).st_mtime_ns
+    if path not in self._files or self._files[path][0] != stamp:
+      if path in self._files: self._expansions.clear() # expansions may hold elements of the old version
+      self._files[path] = (stamp, ET.parse(path).getroot())
+    self._source(path)
+    return self._files[path][1]
+
+  def _source(self, path : str):
+    if path not in self.sources: self.sources.append(path)
+    for frame in self._frames: frame.files.append(path) # a memoized expansion reads them again when reused
+
+  def abs_filename(self, filename : str) -> str:
+    return os.path.normpath(os.path.join(os.path.dirname(self._stack[-1]), filename))
+
+  def load_yaml(self, filename : str) -> Any:
+    import yaml # only needed by files that load yaml
+    path = self.abs_filename(filename)
+    stamp = os.stat(path).st_mtime_ns
+    if path not in self._yaml or self._yaml[path][0] != stamp:
+      if path in self._yaml: self._expansions.clear()
+      with open(path) as fp: self._yaml[path] = (stamp, _yaml_value(yaml.safe_load(fp)))
+    self._source(path)
+    return self._yaml[path][1]
+
+  def find(self, package : str) -> str:
+    if package in self.packages: return self.packages[package]
+    for file in reversed(self._stack):
+      folder = find_package(package, os.path.dirname(file))
+      if folder is not None: return folder
+    raise XacroError(f"{self._stack[-1]}: package {package} not found, pass its folder in packages")
+
+  # symbols
+
+  def lookup(self, scope : _Scope, name : str, macro : bool = False) -> Any:
+    """ Resolves name through the scope chain. Expansions in progress note the value if it comes from outside them """
+    owner = scope
+    while owner is not None:
+      table = owner.macros if macro else owner.symbols
+      if name in table: break
+      owner = owner.parent
+
+    if owner is None: value = _MISSING
+    else:
+      value = table[name]
+      if isinstance(value, _Lazy): # evaluated once, where it was defined
+        value = table[name] = _literal(self.eval_text(value.text, owner))
+
+    depth = owner.depth if owner is not None else -1
+    for frame in self._frames:
+      if depth < frame.depth: frame.reads[("macro" if macro else "symbol", name)] = _freeze(value)
+    return value
+
+  def _arg(self, name : str) -> str:
+    for frame in self._frames: frame.reads[("arg", name)] = self.args.get(name, _MISSING)
+    if name not in self.args: raise XacroError(f"{self._stack[-1]}: undefined arg {name}")
+    return self.args[name]
+
+  def _read(self, scope : _Scope, read : tuple[str, str]) -> Any:
+    kind, name = read
+    if kind == "arg":
+      for frame in self._frames: frame.reads[read] = self.args.get(name, _MISSING)
+      return self.args.get(name, _MISSING)
+    return _freeze(self.lookup(scope, name, kind == "macro"))
+
+  def _impure(self):
+    """ Something outside the expansions in progress changed (a global arg, a property of another scope) """
+    for frame in self._frames: frame.pure = False
+
+  # text
+
+  def eval_text(self, text : str, scope : _Scope) -> Any:
+    """ Substitutes ${expression} and $(extension), a text that is a single expression keeps the type of its value """
+    if "$" not in text: return text
+    matches = list(_TOKENS.finditer(text))
+    if len(matches) == 1 and matches[0].group(1) is not None and matches[0].span() == (0, len(text)):
+      return self._expression(matches[0].group(1), scope)
+
+    parts, last = [], 0
+    for match in matches:
+      parts.append(text[last:match.start()])
+      if match.group(1) is not None: parts.append(_string(self._expression(match.group(1), scope)))
+      elif match.group(2) is not None: parts.append(self._extension(match.group(2)))
+      else: parts.append("$")
+      last = match.end()
+    parts.append(text[last:])
+    return "".join(parts)
+
+  def _text(self, text : str, scope : _Scope) -> str:
+    return _string(self.eval_text(text, scope))
+
+  def _expression(self, expression : str, scope : _Scope) -> Any:
+    if "$(" in expression: expression = _EXTENSIONS.sub(lambda match: self._extension(match.group(1)), expression)
+    code = self._code.get(expression)
+    try:
+      if code is None: code = self._code[expression] = compile(expression.strip(), "<xacro>", "eval")
+      return eval(code, self._globals, _Symbols(self, scope))
+    except XacroError: raise
+    except Exception as error: raise XacroError(f"{self._stack[-1]}: can not evaluate ${{{expression}}}: {error!r}") from error
+
+  def _extension(self, text : str) -> str:
+    command, *arguments = text.split()
+    if command == "arg": return self._arg(arguments[0])
+    if command == "find": return self.find(arguments[0])
+    if command == "env": return os.environ[arguments[0]]
+    if command == "optenv": return os.environ.get(arguments[0], " ".join(arguments[1:]))
+    if command == "dirname": return os.path.dirname(self._stack[-1])
+    if command == "cwd": return os.getcwd()
+    raise XacroError(f"{self._stack[-1]}: unknown extension $({text})")
+
+  # elements
+
+  def _children(self, node : ET.Element, scope : _Scope) -> list:
+    """ The expanded content of node as a list of elements and text """
+    items = [self._text(node.text, scope)] if node.text else []
+    for child in node:
+      items.extend(self._node(child, scope))
+      if child.tail: items.append(self._text(child.tail, scope))
+    return items
+
+  def _node(self, node : ET.Element, scope : _Scope) -> list:
+    if not isinstance(node.tag, str): return [] # comments and processing instructions
+    tag = _xacro_tag(node.tag)
+    if tag is None:
+      element = ET.Element(node.tag, { key : self._text(value, scope) for key, value in node.attrib.items() })
+      return [_assemble(element, self._children(node, scope))]
+
+    if tag in ("if", "unless"):
+      return self._children(node, scope) if _boolean(self.eval_text(self._required(node, "value"), scope)) == (tag == "if") else []
+    if tag == "property": return self._property(node, scope)
+    if tag == "arg":
+      self._impure()
+      name = self._required(node, "name")
+      if name not in self.args and "default" in node.attrib: self.args[name] = self._text(node.get("default"), scope)
+      return []
+    if tag == "macro":
+      scope.macros[self._required(node, "name")] = _Macro(node.get("name"), _params(node.get("params", "")), node)
+      return []
+    if tag == "include": return self._include(node, scope)
+    if tag == "insert_block":
+      block = self.lookup(scope, self._required(node, "name"))
+      if not isinstance(block, _Block): raise XacroError(f"{self._stack[-1]}: {node.get('name')} is not a block")
+      return [item for element in block.elements for item in self._node(element, scope)]
+    if tag == "call": return self._call(self._text(self._required(node, "macro"), scope), node, scope)
+    return self._call(tag, node, scope)
+
+  def _required(self, node : ET.Element, attribute : str) -> str:
+    if attribute not in node.attrib: raise XacroError(f"{self._stack[-1]}: <{_xacro_tag(node.tag)}> needs a {attribute}")
+    return node.attrib[attribute]
+
+  def _property(self, node : ET.Element, scope : _Scope) -> list:
+    name = self._required(node, "name")
+    target = scope
+    if "scope" in node.attrib: # "parent" or "global", defined outside the current expansion
+      self._impure()
+      while target.parent is not None and (node.get("scope") == "global" or target is scope): target = target.parent
+
+    if "default" in node.attrib and self.lookup(scope, name) is not _MISSING: return []
+    value = node.get("value", node.get("default"))
+    if value is None: target.symbols[name] = _Block(list(node)) # a block of elements, used with insert_block
+    elif "$" in value and node.get("lazy_eval", "true").lower() != "false": target.symbols[name] = _Lazy(value)
+    else: target.symbols[name] = _literal(self.eval_text(value, scope))
+    return []
+
+  def _include(self, node : ET.Element, scope : _Scope) -> list:
+    """ The content of the included file is expanded in place, its definitions land in the including scope """
+    path = self.abs_filename(self._text(self._required(node, "filename"), scope))
+    root = self._parse(path)
+    self._stack.append(path)
+    try: return self._children(root, scope)
+    finally: self._stack.pop()
+
+  def _call(self, name : str, node : ET.Element, scope : _Scope) -> list:
+    macro = self.lookup(scope, name, macro=True)
+    if macro is _MISSING: raise XacroError(f"{self._stack[-1]}: unknown macro {name}")
+
+    blocks = list(node)
+    values = {}
+    for param, stars, default in macro.params:
+      if stars:
+        if not blocks: raise XacroError(f"{self._stack[-1]}: macro {name} needs the block {param}")
+        block = blocks.pop(0)
+        values[param] = _Block(list(block) if stars == "**" else [block])
+      elif param in node.attrib: values[param] = _literal(self.eval_text(node.attrib[param], scope))
+      elif default is not None and default.startswith("^"): # inherited from the calling scope
+        value = self.lookup(scope, param)
+        if value is _MISSING and "|" not in default: raise XacroError(f"{self._stack[-1]}: macro {name} inherits {param} but it is not defined")
+        values[param] = value if value is not _MISSING else _literal(self.eval_text(default.partition("|")[2], scope))
+      elif default is not None: values[param] = _literal(self.eval_text(default, scope))
+      else: raise XacroError(f"{self._stack[-1]}: macro {name} is missing the parameter {param}")
+
+    unknown = set(node.attrib) - { param for param, _, _ in macro.params } - ({ "macro" } if _xacro_tag(node.tag) == "call" else set())
+    if unknown: raise XacroError(f"{self._stack[-1]}: macro {name} has no parameters {', '.join(sorted(unknown))}")
+
+    key = (macro.key, tuple((param, _freeze(value)) for param, value in values.items()))
+    for reads, output, files in self._expansions.get(key, ()):
+      if all(self._read(scope, read) == value for read, value in reads.items()):
+        self.hits += 1
+        for path in files: self._source(path)
+        return output
+
+    self.misses += 1
+    body = _Scope(scope) # dynamic scoping, the body sees the symbols of its caller
+    body.symbols.update(values)
+    frame = _Frame(body.depth)
+    self._frames.append(frame)
+    try: output = self._children(macro.body, body)
+    finally: self._frames.pop()
+    if frame.pure: self._expansions.setdefault(key, []).append((frame.reads, output, frame.files))
+    return output
+
+
+_processor = XacroProcessor()
+_lock = threading.Lock() # a processor expands one file at a time
+
+
+def expand_xacro(file : str, args : dict[str, str] = None) -> ET.Element:
+  """ Expands a xacro file with the shared processor, so its memos serve every file loaded in this process """
+  return read_xacro(file, args)[0]
+
+
+def read_xacro(file : str, args : dict[str, str] = None) -> tuple[ET.Element, list[str]]:
+  """ The expanded xacro file and the files it read, itself first """
+  with _lock: return _processor.expand(file, args), list(_processor.sources)
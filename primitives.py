@@ -0,0 +1,21 @@
+import trimesh
+
+MIN_SEGMENTS = 6 # coarsest cylinder or sphere, with fewer segments they no longer pass for round
+
+
+def tessellate(type : str, dimensions : tuple[float, ...], segments : int) -> trimesh.Trimesh:
+  """ Triangles of a urdf box (size), sphere (radius) or cylinder (radius, length along z) around the origin, the round
+  ones with segments around their axis. Vertices are split along sharp edges, so flat faces are shaded flat """
+  mesh = {
+    "box" : lambda: trimesh.creation.box(extents=dimensions),
+    "sphere" : lambda: trimesh.creation.uv_sphere(radius=dimensions[0], count=[max(segments // 2, MIN_SEGMENTS // 2), segments]),
+    "cylinder" : lambda: trimesh.creation.cylinder(radius=dimensions[0], height=dimensions[1], sections=segments),
+  }[type]()
+  return mesh.smooth_shaded
+
+
+def level_segments(type : str, segments : int, ratios : tuple[float, ...]) -> list[int]:
+  """ Segments of the coarser levels of detail, one per ratio of the triangles. A cylinder has triangles in proportion
+  to its segments, a sphere to their square and a box has as many at every level """
+  exponent = 0.5 if type == "sphere" else 1.0
+  return [max(MIN_SEGMENTS, round(segments * ratio ** exponent)) for ratio in ratios]
@@ -0,0 +1,51 @@
+import numpy as np
+
+LIMIT = np.iinfo(np.int16).max # -32768 is left out, so the int16 range is symmetric around 0
+
+
+def quantize_positions(vertices : np.ndarray) -> tuple[np.ndarray, list[float], list[float], float]:
+  """ Quantizes (n, 3) vertices to int16 steps around the center of their bounding box. Decoded as origin + q * step,
+  returns q, origin, step and the largest distance between a decoded and its original vertex """
+  vertices = np.asarray(vertices, dtype=np.float64)
+  if len(vertices) == 0: return np.zeros((0, 3), dtype=np.int16), [0.0] * 3, [1.0] * 3, 0.0
+
+  low, high = vertices.min(axis=0), vertices.max(axis=0)
+  origin = (low + high) / 2
+  step = np.maximum(high - low, 1e-12) / (2 * LIMIT) # flat axes still get a valid step
+  quantized = np.clip(np.rint((vertices - origin) / step), -LIMIT, LIMIT).astype(np.int16)
+
+  error = float(np.linalg.norm(origin + quantized * step - vertices, axis=1).max())
+  return quantized, origin.tolist(), step.tolist(), error
+
+
+def encode_octahedral(normals : np.ndarray) -> tuple[np.ndarray, float]:
+  """ Octahedral encoding of (n, 3) unit normals into (n, 2) int16, returns the codes and the largest angle in
+  radians between a decoded and its original normal """
+  normals = np.asarray(normals, dtype=np.float64)
+  if len(normals) == 0: return np.zeros((0, 2), dtype=np.int16), 0.0
+
+  # project onto the octahedron |x| + |y| + |z| = 1 and fold the lower half over the diagonals
+  projected = normals / np.maximum(np.abs(normals).sum(axis=1, keepdims=True), 1e-12)
+  x, y, z = projected[:, 0], projected[:, 1], projected[:, 2]
+  sign = lambda value: np.where(value >= 0, 1.0, -1.0)
+  lower = z < 0
+  folded_x = np.where(lower, (1 - np.abs(y)) * sign(x), x)
+  folded_y = np.where(lower, (1 - np.abs(x)) * sign(y), y)
+
+  codes = np.rint(np.clip(np.stack([folded_x, folded_y], axis=1), -1, 1) * LIMIT).astype(np.int16)
+
+  lengths = np.linalg.norm(normals, axis=1)
+  valid = lengths > 1e-12 # degenerate normals have no direction to lose
+  cosines = np.einsum("ij,ij->i", decode_octahedral(codes)[valid], normals[valid] / lengths[valid, None])
+  error = float(np.arccos(np.clip(cosines, -1, 1)).max()) if valid.any() else 0.0
+  return codes, error
+
+
+def decode_octahedral(codes : np.ndarray) -> np.ndarray:
+  x, y = codes[:, 0] / LIMIT, codes[:, 1] / LIMIT
+  z = 1 - np.abs(x) - np.abs(y)
+  fold = np.maximum(-z, 0)
+  x = x - np.where(x >= 0, fold, -fold)
+  y = y - np.where(y >= 0, fold, -fold)
+  normals = np.stack([x, y, z], axis=1)
+  return normals / np.linalg.norm(normals, axis=1, keepdims=True)
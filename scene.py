@@ -0,0 +1,69 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from parsers.urdf_parser import URDFData, URDFVisual
+
+
+@dataclass
+class SceneEntity:
+  """ One urdf (or xacro file with its args) of a scene, placed at position (meters) and rotation (roll, pitch, yaw in
+  radians) in the urdf frame. The name is unique in the scene, without one in the manifest it is the robot name of the urdf """
+  file : str
+  name : str = None
+  position : list[float] = field(default_factory=lambda: [0.0, 0.0, 0.0])
+  rotation : list[float] = field(default_factory=lambda: [0.0, 0.0, 0.0])
+  args : dict[str, str] = field(default_factory=dict)
+  data : URDFData = None # set once parsed
+
+  @property
+  def folder(self) -> str:
+    return os.path.dirname(self.file) # mesh files are relative to the urdf
+
+  def visuals(self) -> dict[str, URDFVisual]:
+    return { link.visual.name : link.visual for link in self.data.links if link.visual is not None }
+
+  def movable_joints(self) -> list[str]:
+    return [joint.name for joint in self.data.joints if joint.type != "fixed"]
+
+
+def load_manifest(path : str) -> list[SceneEntity]:
+  """ Reads a scene manifest, e.g.
+  { "entities" : [{ "file" : "../models/pybullet/robots/panda.urdf", "name" : "left", "position" : [0, 0.5, 0] }] }
+  files are relative to the manifest, name, position, rotation and args (of a .xacro file) are optional """
+  with open(path) as fp: manifest = json.load(fp)
+  folder = os.path.dirname(path)
+  entities = []
+  for item in manifest["entities"]:
+    entity = SceneEntity(os.path.normpath(os.path.join(folder, item["file"])), item.get("name"))
+    if "position" in item: entity.position = [float(value) for value in item["position"]]
+    if "rotation" in item: entity.rotation = [float(value) for value in item["rotation"]]
+    if "args" in item: entity.args = { name : str(value) for name, value in item["args"].items() }
+    assert len(entity.position) == 3 and len(entity.rotation) == 3, f"Validation error on scene entity {item['file']}, position and rotation need 3 values"
+    entities.append(entity)
+  return entities
+
+
+def unique_names(names : list[str]) -> list[str]:
+  """ Numbers repeated names, ["panda", "panda", "duck"] becomes ["panda", "panda_2", "duck"] """
+  taken = set(names)
+  seen, unique = set(), []
+  for name in names:
+    candidate, number = name, 1
+    while candidate in seen or (candidate != name and candidate in taken):
+      number += 1
+      candidate = f"{name}_{number}"
+    seen.add(candidate)
+    unique.append(candidate)
+  return unique
+
+
+def parse_scene(entities : list[SceneEntity], workers : int = 8):
+  """ Parses the urdfs of every entity concurrently and gives each entity its unique name. A urdf listed several times
+  (with the same args) is parsed once, the entities share the parsed data """
+  sources = list(dict.fromkeys((entity.file, tuple(sorted(entity.args.items()))) for entity in entities))
+  with ThreadPoolExecutor(max(1, min(workers, len(sources)))) as pool:
+    parsed = dict(zip(sources, pool.map(lambda source: URDFData.from_file(source[0], dict(source[1])), sources)))
+
+  for entity in entities: entity.data = parsed[entity.file, tuple(sorted(entity.args.items()))]
+  for entity, name in zip(entities, unique_names([entity.name or entity.data.name for entity in entities])): entity.name = name
@@ -0,0 +1,191 @@
+import json
+import struct
+from abc import ABC, abstractmethod
+from dataclasses import fields, is_dataclass
+import numpy as np
+
+ARRAY_ROWS = 4096 # rows of an array json encodes at once, this bounds the temporary lists of the text encoding
+SMALL_BYTES = 4096 # binary pieces smaller than this are copied together into one chunk, larger arrays stay referenced
+
+# binary value tags
+NONE, FALSE, TRUE, INT, FLOAT, STRING, LIST, MAP, ARRAY = range(9)
+DTYPES = ["<f4", "<f8", "<i1", "<u1", "<i2", "<u2", "<i4", "<u4", "<i8", "<u8"]
+
+
+class Encoder(ABC):
+  """ Writes a value straight into a list of chunks. Dataclasses are walked field by field and numpy arrays are written
+  piecewise, so unlike asdict and json.dumps no copy of the mesh data is ever built """
+
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, value):
+    if value is None or isinstance(value, (bool, int, float, str)): self.scalar(value) # str enums are strings
+    elif isinstance(value, np.ndarray): self.array(value)
+    elif isinstance(value, dict): self.mapping(value.items(), len(value))
+    elif is_dataclass(value): self.mapping([(field.name, getattr(value, field.name)) for field in fields(value)], len(fields(value)))
+    elif isinstance(value, (list, tuple)): self.sequence(value)
+    elif isinstance(value, np.generic): self.scalar(value.item())
+    else: raise TypeError(f"{type(value).__name__} can not be serialized")
+
+  @abstractmethod
+  def scalar(self, value): ...
+
+  @abstractmethod
+  def mapping(self, items, count : int): ...
+
+  @abstractmethod
+  def sequence(self, values : list): ...
+
+  @abstractmethod
+  def array(self, array : np.ndarray): ...
+
+
+class JsonEncoder(Encoder):
+  """ Compact json, float arrays are written with at most decimals decimal points """
+
+  def __init__(self, decimals : int = 5):
+    super().__init__()
+    self.decimals = decimals
+
+  def scalar(self, value):
+    self.chunks.append(json.dumps(value))
+
+  def mapping(self, items, count : int):
+    self.chunks.append("{")
+    for i, (key, value) in enumerate(items):
+      self.chunks.append(("," if i else "") + json.dumps(key) + ":")
+      self.write(value)
+    self.chunks.append("}")
+
+  def sequence(self, values : list):
+    self.chunks.append("[")
+    for i, value in enumerate(values):
+      if i: self.chunks.append(",")
+      self.write(value)
+    self.chunks.append("]")
+
+  def array(self, array : np.ndarray):
+    if array.ndim == 0: return self.scalar(array.item())
+    self.chunks.append("[")
+    for start in range(0, len(array), ARRAY_ROWS):
+      part = array[start:start + ARRAY_ROWS]
+      if part.dtype.kind == "f": part = np.around(part.astype(np.float64), decimals=self.decimals)
+      self.chunks.append(("," if start else "") + json.dumps(part.tolist(), separators=(',', ':'))[1:-1])
+    self.chunks.append("]")
+
+  def getvalue(self) -> str:
+    return "".join(self.chunks)
+
+
+class BinaryEncoder(Encoder):
+  """ Tagged little endian encoding, every value starts with a uint8 tag:
+  NONE, FALSE, TRUE | INT int64 | FLOAT float64 | STRING uint32 length, utf8 | LIST uint32 count, values |
+  MAP uint32 count, (uint32 length, utf8 key, value) pairs | ARRAY uint8 dtype, uint8 ndim, uint32 shape, uint8 padding,
+  padding zero bytes and the raw data, which starts 4 byte aligned.
+  The chunks reference the array data without copying it and are sent like a UBuffer. Tags, scalars and small arrays
+  are collected in one chunk between them, a chunk per value would cost more memory than the value.
+  Only Python reads it (deserialize, e.g. the benchmark and tooling clients), the Unity client has no reader and asks for json """
+
+  def __init__(self):
+    super().__init__()
+    self.size = 0
+    self.small = bytearray()
+
+  def put(self, data):
+    view = memoryview(data).cast("B")
+    self.size += view.nbytes
+    if view.nbytes < SMALL_BYTES:
+      self.small += view
+      return
+    self.flush()
+    self.chunks.append(view)
+
+  def flush(self):
+    if not self.small: return
+    self.chunks.append(memoryview(self.small))
+    self.small = bytearray() # the view keeps the old one
+
+  def scalar(self, value):
+    if value is None: self.put(bytes([NONE]))
+    elif isinstance(value, bool): self.put(bytes([TRUE if value else FALSE]))
+    elif isinstance(value, int): self.put(struct.pack("<Bq", INT, value))
+    elif isinstance(value, float): self.put(struct.pack("<Bd", FLOAT, value))
+    else:
+      data = value.encode()
+      self.put(struct.pack("<BI", STRING, len(data)) + data)
+
+  def mapping(self, items, count : int):
+    self.put(struct.pack("<BI", MAP, count))
+    for key, value in items:
+      data = key.encode()
+      self.put(struct.pack("<I", len(data)) + data)
+      self.write(value)
+
+  def sequence(self, values : list):
+    self.put(struct.pack("<BI", LIST, len(values)))
+    for value in values: self.write(value)
+
+  def array(self, array : np.ndarray):
+    dtype = array.dtype.newbyteorder("<").str.replace("|", "<") # single byte types have no byte order
+    header = struct.pack(f"<BBB{array.ndim}I", ARRAY, DTYPES.index(dtype), array.ndim, *array.shape)
+    padding = -(self.size + len(header) + 1) % 4
+    self.put(header + bytes([padding]) + bytes(padding))
+    if array.size: self.put(np.ascontiguousarray(array, dtype=dtype))
+
+  def getvalue(self) -> bytes:
+    self.flush()
+    return b"".join(self.chunks)
+
+
+FORMATS = { "json" : JsonEncoder, "binary" : BinaryEncoder }
+
+
+def serialize(value, format : str = "json") -> str | BinaryEncoder:
+  """ The json encoding as str, the binary one as its encoder whose chunks still reference the arrays of value """
+  encoder = FORMATS[format]()
+  encoder.write(value)
+  if format == "json": return encoder.getvalue()
+  encoder.flush()
+  return encoder
+
+
+def deserialize(data : bytes) -> object:
+  """ Decodes the binary encoding, arrays are read only views into data """
+  view = memoryview(data)
+
+  def read(offset : int) -> tuple[object, int]:
+    tag = view[offset]
+    offset += 1
+    if tag in (NONE, FALSE, TRUE): return (None, False, True)[tag], offset
+    if tag == INT: return struct.unpack_from("<q", view, offset)[0], offset + 8
+    if tag == FLOAT: return struct.unpack_from("<d", view, offset)[0], offset + 8
+    if tag == STRING:
+      length, = struct.unpack_from("<I", view, offset)
+      return bytes(view[offset + 4:offset + 4 + length]).decode(), offset + 4 + length
+    if tag == LIST:
+      count, = struct.unpack_from("<I", view, offset)
+      values, offset = [], offset + 4
+      for _ in range(count):
+        value, offset = read(offset)
+        values.append(value)
+      return values, offset
+    if tag == MAP:
+      count, = struct.unpack_from("<I", view, offset)
+      items, offset = {}, offset + 4
+      for _ in range(count):
+        length, = struct.unpack_from("<I", view, offset)
+        key = bytes(view[offset + 4:offset + 4 + length]).decode()
+        items[key], offset = read(offset + 4 + length)
+      return items, offset
+    if tag == ARRAY:
+      dtype, ndim = DTYPES[view[offset]], view[offset + 1]
+      shape = struct.unpack_from(f"<{ndim}I", view, offset + 2)
+      offset += 2 + 4 * ndim
+      offset += 1 + view[offset]
+      count = int(np.prod(shape))
+      array = np.frombuffer(view, dtype=dtype, count=count, offset=offset).reshape(shape)
+      return array, offset + array.nbytes
+    raise ValueError(f"Unknown tag {tag} at {offset - 1}")
+
+  return read(0)[0]
@@ -0,0 +1,162 @@
+import json
+import mmap
+import os
+import struct
+import xml.etree.ElementTree as ET
+import numpy as np
+from parsers.urdf_parser import URDFData
+from parsers.xacro_parser import expand_xacro
+from scene import SceneEntity
+from udata import UMaterial, UMesh
+
+# A snapshot is a compiled scene in one file, meant to be memory mapped: the urdf of every entity (xacro files
+# expanded), every converted mesh with its levels of detail and encoded DATA messages. Little endian, PREAMBLE is
+# magic, version, offset and length of the json index, followed by the sections (raw arrays and payloads), every one
+# starting at a multiple of ALIGNMENT, and the index at the end
+MAGIC = b"USNP"
+VERSION = 3
+PREAMBLE = struct.Struct("<4sIQQ")
+ALIGNMENT = 64 # cache lines, the arrays mapped from a section are aligned for vector loads
+
+
+class SnapshotError(ValueError): pass
+
+
+def _stamp(file : str) -> list[int]:
+  stat = os.stat(file)
+  return [stat.st_size, stat.st_mtime_ns]
+
+
+def _urdf(entity : SceneEntity) -> str:
+  if entity.file.endswith(".xacro"): return ET.tostring(expand_xacro(entity.file, entity.args), encoding="unicode")
+  with open(entity.file, "r") as fp: return fp.read()
+
+
+def write_snapshot(path : str, entities : list[SceneEntity], meshes : dict[str, list[UMesh]], messages : dict[tuple[int, str], tuple[list[str], bytes]], config : dict, sources : list[str] = ()):
+  """ Writes the scene to path, meshes are the converted mesh files of the entities and messages the encoded DATA
+  messages (with their geometries) per level of detail and format. The snapshot is stale once one of the urdfs (or the
+  files a xacro includes), the mesh files or the other sources (e.g. a scene manifest) changes, or it is opened with
+  another config """
+  sections : list[tuple[int, memoryview]] = []
+  arrays : dict[int, list] = {} # by id, levels of detail that are not smaller share the arrays of the finer level
+  end = PREAMBLE.size
+
+  def section(data) -> int:
+    nonlocal end
+    view = memoryview(data).cast("B")
+    start = end + -end % ALIGNMENT
+    sections.append((start, view))
+    end = start + view.nbytes
+    return start
+
+  def array(values : np.ndarray) -> list:
+    if id(values) not in arrays:
+      contiguous = np.ascontiguousarray(values)
+      arrays[id(values)] = [section(contiguous), contiguous.dtype.str, list(contiguous.shape)]
+    return arrays[id(values)]
+
+  def package(mesh : UMesh, lods : bool = True) -> dict:
+    return {
+      "name" : mesh.name,
+      "position" : mesh.position,
+      "rotation" : mesh.rotation,
+      "scale" : mesh.scale,
+      "material" : vars(mesh.material) if mesh.material is not None else None,
+      "geometry" : mesh.geometry,
+      "indices" : array(mesh.indices),
+      "vertices" : array(mesh.vertices),
+      "normals" : array(mesh.normals),
+      "uvs" : array(mesh.uvs) if mesh.uvs is not None else None,
+      "image" : array(mesh.image) if mesh.image is not None else None, # the meshes of a texture share its pixels
+      "lods" : [package(lod, False) for lod in mesh.lods] if lods else [], # a level may be the mesh itself
+    }
+
+  stamps = { file : _stamp(file) for file in dict.fromkeys([*sources, *(file for entity in entities for file in [entity.file, *entity.data.includes]), *meshes]) } # before reading, a change meanwhile makes it stale
+  index = json.dumps({
+    "config" : config,
+    "sources" : stamps,
+    "entities" : [{
+      "file" : entity.file,
+      "name" : entity.name,
+      "position" : entity.position,
+      "rotation" : entity.rotation,
+      "args" : entity.args,
+      "urdf" : _urdf(entity),
+      "includes" : entity.data.includes,
+      "visuals" : [link.visual.name if link.visual is not None else None for link in entity.data.links], # unnamed visuals get a name that differs between processes
+    } for entity in entities],
+    "meshes" : { file : [package(mesh) for mesh in file_meshes] for file, file_meshes in meshes.items() },
+    "messages" : [{ "level" : level, "format" : format, "geometries" : geometries, "payload" : [section(payload), len(payload)] } for (level, format), (geometries, payload) in messages.items()],
+  }).encode()
+
+  temp = f"{path}.{os.getpid()}.tmp" # write and rename, so servers starting meanwhile never map half a snapshot
+  with open(temp, "wb") as fp:
+    fp.write(PREAMBLE.pack(MAGIC, VERSION, end, len(index)))
+    for start, view in sections:
+      fp.write(bytes(start - fp.tell()))
+      fp.write(view)
+    fp.write(index)
+  os.replace(temp, path)
+
+
+class Snapshot:
+  """ A snapshot mapped read only, the mesh arrays and the payloads are views into the mapping. Nothing is read before
+  it is sent, and every server process mapping the same file shares its pages in the page cache """
+
+  def __init__(self, path : str):
+    with open(path, "rb") as fp:
+      if os.fstat(fp.fileno()).st_size < PREAMBLE.size: raise SnapshotError(f"{path} is too short for a snapshot")
+      self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) # stays valid after the file is closed or replaced
+
+    magic, version, offset, length = PREAMBLE.unpack_from(self.map)
+    if magic != MAGIC: raise SnapshotError(f"{path} is no snapshot")
+    if version != VERSION: raise SnapshotError(f"{path} has version {version} instead of {VERSION}")
+    try: self.index = json.loads(self.map[offset:offset + length])
+    except ValueError as error: raise SnapshotError(f"{path} has a broken index, {error}")
+
+  def stale(self, config : dict) -> str | None:
+    """ Why the snapshot no longer matches its sources or config, None while it does """
+    if self.index["config"] != config: return "the configuration changed"
+    for file, stamp in self.index["sources"].items():
+      try:
+        if _stamp(file) != stamp: return f"{file} changed"
+      except OSError: return f"{file} is missing"
+    return None
+
+  def entities(self) -> list[SceneEntity]:
+    entities = []
+    for item in self.index["entities"]:
+      data = URDFData.parse(item["urdf"], opt_name=os.path.basename(item["file"]).split(".")[0])
+      data.includes = item["includes"]
+      for link, name in zip(data.links, item["visuals"]):
+        if link.visual is not None: link.visual.name = name
+      entities.append(SceneEntity(item["file"], item["name"], item["position"], item["rotation"], item["args"], data))
+    return entities
+
+  def meshes(self) -> dict[str, list[UMesh]]:
+    def restore(item : dict) -> UMesh:
+      mesh = UMesh(
+        name=item["name"],
+        position=item["position"],
+        rotation=item["rotation"],
+        scale=item["scale"],
+        indices=self._array(*item["indices"]),
+        vertices=self._array(*item["vertices"]),
+        normals=self._array(*item["normals"]),
+        uvs=self._array(*item["uvs"]) if item["uvs"] is not None else None,
+        image=self._array(*item["image"]) if item["image"] is not None else None,
+        material=UMaterial(**item["material"]) if item["material"] is not None else None,
+        geometry=item["geometry"], # hashing the arrays would read all of them
+      )
+      mesh.lods = [restore(lod) for lod in item["lods"]]
+      return mesh
+    return { file : [restore(item) for item in items] for file, items in self.index["meshes"].items() }
+
+  def messages(self) -> dict[tuple[int, str], tuple[list[str], memoryview]]:
+    return { (item["level"], item["format"]) : (item["geometries"], self._view(*item["payload"])) for item in self.index["messages"] }
+
+  def _array(self, offset : int, dtype : str, shape : list[int]) -> np.ndarray:
+    return np.frombuffer(self.map, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+  def _view(self, offset : int, length : int) -> memoryview:
+    return memoryview(self.map)[offset:offset + length]
@@ -0,0 +1,332 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from kinematics import KinematicModel
+
+LEAF_SIZE = 8 # triangles per leaf of the link trees, the top level tree has one link per leaf
+TINY = 1e-30 # stands in for zero direction components, so the slab test never computes 0 * inf
+
+
+def _ranges(starts : np.ndarray, counts : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """ The ranges [start, start + count) one after another, with the index of the range every position belongs to """
+  owners = np.repeat(np.arange(len(starts)), counts)
+  return owners, np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+
+def _reduce_ranges(ufunc : np.ufunc, values : np.ndarray, starts : np.ndarray, ends : np.ndarray) -> np.ndarray:
+  """ ufunc over values[start:end] of every (non empty) range, in one reduceat """
+  padded = np.concatenate([values, values[:1]]) # reduceat can not take len(values) as index
+  return ufunc.reduceat(padded, np.stack([starts, ends], axis=1).ravel())[::2]
+
+
+class BVH:
+  """ Bounding volume hierarchy over boxes lo, hi (n, 3) with median splits along the longest axis of their centers.
+  It is built level by level with one sort per level, not node by node. The nodes are flat arrays: a leaf has count > 0
+  and holds the primitives order[start:start + count], an inner node has the children left and left + 1 """
+
+  def __init__(self, lo : np.ndarray, hi : np.ndarray, leaf_size : int = LEAF_SIZE):
+    centers = (lo + hi) / 2
+    self.order = np.arange(len(lo))
+    parts = []
+    start, end = np.array([0]), np.array([len(lo)])
+    total = 1
+    while len(start):
+      sizes = end - start
+      split = sizes > leaf_size
+      parts.append((
+        _reduce_ranges(np.minimum, lo[self.order], start, end),
+        _reduce_ranges(np.maximum, hi[self.order], start, end),
+        np.where(split, total + 2 * (np.cumsum(split) - 1), -1),
+        start,
+        np.where(split, 0, sizes),
+      ))
+      total += 2 * int(split.sum())
+
+      start, sizes = start[split], sizes[split]
+      if len(start) == 0: break
+      owners, positions = _ranges(start, sizes)
+      points = centers[self.order[positions]]
+      offsets = np.cumsum(sizes) - sizes
+      extent = _reduce_ranges(np.maximum, points, offsets, offsets + sizes) - _reduce_ranges(np.minimum, points, offsets, offsets + sizes)
+      keys = points[np.arange(len(points)), np.argmax(extent, axis=1)[owners]]
+      self.order[positions] = self.order[positions[np.lexsort((keys, owners))]]
+      middle = start + sizes // 2
+      start, end = np.stack([start, middle], axis=1).ravel(), np.stack([middle, start + sizes], axis=1).ravel()
+
+    self.lo, self.hi, self.left, self.start, self.count = [np.concatenate(arrays) for arrays in zip(*parts)]
+
+
+def _max3(values : np.ndarray) -> np.ndarray:
+  return np.maximum(np.maximum(values[:, 0], values[:, 1]), values[:, 2]) # much faster than max(axis=1) over 3 columns
+
+def _min3(values : np.ndarray) -> np.ndarray:
+  return np.minimum(np.minimum(values[:, 0], values[:, 1]), values[:, 2])
+
+
+def _slab(lo : np.ndarray, hi : np.ndarray, origins : np.ndarray, inverse : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """ Distances along the rays where they enter and leave the boxes, a ray misses its box where it enters after it left """
+  near, far = (lo - origins) * inverse, (hi - origins) * inverse
+  return _max3(np.minimum(near, far)), _min3(np.maximum(near, far))
+
+
+def _box_distances(lo : np.ndarray, hi : np.ndarray, points : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """ Distances of the points to the nearest and to the farthest point of their boxes """
+  nearest = points - np.clip(points, lo, hi)
+  farthest = points - np.where(2 * points < lo + hi, hi, lo)
+  return np.sqrt(_dot(nearest, nearest)), np.sqrt(_dot(farthest, farthest))
+
+
+def _descend(tree : BVH, nodes : np.ndarray, pairs : np.ndarray, visit, leaves):
+  """ Walks pairs down the tree breadth first, a whole level of the tree at a time. visit(pairs, nodes) tells which
+  pairs enter their node, leaves(pairs, nodes) gets the pairs that reached a leaf """
+  while len(pairs):
+    keep = visit(pairs, nodes)
+    pairs, nodes = pairs[keep], nodes[keep]
+    leaf = tree.count[nodes] > 0
+    if leaf.any(): leaves(pairs[leaf], nodes[leaf])
+    pairs, left = pairs[~leaf], tree.left[nodes[~leaf]]
+    pairs, nodes = np.concatenate([pairs, pairs]), np.concatenate([left, left + 1])
+
+
+def _leaf_triangles(tree : BVH, pairs : np.ndarray, nodes : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """ A pair for every triangle of the leaves the pairs reached """
+  owners, triangles = _ranges(tree.start[nodes], tree.count[nodes])
+  return pairs[owners], triangles
+
+
+def _dot(a : np.ndarray, b : np.ndarray) -> np.ndarray:
+  return np.einsum("ij,ij->i", a, b)
+
+
+def ray_triangles(origins : np.ndarray, directions : np.ndarray, v0 : np.ndarray, e1 : np.ndarray, e2 : np.ndarray) -> np.ndarray:
+  """ Distance along every ray to its triangle (v0, v0 + e1, v0 + e2), inf where it misses (Moeller Trumbore) """
+  p = np.cross(directions, e2)
+  det = _dot(e1, p)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    inverse = 1.0 / det
+    s = origins - v0
+    u = _dot(s, p) * inverse
+    q = np.cross(s, e1)
+    v = _dot(directions, q) * inverse
+    t = _dot(e2, q) * inverse
+    hit = (np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0) # parallel rays compare nan
+  return np.where(hit, t, np.inf)
+
+
+def closest_on_triangles(points : np.ndarray, a : np.ndarray, b : np.ndarray, c : np.ndarray) -> np.ndarray:
+  """ Closest point of every triangle (a, b, c) to its point, by the voronoi region the point lies in (Ericson) """
+  ab, ac, ap, bp, cp = b - a, c - a, points - a, points - b, points - c
+  d1, d2, d3, d4, d5, d6 = _dot(ab, ap), _dot(ac, ap), _dot(ab, bp), _dot(ac, bp), _dot(ab, cp), _dot(ac, cp)
+  va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+
+  with np.errstate(divide="ignore", invalid="ignore"): # degenerate triangles end up in an edge or vertex region
+    denominator = 1.0 / (va + vb + vc)
+    closest = a + ab * (vb * denominator)[:, None] + ac * (vc * denominator)[:, None]
+    # the regions in reverse order of precedence, later ones overwrite
+    regions = [
+      ((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0), lambda: b + (c - b) * ((d4 - d3) / ((d4 - d3) + (d5 - d6)))[:, None]),
+      ((vb <= 0) & (d2 >= 0) & (d6 <= 0), lambda: a + ac * (d2 / (d2 - d6))[:, None]),
+      ((d6 >= 0) & (d5 <= d6), lambda: c),
+      ((vc <= 0) & (d1 >= 0) & (d3 <= 0), lambda: a + ab * (d1 / (d1 - d3))[:, None]),
+      ((d3 >= 0) & (d4 <= d3), lambda: b),
+      ((d1 <= 0) & (d2 <= 0), lambda: a),
+    ]
+    for inside, point in regions:
+      if inside.any(): closest = np.where(inside[:, None], point(), closest)
+  return closest
+
+
+class LinkTree:
+  """ The triangles of a link in its own frame, ordered by the leaves of their tree, a kd tree of its vertices and the
+  triangles around every vertex """
+
+  def __init__(self, vertices : np.ndarray, faces : np.ndarray):
+    corners = vertices[faces]
+    self.tree = BVH(corners.min(axis=1), corners.max(axis=1))
+    corners = corners[self.tree.order]
+    self.v0 = corners[:, 0]
+    self.e1 = corners[:, 1] - corners[:, 0]
+    self.e2 = corners[:, 2] - corners[:, 0]
+
+    positions, corner_vertices = np.unique(corners.reshape(-1, 3), axis=0, return_inverse=True) # meshes repeat vertices per face
+    corner_vertices = corner_vertices.ravel()
+    self.vertices = cKDTree(positions, balanced_tree=False, compact_nodes=False)
+    self.around = np.argsort(corner_vertices, kind="stable") // 3 # triangles grouped by vertex
+    self.around_count = np.bincount(corner_vertices, minlength=len(positions))
+    self.around_start = np.cumsum(self.around_count) - self.around_count
+
+
+class Forest:
+  """ The trees of all links packed into one node and triangle array, so a query walks every link in the same loop.
+  roots are the root node and first triangle the offset of the triangles of every link """
+
+  def __init__(self, trees : list[LinkTree]):
+    nodes = np.cumsum([0] + [len(tree.tree.lo) for tree in trees])
+    triangles = np.cumsum([0] + [len(tree.v0) for tree in trees])
+    self.roots, self.first_triangle = nodes[:-1], triangles[:-1]
+    self.lo = np.concatenate([tree.tree.lo for tree in trees])
+    self.hi = np.concatenate([tree.tree.hi for tree in trees])
+    self.left = np.concatenate([np.where(tree.tree.left >= 0, tree.tree.left + offset, -1) for tree, offset in zip(trees, self.roots)])
+    self.start = np.concatenate([tree.tree.start + offset for tree, offset in zip(trees, self.first_triangle)])
+    self.count = np.concatenate([tree.tree.count for tree in trees])
+    self.v0, self.e1, self.e2 = [np.concatenate([getattr(tree, name) for tree in trees]) for name in ("v0", "e1", "e2")]
+
+
+class SpatialIndex:
+  """ Ray casts and nearest point queries against the links of every entity in their current pose. Every link has a
+  tree of its triangles in its own frame, built once, the queries are moved into the link frames instead of moving the
+  meshes. A top level tree over the world boxes of the links is rebuilt when the joints move. Every query is a batch,
+  the whole batch walks the trees of all links together one level at a time. Positions are in the urdf frame, in meters """
+
+  def __init__(self):
+    self.links : list[tuple[str, str]] = [] # entity and link name of every link with triangles
+    self.entities : dict[str, tuple[KinematicModel, np.ndarray, list[int], np.ndarray]] = {} # model, placement, links and configuration
+    self.trees : list[LinkTree] = []
+    self.poses = np.zeros((0, 4, 4))
+    self.forest : Forest = None
+    self.top : BVH = None
+
+  def add_entity(self, name : str, model : KinematicModel, placement : np.ndarray, meshes : dict[str, tuple[np.ndarray, np.ndarray]]):
+    """ meshes are the vertices and faces of links in their frame, placement is the 4x4 pose of the root link """
+    indices = []
+    for link, (vertices, faces) in meshes.items():
+      if len(faces) == 0: continue
+      indices.append(len(self.links))
+      self.links.append((name, link))
+      self.trees.append(LinkTree(np.asarray(vertices, dtype=np.float64), np.asarray(faces)))
+    self.entities[name] = (model, placement, indices, None)
+    self.poses = np.concatenate([self.poses, np.zeros((len(indices), 4, 4))])
+    self.forest = Forest(self.trees) if self.trees else None
+    self.set_positions(name, [], [])
+
+  def set_positions(self, entity : str, joints : list[str], positions : list[float]):
+    """ Moves the links of an entity to the joint positions, joints left out are at 0 """
+    model, placement, indices, configuration = self.entities[entity]
+    values = dict(zip(joints, positions))
+    q = np.array([values.get(joint, 0.0) for joint in model.dof], dtype=np.float64)
+    if configuration is not None and np.array_equal(q, configuration): return
+    self.entities[entity] = (model, placement, indices, q)
+
+    poses = placement @ model.forward(q)
+    for index in indices: self.poses[index] = poses[model.link_index[self.links[index][1]]]
+    self.top = None
+
+  def _top(self) -> BVH:
+    """ The tree over the world boxes of the links, the 8 corners of the root box of each link moved into the world """
+    if self.top is None:
+      lo, hi = self.forest.lo[self.forest.roots], self.forest.hi[self.forest.roots]
+      corners = np.stack([np.where([x, y, z], hi, lo) for x in (0, 1) for y in (0, 1) for z in (0, 1)], axis=1)
+      world = corners @ self.poses[:, :3, :3].transpose(0, 2, 1) + self.poses[:, None, :3, 3]
+      self.top = BVH(world.min(axis=1), world.max(axis=1), leaf_size=1)
+    return self.top
+
+  def _candidates(self, visit) -> tuple[np.ndarray, np.ndarray]:
+    """ The queries and links they may reach, visit(queries, nodes) tells which boxes of the top level tree they enter """
+    top, candidates = self._top(), []
+    count = len(visit.queries)
+    _descend(top, np.zeros(count, dtype=np.int64), np.arange(count), visit, lambda pairs, nodes: candidates.append((pairs, top.order[top.start[nodes]])))
+    if not candidates: return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return tuple(np.concatenate(arrays) for arrays in zip(*candidates))
+
+  def _local(self, links : np.ndarray, points : np.ndarray, directions : np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+    """ The points (and directions) moved into the frames of the links """
+    rotations = self.poses[links, :3, :3]
+    local = np.einsum("nji,nj->ni", rotations, points - self.poses[links, :3, 3])
+    return local, (np.einsum("nji,nj->ni", rotations, directions) if directions is not None else None)
+
+  def raycast(self, origins : np.ndarray, directions : np.ndarray, max_distance : float = np.inf) -> dict[str, np.ndarray]:
+    """ The first triangle every ray hits within max_distance: distance, world point and normal (facing the ray) and the
+    index of the link in self.links, -1 (and distance inf) where a ray hits nothing """
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    count = len(origins)
+    best = np.full(count, float(max_distance))
+    hit_link, hit_triangle = np.full(count, -1), np.full(count, -1)
+
+    class Rays: # the pairs of the walks are rays into trees, in the frame of the trees
+      def __init__(self, tree, origins, directions, queries):
+        self.tree, self.origins, self.directions, self.queries = tree, origins, directions, queries
+        self.inverse = 1.0 / np.where(directions == 0, TINY, directions)
+      def __call__(self, pairs, nodes):
+        near, far = _slab(self.tree.lo[nodes], self.tree.hi[nodes], self.origins[pairs], self.inverse[pairs])
+        return (near <= far) & (far >= 0) & (near <= best[self.queries[pairs]])
+
+    if count and self.trees:
+      rays, links = self._candidates(Rays(self._top(), origins, directions, np.arange(count)))
+      forest = self.forest
+      local = Rays(forest, *self._local(links, origins[rays], directions[rays]), rays)
+
+      def leaves(pairs, nodes): # the nearest hit so far prunes the boxes farther away, in every link
+        pairs, triangles = _leaf_triangles(forest, pairs, nodes)
+        distances = ray_triangles(local.origins[pairs], local.directions[pairs], forest.v0[triangles], forest.e1[triangles], forest.e2[triangles])
+        closer = distances < best[rays[pairs]]
+        pairs, triangles, distances = pairs[closer], triangles[closer], distances[closer]
+        np.minimum.at(best, rays[pairs], distances)
+        won = distances == best[rays[pairs]]
+        hit_link[rays[pairs[won]]], hit_triangle[rays[pairs[won]]] = links[pairs[won]], triangles[won]
+
+      _descend(forest, forest.roots[links], np.arange(len(rays)), local, leaves)
+
+    hit = hit_link >= 0
+    normals = np.zeros_like(origins)
+    if hit.any():
+      rotations = self.poses[hit_link[hit], :3, :3]
+      normals[hit] = np.einsum("nij,nj->ni", rotations, np.cross(self.forest.e1[hit_triangle[hit]], self.forest.e2[hit_triangle[hit]]))
+      normals[hit] /= np.linalg.norm(normals[hit], axis=1, keepdims=True)
+      normals[_dot(normals, directions) > 0] *= -1
+    return {
+      "link" : hit_link,
+      "distance" : np.where(hit, best, np.inf),
+      "point" : np.where(hit[:, None], origins + directions * np.where(hit, best, 0.0)[:, None], 0.0),
+      "normal" : normals,
+    }
+
+  def nearest(self, points : np.ndarray, max_distance : float = np.inf) -> dict[str, np.ndarray]:
+    """ The nearest point on the links to every point within max_distance: distance, world point and the index of the
+    link in self.links, -1 (and distance inf) where no link is that close """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    count = len(points)
+    best = np.full(count, float(max_distance))
+    hit_link, hit_point = np.full(count, -1), np.zeros((count, 3))
+
+    class Points: # the pairs of the walks are points in trees, in the frame of the trees
+      def __init__(self, tree, points, queries):
+        self.tree, self.points, self.queries = tree, points, queries
+      def __call__(self, pairs, nodes):
+        near, far = _box_distances(self.tree.lo[nodes], self.tree.hi[nodes], self.points[pairs])
+        np.minimum.at(best, self.queries[pairs], far) # every box holds some surface, so none is nearer than its farthest corner
+        return near <= best[self.queries[pairs]]
+
+    if count and self.trees:
+      queries, links = self._candidates(Points(self._top(), points, np.arange(count)))
+      forest = self.forest
+      local = Points(forest, self._local(links, points[queries])[0], queries)
+
+      def test(pairs : np.ndarray, triangles : np.ndarray):
+        v0 = forest.v0[triangles]
+        closest = closest_on_triangles(local.points[pairs], v0, v0 + forest.e1[triangles], v0 + forest.e2[triangles])
+        distances = np.linalg.norm(closest - local.points[pairs], axis=1)
+        closer = distances <= best[queries[pairs]]
+        pairs, closest, distances = pairs[closer], closest[closer], distances[closer]
+        np.minimum.at(best, queries[pairs], distances)
+        won = distances == best[queries[pairs]]
+        hit_link[queries[pairs[won]]], hit_point[queries[pairs[won]]] = links[pairs[won]], closest[won]
+
+      # the triangles around the nearest vertex give a close first answer, so only few boxes are entered after
+      for link in np.unique(links):
+        tree, pairs = self.trees[link], np.flatnonzero(links == link)
+        vertices = tree.vertices.query(local.points[pairs])[1]
+        owners, around = _ranges(tree.around_start[vertices], tree.around_count[vertices])
+        test(pairs[owners], tree.around[around] + forest.first_triangle[link])
+
+      _descend(forest, forest.roots[links], np.arange(len(queries)), local, lambda pairs, nodes: test(*_leaf_triangles(forest, pairs, nodes)))
+
+    hit = hit_link >= 0
+    world = np.zeros_like(points)
+    if hit.any(): world[hit] = np.einsum("nij,nj->ni", self.poses[hit_link[hit], :3, :3], hit_point[hit]) + self.poses[hit_link[hit], :3, 3]
+    return {
+      "link" : hit_link,
+      "distance" : np.where(hit, best, np.inf),
+      "point" : world,
+    }
+
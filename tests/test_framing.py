@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from framing import CHUNK_SIZE, CODECS, HEADER, Assembler, FramingError, compress, decompress, frame, frames
+from udata import UHeaderType
+
+
+def message_frames(type : UHeaderType, message_id : int, payload : bytes, flags : int = 0) -> list[bytes]:
+  pieces = [memoryview(payload)[:100], memoryview(payload)[100:]] # a small piece is coalesced with the header
+  return [b"".join(fragments) for fragments in frames(type, message_id, pieces, len(payload), flags)]
+
+
+@pytest.fixture
+def payload() -> bytes:
+  return np.random.default_rng(0).integers(0, 255, int(2.5 * CHUNK_SIZE), dtype=np.uint8).tobytes()
+
+
+def test_single_frame_round_trip():
+  assembler = Assembler()
+  assert assembler.feed(frame(UHeaderType.CMD, 7, b'{"command":"raycast"}')) == (UHeaderType.CMD, b'{"command":"raycast"}')
+  empty = message_frames(UHeaderType.BEACON, 8, b"")
+  assert len(empty) == 1 and assembler.feed(empty[0]) == (UHeaderType.BEACON, b"")
+
+
+def test_chunked_messages_interleaved(payload):
+  first, second = message_frames(UHeaderType.DATA, 1, payload), message_frames(UHeaderType.MESH, 2, payload[::-1])
+  assert [len(data) - HEADER.size for data in first] == [CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE // 2]
+  assembler = Assembler()
+  received = [assembler.feed(data) for pair in zip(first, second) for data in pair]
+  assert received[:-2] == [None] * 4
+  assert received[-2] == (UHeaderType.DATA, payload) and received[-1] == (UHeaderType.MESH, payload[::-1])
+  assert not assembler.partial
+
+
+def test_compressed_round_trip(payload):
+  text = b"vertices " * 100000
+  compressed = compress([memoryview(text)[:10], memoryview(text)[10:]], "deflate", 6)
+  assert len(compressed) < len(text) // 100
+  data, = message_frames(UHeaderType.DATA, 3, compressed, CODECS["deflate"])
+  assert Assembler().feed(data) == (UHeaderType.DATA, text)
+
+
+@pytest.mark.parametrize("order", [[0, 2, 1], [1, 0, 2], [0, 0, 1]])
+def test_out_of_order_chunks_are_refused(payload, order):
+  chunks = message_frames(UHeaderType.DATA, 4, payload)
+  assembler = Assembler()
+  with pytest.raises(FramingError):
+    for index in order: assembler.feed(chunks[index])
+
+
+def test_wrong_chunk_length_is_refused(payload):
+  chunks = message_frames(UHeaderType.DATA, 5, payload)
+  assembler = Assembler()
+  assembler.feed(chunks[0])
+  with pytest.raises(FramingError): assembler.feed(chunks[1][:-1]) # a short chunk before the last
+
+
+def test_oversize_messages_are_refused(payload):
+  with pytest.raises(FramingError): Assembler(limit=CHUNK_SIZE).feed(message_frames(UHeaderType.DATA, 6, payload)[0]) # before it is allocated
+  bomb = compress([bytes(64 * CHUNK_SIZE)], "deflate", 9)
+  data, = message_frames(UHeaderType.CMD, 7, bomb, CODECS["deflate"])
+  with pytest.raises(FramingError): Assembler(limit=CHUNK_SIZE).feed(data) # small on the wire, large once inflated
+  assert len(decompress(memoryview(bomb), CODECS["deflate"], 64 * CHUNK_SIZE)) == 64 * CHUNK_SIZE
+
+
+@pytest.mark.parametrize("data", [b"short", HEADER.pack(255, 0, 0, 1, 0, 0), HEADER.pack(0, 9, 0, 1, 0, 3) + b"abc"])
+def test_malformed_frames_are_refused(data):
+  with pytest.raises(FramingError): Assembler().feed(data)
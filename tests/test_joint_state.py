@@ -0,0 +1,24 @@
+import pytest
+from joint_state import JointStatePublisher
+
+
+@pytest.fixture
+def publisher() -> JointStatePublisher:
+  publisher = JointStatePublisher(30, 1e-4)
+  publisher.add_entity("robot", ["a", "b"])
+  return publisher
+
+
+@pytest.mark.parametrize("value", [1e300, -1e39, 10**400, float("nan"), float("inf"), True, "1.0", None])
+def test_set_positions_rejects_what_float32_cannot_hold(publisher, value):
+  with pytest.raises(ValueError):
+    publisher.set_positions("robot", { "a" : 0.5, "b" : value })
+  assert publisher.positions[0].tolist() == [0.0, 0.0] # nothing changed, not even the valid joint
+
+
+def test_set_positions(publisher):
+  publisher.set_positions("robot", { "b" : 3.0e38 })
+  publisher.set_positions("robot", { "a" : -2 })
+  assert publisher.positions[0].tolist() == [-2.0, pytest.approx(3.0e38, rel=1e-6)]
+  with pytest.raises(ValueError): publisher.set_positions("robot", { "c" : 0.0 })
+  with pytest.raises(ValueError): publisher.set_positions("other", { "a" : 0.0 })
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+from kinematics import KinematicModel
+from parsers.urdf_parser import URDFData
+
+PANDA = os.path.join(os.path.dirname(__file__), "..", "res/models/common/robots/panda_arm_hand_pinocchio.urdf") # panda_finger_joint2 mimics panda_finger_joint1
+
+
+@pytest.fixture(scope="module")
+def model() -> KinematicModel:
+  return KinematicModel(URDFData.from_file(PANDA))
+
+
+def numeric_jacobian(model : KinematicModel, q : np.ndarray, link : str, step : float = 1e-6) -> np.ndarray:
+  """ Central differences of the position and the orientation (as rotation vector) of link """
+  index = model.link_index[link]
+  columns = []
+  for dof in range(len(q)):
+    delta = np.zeros_like(q)
+    delta[dof] = step
+    plus, minus = model.forward(q + delta)[index], model.forward(q - delta)[index]
+    linear = (plus[:3, 3] - minus[:3, 3]) / (2 * step)
+    angular = Rotation.from_matrix(plus[:3, :3] @ minus[:3, :3].T).as_rotvec() / (2 * step)
+    columns.append(np.concatenate([linear, angular]))
+  return np.stack(columns, axis=1)
+
+
+@pytest.mark.parametrize("link", ["panda_hand", "panda_rightfinger"])
+def test_jacobian_matches_finite_differences(model, link):
+  random = np.random.default_rng(0)
+  q = model.clip(model.sample(5, random) * 0.9) # away from the limits, the differences step past neither side
+  jacobians = model.jacobian(q, link)
+  for configuration, jacobian in zip(q, jacobians):
+    np.testing.assert_allclose(jacobian, numeric_jacobian(model, configuration, link), atol=1e-6)
+  np.testing.assert_allclose(model.jacobian(q[0], link), jacobians[0])
+
+
+def test_seeds_start_from_the_configuration(model):
+  current = model.sample(1, np.random.default_rng(1))[0]
+  seeds = model.seeds(current, 3, 4)
+  assert seeds.shape == (3, 4, len(model.dof))
+  np.testing.assert_array_equal(seeds[:, 0], np.broadcast_to(current, (3, len(model.dof))))
+  assert model.seeds(current, 2, 1).shape == (2, 1, len(model.dof)) # one restart, no random seeds
+
+
+def test_inverse_drag_from_a_single_seed(model):
+  """ A target dragged a little away from the current pose is reached from that pose alone """
+  random = np.random.default_rng(2)
+  current = model.clip(model.sample(1, random)[0] * 0.5)
+  moved = model.forward(model.clip(current + random.normal(0.0, 0.02, len(model.dof))))[model.link_index["panda_hand"]]
+  result = model.inverse("panda_hand", moved[None, :3, 3], moved[None, :3, :3], model.seeds(current, 1, 1))
+  assert result["converged"].tolist() == [True]
+  reached = model.forward(result["q"][0])[model.link_index["panda_hand"]]
+  np.testing.assert_allclose(reached[:3, 3], moved[:3, 3], atol=1e-4)
+
+
+def test_inverse_reaches_sampled_poses(model):
+  random = np.random.default_rng(3)
+  poses = model.forward(model.sample(10, random))[:, model.link_index["panda_hand"]]
+  result = model.inverse("panda_hand", poses[:, :3, 3], poses[:, :3, :3], model.seeds(np.zeros(len(model.dof)), 10, 8, random))
+  assert result["converged"].mean() >= 0.8
+  assert (result["position_error"][result["converged"]] < 1e-4).all()
+  assert ((model.lower <= result["q"]) & (result["q"] <= model.upper)).all()
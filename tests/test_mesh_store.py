@@ -0,0 +1,49 @@
+import numpy as np
+from mesh_store import ALIGNMENT, MIN_PAYLOAD, MeshStore
+from udata import UMaterial, UMesh
+
+
+def mesh(seed : int, uvs : bool = True) -> UMesh:
+  random = np.random.default_rng(seed)
+  vertices = random.normal(size=(40, 3)).astype(np.float32)
+  material = UMaterial("paint", [0.0] * 4, [1.0] * 4, [0.0] * 4, 0.5, texture=f"texture{seed}" if uvs else None)
+  fine = UMesh("part", [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, 1.0, 1.0], random.integers(0, 40, 60).astype(np.uint32), vertices, vertices * 2,
+               uvs=random.uniform(size=(40, 2)).astype(np.float32) if uvs else None, material=material, image=np.full((2, 2, 4), seed, dtype=np.uint8) if uvs else None)
+  fine.lods = [UMesh("part", [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, 1.0, 1.0], fine.indices[:30], vertices, fine.normals, uvs=fine.uvs, material=material, image=fine.image), fine]
+  return fine
+
+
+def test_stored_meshes_are_equal_read_only_views():
+  store = MeshStore()
+  originals = [mesh(1), mesh(2, uvs=False)]
+  stored = store.store(originals)
+  start = min(np.frombuffer(segment, dtype=np.uint8).ctypes.data for segment in store.maps)
+  for original, copy in zip(originals, stored):
+    assert copy.geometry == original.geometry and len(copy.lods) == 2 and copy.lods[1] is copy # the level that is the mesh itself stays it
+    for level, copied in zip([original, *original.lods[:1]], [copy, *copy.lods[:1]]):
+      for name in ("indices", "vertices", "normals", "uvs"):
+        array = getattr(copied, name)
+        if getattr(level, name) is None:
+          assert array is None
+          continue
+        np.testing.assert_array_equal(array, getattr(level, name))
+        assert not array.flags.writeable and (array.ctypes.data - start) % ALIGNMENT == 0
+  np.testing.assert_array_equal(stored[0].image, originals[0].image)
+
+
+def test_geometries_and_images_are_written_once():
+  store = MeshStore()
+  first = store.store([mesh(3)])[0]
+  size = store.size
+  again = store.store([mesh(3)])[0]
+  assert store.size == size # nothing appended
+  assert again.vertices.ctypes.data == first.vertices.ctypes.data and again.image.ctypes.data == first.image.ctypes.data
+
+
+def test_payloads():
+  store = MeshStore()
+  small = b"x" * (MIN_PAYLOAD - 1)
+  assert store.payload(small) is small # stays on the heap
+  large = bytes(range(256)) * (MIN_PAYLOAD // 256 + 1)
+  view = store.payload(large)
+  assert isinstance(view, memoryview) and bytes(view) == large
@@ -0,0 +1,17 @@
+from metrics import Metrics, PrometheusSink
+
+
+def test_forget_drops_the_series_of_a_client():
+  metrics = Metrics()
+  metrics.enabled = True
+  for client in ("a:1", "b:2"):
+    metrics.gauge("send_queue", 1, add=True, client=client)
+    metrics.count("messages_sent", client=client, message="DATA")
+    metrics.observe(("send", (("client", client),)), 0.5)
+  metrics.gauge("clients", 2)
+
+  metrics.forget(client="a:1")
+  rendered = PrometheusSink(0).render(metrics.snapshot())
+  assert "a:1" not in rendered
+  assert rendered.count('client="b:2"') == 5 # the gauge, the counter and the three timer lines
+  assert "urdf_clients 2" in rendered
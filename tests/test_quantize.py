@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from quantize import LIMIT, decode_octahedral, encode_octahedral, quantize_positions
+
+
+@pytest.mark.parametrize("scale", [1e-3, 1.0, 250.0])
+def test_positions_within_half_a_step(scale):
+  vertices = np.random.default_rng(0).uniform(-1, 2, (5000, 3)) * scale
+  quantized, origin, step, error = quantize_positions(vertices)
+  assert quantized.dtype == np.int16 and np.abs(quantized.astype(np.int32)).max() <= LIMIT
+  decoded = np.asarray(origin) + quantized * np.asarray(step)
+  assert (np.abs(decoded - vertices) <= np.asarray(step) / 2 + 1e-12 * scale).all() # rounding, per axis
+  assert error == pytest.approx(np.linalg.norm(decoded - vertices, axis=1).max())
+  assert error <= np.linalg.norm(step) / 2
+  assert error <= 3e-5 * scale * 3 ** 0.5 # 16 bits over the 3 * scale extent
+
+
+def test_positions_flat_and_empty():
+  flat = np.array([[0.0, 1.0, 5.0], [1.0, 1.0, 5.0], [0.5, 1.0, 5.0]]) # no extent along y and z
+  quantized, origin, step, error = quantize_positions(flat)
+  assert np.isfinite(step).all() and error < 1e-9
+  np.testing.assert_allclose(np.asarray(origin) + quantized * np.asarray(step), flat, atol=1e-9)
+  quantized, _, _, error = quantize_positions(np.zeros((0, 3)))
+  assert quantized.shape == (0, 3) and error == 0.0
+
+
+def test_octahedral_error_bound():
+  normals = np.random.default_rng(1).normal(size=(100000, 3))
+  normals = np.concatenate([normals, np.eye(3), -np.eye(3), [[1, 1, -1], [-1, 0, -1]]]) # poles and the folded half
+  codes, error = encode_octahedral(normals)
+  assert codes.dtype == np.int16 and np.abs(codes.astype(np.int32)).max() <= LIMIT
+  units = normals / np.linalg.norm(normals, axis=1, keepdims=True)
+  angles = np.arccos(np.clip(np.einsum("ij,ij->i", decode_octahedral(codes), units), -1, 1))
+  assert error == pytest.approx(angles.max())
+  assert error < 1e-4 # radians, about 0.006 degrees
+  np.testing.assert_allclose(decode_octahedral(codes[-8:-2]), units[-8:-2], atol=1e-12) # the axes are exact
+
+
+def test_octahedral_degenerate_normals():
+  codes, error = encode_octahedral(np.array([[0.0, 0.0, 0.0], [0.0, 0.0, 2.0]]))
+  assert error < 1e-12 and codes[1].tolist() == [0, 0]
+  assert encode_octahedral(np.zeros((0, 3)))[0].shape == (0, 2)
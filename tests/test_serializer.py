@@ -0,0 +1,62 @@
+import json
+from dataclasses import dataclass
+import numpy as np
+import pytest
+from serializer import Encoder, deserialize, serialize
+
+
+@dataclass
+class Part:
+  name : str
+  scale : list[float]
+  vertices : np.ndarray
+
+
+def sample() -> dict:
+  random = np.random.default_rng(0)
+  return {
+    "none" : None, "flags" : [True, False], "int" : -2**40, "float" : 0.1, "text" : "ümlaut",
+    "nested" : { "empty" : {}, "list" : [] },
+    "part" : Part("link", [1.0, 2.0, 3.0], random.normal(size=(5000, 3)).astype(np.float32)), # above SMALL_BYTES
+    "indices" : np.arange(7, dtype=np.uint16), # leaves the next array unaligned without padding
+    "colors" : random.integers(0, 255, (3, 4), dtype=np.uint8),
+    "counts" : np.array([1, -1], dtype=np.int64),
+    "nothing" : np.zeros((0, 3), dtype=np.float32),
+    "scalar" : np.float64(2.5),
+  }
+
+
+def test_encoder_is_abstract():
+  with pytest.raises(TypeError): Encoder()
+
+
+def test_json_round_trip():
+  value = sample()
+  decoded = json.loads(serialize(value))
+  assert decoded["part"]["name"] == "link" and decoded["part"]["scale"] == [1.0, 2.0, 3.0]
+  np.testing.assert_allclose(decoded["part"]["vertices"], value["part"].vertices, atol=1e-5) # 5 decimals
+  assert decoded["indices"] == list(range(7)) and decoded["colors"] == value["colors"].tolist()
+  assert decoded["nothing"] == [] and decoded["scalar"] == 2.5
+  assert { key : decoded[key] for key in ("none", "flags", "int", "float", "text", "nested", "counts") } == \
+    { "none" : None, "flags" : [True, False], "int" : -2**40, "float" : 0.1, "text" : "ümlaut", "nested" : { "empty" : {}, "list" : [] }, "counts" : [1, -1] }
+
+
+def test_binary_round_trip():
+  value = sample()
+  encoder = serialize(value, "binary")
+  data = encoder.getvalue()
+  assert len(data) == encoder.size
+  decoded = deserialize(data)
+
+  for key in ("none", "flags", "int", "float", "text", "nested", "scalar"): assert decoded[key] == value[key]
+  assert decoded["part"]["name"] == "link" and decoded["part"]["scale"] == [1.0, 2.0, 3.0]
+  start = np.frombuffer(data, dtype=np.uint8).ctypes.data
+  for decoded_array, array in [(decoded["part"]["vertices"], value["part"].vertices), *((decoded[key], value[key]) for key in ("indices", "colors", "counts", "nothing"))]:
+    assert decoded_array.dtype == array.dtype and decoded_array.shape == array.shape
+    np.testing.assert_array_equal(decoded_array, array) # exact, no rounding
+    assert (decoded_array.ctypes.data - start) % 4 == 0 or decoded_array.size == 0
+
+
+def test_unknown_values_are_refused():
+  with pytest.raises(TypeError): serialize({ "set" : { 1, 2 } })
+  with pytest.raises(ValueError): deserialize(b"\xff")
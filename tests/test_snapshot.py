@@ -0,0 +1,92 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from scene import SceneEntity, parse_scene
+from snapshot import Snapshot, SnapshotError, write_snapshot
+from udata import UMaterial, UMesh
+
+FRANKA = os.path.join(os.path.dirname(__file__), "..", "res/models/test/franka_description")
+URDF = """<robot name="box"><link name="base"><visual name="shell"><geometry><mesh filename="box.obj"/></geometry></visual></link></robot>"""
+
+
+def touch(path : str, text : str):
+  with open(path, "w") as fp: fp.write(text)
+  stat = os.stat(path)
+  os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9)) # a new stamp even on coarse file systems
+
+
+def mesh() -> UMesh:
+  random = np.random.default_rng(0)
+  vertices = random.normal(size=(30, 3)).astype(np.float32)
+  fine = UMesh("shell", [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, 1.0, 1.0], np.arange(30, dtype=np.uint32), vertices, vertices.copy(),
+               uvs=random.uniform(size=(30, 2)).astype(np.float32), material=UMaterial("paint", [0.1, 0.1, 0.1, 1.0], [1.0, 0.5, 0.0, 1.0], [0.2, 0.2, 0.2, 1.0], 0.4, texture="abc"), image=np.full((4, 4, 4), 7, dtype=np.uint8))
+  fine.lods = [UMesh("shell", [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, 1.0, 1.0], fine.indices[:15], vertices, fine.normals, uvs=fine.uvs, material=fine.material, image=fine.image)]
+  return fine
+
+
+@pytest.fixture
+def urdf_scene(tmp_path):
+  touch(tmp_path / "box.urdf", URDF)
+  touch(tmp_path / "box.obj", "v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n")
+  touch(tmp_path / "scene.json", '{ "entities" : [{ "file" : "box.urdf" }] }')
+  entities = [SceneEntity(str(tmp_path / "box.urdf"), "box", [0.0, 1.0, 0.0])]
+  parse_scene(entities)
+  path = str(tmp_path / "scene.snapshot")
+  write_snapshot(path, entities, { str(tmp_path / "box.obj") : [mesh()] }, { (0, "json") : (["abc"], b'{"entities":[]}') }, { "lods" : [0.5] }, [str(tmp_path / "scene.json")])
+  return tmp_path, path
+
+
+def test_round_trip(urdf_scene):
+  folder, path = urdf_scene
+  snapshot = Snapshot(path)
+  assert snapshot.stale({ "lods" : [0.5] }) is None
+
+  entity, = snapshot.entities()
+  assert (entity.name, entity.position, entity.data.name, list(entity.visuals())) == ("box", [0.0, 1.0, 0.0], "box", ["shell"])
+  restored, = snapshot.meshes()[str(folder / "box.obj")]
+  original = mesh()
+  for name in ("indices", "vertices", "normals", "uvs", "image"): np.testing.assert_array_equal(getattr(restored, name), getattr(original, name))
+  assert restored.geometry == original.geometry and vars(restored.material) == vars(original.material)
+  assert restored.lods[0].indices.tolist() == original.lods[0].indices.tolist() and restored.lods[0].vertices.ctypes.data == restored.vertices.ctypes.data # shared, not stored twice
+  assert { key : (geometries, bytes(payload)) for key, (geometries, payload) in snapshot.messages().items() } == { (0, "json") : (["abc"], b'{"entities":[]}') }
+
+
+@pytest.mark.parametrize("source", ["box.urdf", "box.obj", "scene.json"])
+def test_stale_once_a_source_changes(urdf_scene, source):
+  folder, path = urdf_scene
+  touch(folder / source, open(folder / source).read() + "\n")
+  assert source in Snapshot(path).stale({ "lods" : [0.5] })
+
+
+def test_stale_with_another_config_or_a_missing_source(urdf_scene):
+  folder, path = urdf_scene
+  assert Snapshot(path).stale({ "lods" : [0.25] }) == "the configuration changed"
+  os.remove(folder / "box.obj")
+  assert Snapshot(path).stale({ "lods" : [0.5] }).endswith("box.obj is missing")
+
+
+def test_stale_once_an_included_xacro_changes(tmp_path):
+  shutil.copytree(FRANKA, tmp_path / "franka_description") # the includes find the package by its folder name
+  file = str(tmp_path / "franka_description/robots/panda/panda.urdf.xacro")
+  entities = [SceneEntity(file, "panda")]
+  parse_scene(entities)
+  included = str(tmp_path / "franka_description/robots/common/franka_arm.xacro")
+  assert included in entities[0].data.includes and str(tmp_path / "franka_description/robots/panda/joint_limits.yaml") in entities[0].data.includes
+
+  path = str(tmp_path / "panda.snapshot")
+  write_snapshot(path, entities, {}, {}, {})
+  assert Snapshot(path).stale({}) is None
+  assert Snapshot(path).entities()[0].data.includes == entities[0].data.includes # a warm start still knows what to watch
+
+  touch(included, open(included).read().replace("_joint1", "_joint_one"))
+  assert Snapshot(path).stale({}) == f"{included} changed"
+  parse_scene(entities)
+  assert "panda_joint_one" in [joint.name for joint in entities[0].data.joints]
+
+
+def test_broken_files_are_refused(tmp_path):
+  touch(tmp_path / "short", "USNP")
+  touch(tmp_path / "other", "x" * 64)
+  with pytest.raises(SnapshotError): Snapshot(str(tmp_path / "short"))
+  with pytest.raises(SnapshotError): Snapshot(str(tmp_path / "other"))
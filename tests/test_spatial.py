@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import pytest
+import trimesh
+from kinematics import KinematicModel
+from parsers.urdf_parser import URDFData
+from spatial import SpatialIndex, ray_triangles
+
+PANDA = os.path.join(os.path.dirname(__file__), "..", "res/models/common/robots/panda_arm_hand_pinocchio.urdf")
+
+
+def link_meshes(model : KinematicModel, random : np.random.Generator) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+  """ A small sphere or box per link, off its origin so the link rotations matter """
+  meshes = {}
+  for i, link in enumerate(model.links):
+    mesh = trimesh.creation.icosphere(subdivisions=2, radius=0.04) if i % 2 else trimesh.creation.box(extents=[0.08, 0.05, 0.12])
+    mesh.apply_translation(random.uniform(-0.05, 0.05, 3))
+    meshes[link] = (mesh.vertices, mesh.faces)
+  return meshes
+
+
+@pytest.fixture(scope="module")
+def scene():
+  """ Two pandas in random poses, the index and the world triangles of every link in the order of index.links """
+  random = np.random.default_rng(0)
+  model = KinematicModel(URDFData.from_file(PANDA))
+  index, triangles = SpatialIndex(), []
+  for name, offset in (("left", [0.0, 0.4, 0.0]), ("right", [0.0, -0.4, 0.0])):
+    placement = trimesh.transformations.rotation_matrix(random.uniform(-np.pi, np.pi), [0, 0, 1])
+    placement[:3, 3] = offset
+    meshes = link_meshes(model, random)
+    index.add_entity(name, model, placement, meshes)
+    q = model.sample(1, random)[0]
+    index.set_positions(name, model.dof, q.tolist())
+    poses = placement @ model.forward(q)
+    for link, (vertices, faces) in meshes.items(): triangles.append(trimesh.transform_points(vertices, poses[model.link_index[link]])[faces])
+  return index, triangles
+
+
+def test_raycast_matches_brute_force(scene):
+  index, triangles = scene
+  random = np.random.default_rng(1)
+  every = np.concatenate(triangles)
+  origins = random.uniform(-1.5, 1.5, (500, 3))
+  targets = np.concatenate([every[random.integers(0, len(every), 250)].mean(axis=1), random.uniform(-1.5, 1.5, (250, 3))]) # half aim at a triangle
+  directions = targets - origins
+  result = index.raycast(origins, directions)
+
+  owner = np.repeat(np.arange(len(triangles)), [len(part) for part in triangles])
+  rays, faces = np.repeat(np.arange(len(origins)), len(every)), np.tile(np.arange(len(every)), len(origins))
+  unit = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+  distances = ray_triangles(origins[rays], unit[rays], every[faces, 0], every[faces, 1] - every[faces, 0], every[faces, 2] - every[faces, 0]).reshape(len(origins), -1)
+  expected, expected_link = distances.min(axis=1), owner[distances.argmin(axis=1)]
+
+  hit = np.isfinite(expected)
+  assert hit.sum() > 100 and (~hit).sum() > 50
+  np.testing.assert_array_equal(np.isfinite(result["distance"]), hit)
+  np.testing.assert_allclose(result["distance"][hit], expected[hit], atol=1e-9)
+  assert (result["link"][hit] == expected_link[hit]).mean() > 0.99 # ties on shared edges may go either way
+  assert (result["link"][~hit] == -1).all()
+  np.testing.assert_allclose(result["point"][hit], origins[hit] + unit[hit] * expected[hit, None], atol=1e-9)
+  assert (np.einsum("ij,ij->i", result["normal"][hit], unit[hit]) <= 0).all() # facing the ray
+
+
+def test_raycast_max_distance(scene):
+  index, _ = scene
+  origins, directions = np.array([[0.0, 0.4, 3.0]]), np.array([[0.0, 0.0, -1.0]])
+  distance = index.raycast(origins, directions)["distance"][0]
+  assert np.isfinite(distance)
+  assert index.raycast(origins, directions, max_distance=distance - 1e-6)["link"][0] == -1
+
+
+def test_nearest_matches_brute_force(scene):
+  index, triangles = scene
+  points = np.random.default_rng(2).uniform(-1.0, 1.0, (300, 3))
+  result = index.nearest(points)
+
+  distances = np.full((len(points), len(triangles)), np.inf)
+  for link, part in enumerate(triangles):
+    for i, point in enumerate(points):
+      closest = trimesh.triangles.closest_point(part, np.repeat(point[None], len(part), axis=0))
+      distances[i, link] = np.linalg.norm(closest - point, axis=1).min()
+  expected = distances.min(axis=1)
+
+  np.testing.assert_allclose(result["distance"], expected, atol=1e-9)
+  assert (distances[np.arange(len(points)), result["link"]] <= expected + 1e-9).all()
+  np.testing.assert_allclose(np.linalg.norm(result["point"] - points, axis=1), expected, atol=1e-9)
+
+  near = index.nearest(points, max_distance=np.median(expected))
+  np.testing.assert_array_equal(near["link"] >= 0, expected <= np.median(expected))
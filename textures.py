@@ -0,0 +1,119 @@
+import hashlib
+import io
+import json
+import os
+import urllib.parse
+import numpy as np
+try: from PIL import Image
+except ImportError: Image = None # trimesh only loads images with pillow, without it no material has one
+
+PADDING = 4 # pixels around every texture of an atlas repeating its border, so filtering does not bleed into the neighbours
+UV_TOLERANCE = 1e-3 # uvs this far outside [0, 1] do not count as tiling yet
+
+
+def read_image(image) -> np.ndarray | None:
+  """ The rgba pixels (h, w, 4) uint8 of a material image, top row first. None without an image and for a single color,
+  trimesh makes those up for materials whose texture file is missing """
+  if image is None or Image is None: return None
+  pixels = np.asarray(image.convert("RGBA"))
+  if (pixels == pixels[0, 0]).all(): return None
+  return np.ascontiguousarray(pixels)
+
+
+def load_image(file : str) -> np.ndarray | None:
+  """ The pixels of an image file, e.g. the texture of a urdf material """
+  if Image is None: return None
+  with Image.open(file) as image: return read_image(image)
+
+
+def material_files(file : str) -> list[str]:
+  """ The files trimesh reads along with a mesh file, the mtllib of an obj and the map_Kd images in it or the external
+  buffers and images of a gltf. Paths relative to the folder of the mesh file as trimesh resolves them, missing ones too """
+  folder, extension = os.path.dirname(file), os.path.splitext(file)[1].lower()
+  names = []
+  if extension == ".obj":
+    with open(file, "r", errors="replace") as fp: library = next((line[line.find("mtllib") + 6:].strip() for line in fp if "mtllib" in line), None)
+    if library:
+      names.append(library)
+      try:
+        with open(os.path.join(folder, library), "r", errors="replace") as fp:
+          names += [line.strip()[6:].strip() for line in fp if line.strip().lower().startswith("map_kd") and line.strip()[6:].strip()]
+      except OSError: pass # trimesh loads the obj without materials
+  elif extension == ".gltf":
+    with open(file, "r") as fp: gltf = json.load(fp)
+    uris = [item.get("uri") for item in gltf.get("buffers", []) + gltf.get("images", [])]
+    names += [urllib.parse.unquote(uri) for uri in uris if uri and not uri.startswith("data:")]
+  return list(dict.fromkeys(os.path.normpath(os.path.join(folder, name)) for name in names))
+
+
+def texture_key(pixels : np.ndarray) -> str:
+  """ Content address of the pixels """
+  digest = hashlib.blake2b(digest_size=8)
+  digest.update(np.asarray(pixels.shape, dtype=np.uint32))
+  digest.update(np.ascontiguousarray(pixels))
+  return digest.hexdigest()
+
+
+def tiles(uvs : np.ndarray) -> bool:
+  """ Whether the uvs leave the unit square, a tiling texture repeats and cannot be cut out of an atlas """
+  return len(uvs) > 0 and (uvs.min() < -UV_TOLERANCE or uvs.max() > 1 + UV_TOLERANCE)
+
+
+def encode_texture(pixels : np.ndarray, max_size : int, quality : int) -> tuple[bytes, str, int, int]:
+  """ The encoded texture scaled down to at most max_size pixels on its longest side, its format and size. Textures
+  with transparent pixels are png, the others jpeg of quality """
+  image = Image.fromarray(pixels, "RGBA")
+  scale = max_size / max(image.size)
+  if scale < 1: image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.Resampling.LANCZOS)
+
+  output = io.BytesIO()
+  if (pixels[..., 3] < 255).any():
+    format = "png"
+    image.save(output, "PNG")
+  else:
+    format = "jpg"
+    image.convert("RGB").save(output, "JPEG", quality=quality)
+  return output.getvalue(), format, image.width, image.height
+
+
+def _shelves(sizes : dict[str, tuple[int, int]], width : int, max_height : int) -> tuple[dict[str, tuple[int, int]], int]:
+  """ Places the padded sizes (width, height) tallest first left to right in rows of width, the ones that would end
+  below max_height stay out. The top left corner of every placed one and the height used """
+  places, x, y, row = {}, 0, 0, 0
+  for key, (w, h) in sorted(sizes.items(), key=lambda item: (-item[1][1], item[0])):
+    if w > width: continue
+    if x + w > width: x, y, row = 0, y + row, 0
+    if y + h > max_height: continue
+    places[key] = (x, y)
+    x, row = x + w, max(row, h)
+  return places, y + row
+
+
+def pack_atlas(textures : dict[str, np.ndarray], max_size : int) -> tuple[str, np.ndarray, dict[str, dict]] | None:
+  """ Packs the textures into one atlas of at most max_size pixels on a side, the smallest power of two width they fit
+  in. The key and pixels of the atlas and per packed texture the offset and scale of the material that maps its uvs
+  into the atlas (uv space, v up). None if fewer than two fit """
+  sizes = { key : (pixels.shape[1] + 2 * PADDING, pixels.shape[0] + 2 * PADDING) for key, pixels in textures.items() }
+  width = 1 << (max(w for w, _ in sizes.values()) - 1).bit_length()
+  while True:
+    places, height = _shelves(sizes, min(width, max_size), max_size)
+    if len(places) == len(sizes) and height <= width or width >= max_size: break
+    width *= 2
+  if len(places) < 2: return None
+
+  width, height = min(width, max_size), 1 << (height - 1).bit_length()
+  atlas = np.zeros((height, width, 4), dtype=np.uint8)
+  regions = {}
+  for key, (x, y) in places.items():
+    pixels = textures[key]
+    h, w = pixels.shape[:2]
+    atlas[y:y + h + 2 * PADDING, x:x + w + 2 * PADDING] = np.pad(pixels, ((PADDING, PADDING), (PADDING, PADDING), (0, 0)), mode="edge")
+    regions[key] = {
+      "textureOffset" : [(x + PADDING) / width, 1 - (y + PADDING + h) / height], # rows count down from the top, v up from the bottom
+      "textureScale" : [w / width, h / height],
+    }
+
+  layout = json.dumps(sorted((key, place) for key, place in places.items())).encode()
+  key = hashlib.blake2b(layout, digest_size=8).hexdigest() # the pieces and where they are, hashing the pixels takes longer
+  for region in regions.values(): region["texture"] = key
+  return key, atlas, regions
@@ -1,14 +1,12 @@
-from dataclasses import dataclass, is_dataclass, asdict
+from dataclasses import dataclass, field, replace
 from enum import Enum
+import hashlib
 import math
+import numpy as np
+from quantize import encode_octahedral, quantize_positions
 
 
-
-def dataclass_to_dict_rec(obj, exclude : set = {}): 
-  return { key: dataclass_to_dict_rec(value) for key, value in asdict(obj).items() if key not in exclude } if is_dataclass(obj) else obj
-
-
-class UHeaderType(str, Enum):
+class UHeaderType(str, Enum): # the position is the type code of the framing, new types go last
   ENTITY = "ENTITY"
   MESH = "MESH"
   SHAPE = "SHAPE"
@@ -16,6 +14,15 @@ class UHeaderType(str, Enum):
   BEACON = "BEACON"
   SPAWN  = "SPAWN"
   DATA = "DATA"
+  BUFFER = "BUFFER"
+  GEOMETRY = "GEOMETRY"
+  JOINTS = "JOINTS" # layout of the UPDATE frames
+  CMD = "CMD" # requests of a client, json with a "command" name
+  DIFF = "DIFF" # added, changed and removed links, joints and visuals of an entity after a reload
+  MSG = "MSG" # log text of a client
+  ERR = "ERR" # error text of a client
+  RESULT = "RESULT" # answer to a query CMD (raycast, nearest), carries the id of the command
+  TEXTURE = "TEXTURE" # encoded image a material refers to by its key
 
 class UJointType(str, Enum):
   REVOLUTE  = "REVOLUTE"
@@ -32,6 +39,34 @@ class UVisualType(str, Enum):
   PLANE     = "PLANE"
   MESH      = "MESH"
   
+class UShapeType(str, Enum):
+  BOX       = "BOX"
+  SPHERE    = "SPHERE"
+  CYLINDER  = "CYLINDER"
+  HULLS     = "HULLS" # convex decomposition of a mesh
+
+class UBuffer:
+  """ Binary blob the mesh arrays of a package are written to when the binary encoding is used.
+  The arrays are only referenced (no copy for arrays that already have the wire dtype), every array starts 4 byte aligned """
+  ALIGNMENT = 4
+
+  def __init__(self):
+    self.chunks : list[memoryview] = []
+    self.size = 0
+
+  def append(self, array : np.ndarray, dtype : str) -> int:
+    view = memoryview(np.ascontiguousarray(array, dtype=dtype)).cast("B")
+    offset = self.size
+    self.chunks.append(view)
+    self.size += view.nbytes
+
+    padding = -self.size % UBuffer.ALIGNMENT
+    if padding:
+      self.chunks.append(memoryview(bytes(padding)))
+      self.size += padding
+    return offset
+
+
 @dataclass
 class UMaterial:
   name : str
@@ -39,6 +74,9 @@ class UMaterial:
   diffuse : list[float]
   ambient : list[float]
   glossiness : float
+  texture : str = None # key of the TEXTURE of the diffuse map
+  textureOffset : list[float] = field(default_factory=lambda: [0.0, 0.0]) # where the uvs land in the texture, uv * scale + offset
+  textureScale : list[float] = field(default_factory=lambda: [1.0, 1.0])
 
   def __post_init__(self):
     assert self.name is not None and len(self.name) > 0
@@ -49,10 +87,14 @@ class UMesh:
   position : list[float]
   rotation : list[float]
   scale : list[float]
-  indices : list[int]
-  vertices : list[list[float]]
-  normals : list[list[float]]
+  indices : np.ndarray   # (n * 3,) triangle indices
+  vertices : np.ndarray  # (n, 3) float32
+  normals : np.ndarray   # (n, 3) float32
+  uvs : np.ndarray = None # (n, 2) float32 texture coordinates, v up
   material : UMaterial = None
+  image : np.ndarray = field(default=None, repr=False) # (h, w, 4) uint8 pixels of the texture of the material, top row first
+  geometry : str = field(default=None, repr=False) # content address of the arrays, computed unless already known (from a snapshot)
+  lods : list["UMesh"] = field(default_factory=list, repr=False) # coarser levels of detail, finest first
 
   def __post_init__(self):
     assert self.name is not None and len(self.name) > 0
@@ -61,6 +103,91 @@ class UMesh:
     assert isinstance(self.scale, list) and len(self.scale) == 3
 
     assert len(self.normals) == len(self.vertices)
+    assert self.uvs is None or len(self.uvs) == len(self.vertices)
+    if self.geometry is not None: return
+
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(np.ascontiguousarray(self.vertices, dtype=np.float32))
+    digest.update(np.ascontiguousarray(self.normals, dtype=np.float32))
+    digest.update(np.ascontiguousarray(self.indices, dtype=np.uint32))
+    if self.uvs is not None: digest.update(np.ascontiguousarray(self.uvs, dtype=np.float32))
+    self.geometry = digest.hexdigest()
+
+  def level(self, level : int) -> "UMesh":
+    """ The mesh at a level of detail, 0 is the full mesh and levels past the coarsest one clamp to it """
+    return self if level == 0 or not self.lods else self.lods[min(level, len(self.lods)) - 1]
+
+  def triangles(self) -> int:
+    return len(self.indices) // 3
+
+  def texture_key(self, textures : dict[str, dict] = {}) -> str | None:
+    """ Key of the TEXTURE the material refers to, textures moves it into an atlas (see UEntity) """
+    if self.material is None or self.material.texture is None: return None
+    return textures.get(self.material.texture, {}).get("texture", self.material.texture)
+
+  def package(self, geometries : dict[str, "UMesh"], textures : dict[str, dict] = {}, primitive : dict = None) -> dict:
+    """ Packages the mesh with a reference to its arrays, the mesh is added to geometries if its arrays are new. With
+    primitive (type and size of a box, sphere or cylinder) the client builds the shape itself and no arrays are referenced """
+    if primitive is None: geometries.setdefault(self.geometry, self)
+    material = self.material
+    if material is not None and material.texture in textures: material = replace(material, **textures[material.texture])
+    data = {
+      "name" : self.name,
+      "position" : self.position,
+      "rotation" : self.rotation,
+      "scale" : self.scale,
+      "material" : material,
+      "geometry" : self.geometry if primitive is None else None,
+    }
+    if primitive is not None: data["primitive"] = primitive
+    return data
+
+  def package_geometry(self, buffer : UBuffer = None, quantized : bool = False) -> dict:
+    """ Packages the arrays as they are or into buffer. Quantized, the vertices are int16 steps of a grid over the bounding
+    box and the normals octahedral int16 pairs, "quantization" holds the grid and the largest errors this introduced """
+    data = { "key" : self.geometry }
+
+    vertices, normals = self.vertices, self.normals
+    if quantized:
+      vertices, origin, step, position_error = quantize_positions(self.vertices)
+      normals, normal_error = encode_octahedral(self.normals)
+      data["quantization"] = { "origin" : origin, "step" : step, "positionError" : position_error, "normalError" : normal_error }
+
+    if buffer is None: # referenced, the serializer writes them
+      data["indices"] = self.indices
+      data["vertices"] = vertices
+      data["normals"] = normals
+      if self.uvs is not None: data["uvs"] = self.uvs
+      return data
+
+    wide = len(self.vertices) > np.iinfo(np.uint16).max
+    data["buffer"] = {
+      "vertexOffset" : buffer.append(vertices, "<i2" if quantized else "<f4"),
+      "normalOffset" : buffer.append(normals, "<i2" if quantized else "<f4"),
+      "indexOffset" : buffer.append(self.indices, "<u4" if wide else "<u2"),
+      "vertexCount" : len(self.vertices),
+      "indexCount" : len(self.indices),
+      "indexFormat" : "UInt32" if wide else "UInt16",
+    }
+    if self.uvs is not None: data["buffer"]["uvOffset"] = buffer.append(self.uvs, "<f4") # float32 uv pairs, also when quantized
+    return data
+
+@dataclass
+class UTexture:
+  """ Image a material refers to by key, encoded (png or jpg) at the size a client asked for """
+  key : str
+  format : str
+  width : int
+  height : int
+  data : bytes | memoryview
+
+  def package(self, buffer : UBuffer = None) -> dict:
+    """ Packages the encoded image as an array or into buffer, from the start of it """
+    data = { "key" : self.key, "format" : self.format, "width" : self.width, "height" : self.height }
+    image = np.frombuffer(self.data, dtype=np.uint8)
+    if buffer is None: data["data"] = image
+    else: data["buffer"] = { "offset" : buffer.append(image, "<u1"), "length" : len(image) }
+    return data
 
 @dataclass(frozen=True)
 class UVisual:
@@ -70,6 +197,8 @@ class UVisual:
   rotation : list[float]
   scale : list[float]
   meshes : list[UMesh]
+  texture : str = None # key of the TEXTURE of the urdf material, for the meshes without one of their own
+  size : list[float] = None # box size, sphere [radius] or cylinder [radius, length] along z of the mesh frame, None for a mesh file
 
   def __post_init__(self):
     assert self.name is not None and len(self.name) > 0
@@ -77,7 +206,61 @@ class UVisual:
     assert isinstance(self.rotation, list) and len(self.rotation) == 3 and isinstance(self.rotation[0], float)
     assert isinstance(self.scale, list) and len(self.scale) == 3 and isinstance(self.scale[0], float)
     assert self.type in UVisualType, f"Visual type {self.type} is not valid"
+
+  def triangles(self, level : int = 0) -> int:
+    return sum(mesh.level(level).triangles() for mesh in self.meshes)
+
+  def texture_keys(self, textures : dict[str, dict] = {}) -> list[str]:
+    """ Keys of the TEXTURE messages the visual refers to """
+    keys = [mesh.texture_key(textures) for mesh in self.meshes] + [self.texture]
+    return [key for key in dict.fromkeys(keys) if key is not None]
+
+  def primitive(self) -> dict | None:
+    """ What a client needs to build the primitive itself, in place of the tessellated mesh """
+    return { "type" : self.type, "size" : self.size } if self.size is not None else None
+
+  def package(self, geometries : dict[str, UMesh], level : int = 0, textures : dict[str, dict] = {}, primitives : bool = False) -> dict:
+    """ With primitives a box, sphere or cylinder is described by its size instead of its tessellation """
+    primitive = self.primitive() if primitives else None
+    return {
+      "name" : self.name,
+      "type" : self.type,
+      "position" : self.position,
+      "rotation" : self.rotation,
+      "scale" : self.scale,
+      "texture" : self.texture,
+      "meshes" : [mesh.level(level).package(geometries, textures, primitive) for mesh in self.meshes]
+    }
   
+@dataclass(frozen=True)
+class UShape:
+  """ Collision shape in the frame of its link. size holds the extents of a box, [radius] of a sphere, [radius, length]
+  of a cylinder along y and the scale of hulls """
+  name : str
+  link : str
+  type : UShapeType
+  position : list[float]
+  rotation : list[float]
+  size : list[float]
+  hulls : list[UMesh] = field(default_factory=list)
+
+  def __post_init__(self):
+    assert self.name is not None and len(self.name) > 0
+    assert isinstance(self.position, list) and len(self.position) == 3 and isinstance(self.position[0], float)
+    assert isinstance(self.rotation, list) and len(self.rotation) == 3 and isinstance(self.rotation[0], float)
+    assert self.type in UShapeType, f"Shape type {self.type} is not valid"
+
+  def package(self, geometries : dict[str, UMesh]) -> dict:
+    return {
+      "name" : self.name,
+      "link" : self.link,
+      "type" : self.type,
+      "position" : self.position,
+      "rotation" : self.rotation,
+      "size" : self.size,
+      "hulls" : [hull.package(geometries) for hull in self.hulls]
+    }
+
 @dataclass(frozen=True)
 class UJoint:
   name : str
@@ -125,18 +308,30 @@ class UEntity:
   joints :  list[UJoint]
   links :   list[ULink]
   visuals : list[UVisual]
+  position : list[float] = field(default_factory=lambda: [0.0, 0.0, 0.0]) # placement of the entity in the scene
+  rotation : list[float] = field(default_factory=lambda: [0.0, 0.0, 0.0])
+  textures : dict[str, dict] = field(default_factory=dict) # texture, textureOffset and textureScale of the material textures packed into an atlas
 
   def __post_init__(self):
     assert self.name is not None and len(self.name) > 0
 
-  def package(self) -> dict:
+  def triangles(self, level : int = 0) -> int:
+    return sum(visual.triangles(level) for visual in self.visuals)
+
+  def texture_keys(self) -> list[str]:
+    """ Keys of the TEXTURE messages the entity refers to, every level of detail shares the materials """
+    return list(dict.fromkeys(key for visual in self.visuals for key in visual.texture_keys(self.textures)))
+
+  def package(self, geometries : dict[str, UMesh], level : int = 0, primitives : bool = False) -> dict:
     return {
       "name" : self.name,
       "startLink" : self.links[0].name,
       "manipulable" : self.manipulable,
-      "joints" :  { joint.name : dataclass_to_dict_rec(joint) for joint in self.joints },
-      "links" :   { link.name  : dataclass_to_dict_rec(link) for link in self.links },
-      "visuals" : { visual.name : dataclass_to_dict_rec(visual) for visual in self.visuals }
+      "position" : self.position,
+      "rotation" : self.rotation,
+      "joints" :  { joint.name : joint for joint in self.joints },
+      "links" :   { link.name  : link for link in self.links },
+      "visuals" : { visual.name : visual.package(geometries, level, self.textures, primitives) for visual in self.visuals }
     }
 
 
@@ -144,8 +339,23 @@ class UEntity:
 class UData():
   entities : list[UEntity] = None
 
-  def package(self) -> list[dict]:
-    return [entity.package() for entity in self.entities]
+  def triangles(self, level : int = 0) -> int:
+    return sum(entity.triangles(level) for entity in self.entities)
+
+  def texture_keys(self) -> list[str]:
+    return list(dict.fromkeys(key for entity in self.entities for key in entity.texture_keys()))
+
+  def package(self, buffer : UBuffer = None, level : int = 0, quantized : bool = False, primitives : bool = False) -> dict:
+    """ Packages all entities at a level of detail, the meshes only reference their arrays which are packaged once per
+    content in geometries. If a buffer is given the arrays are written to it instead of the returned dict. With
+    primitives boxes, spheres and cylinders come as their size and need no arrays.
+    The dict references the dataclasses and arrays instead of copying them, serializer.serialize encodes it """
+    geometries = {}
+    entities = [entity.package(geometries, level, primitives) for entity in self.entities]
+    return {
+      "entities" : entities,
+      "geometries" : { key : mesh.package_geometry(buffer, quantized) for key, mesh in geometries.items() }
+    }
   
 
   
@@ -12,4 +12,28 @@ public class JointController : MonoBehaviour
   public Vector3 axis;
 
   public string type;
+
+  private bool _initialized = false;
+  private Vector3 _initialPosition;
+  private Quaternion _initialRotation;
+
+  // position in radians or meters relative to the pose the joint was spawned in, as sent in UPDATE frames
+  public void SetPosition(float value)
+  {
+    if (!_initialized) {
+      _initialPosition = transform.localPosition;
+      _initialRotation = transform.localRotation;
+      _initialized = true;
+    }
+
+    switch (type) {
+      case "REVOLUTE":
+        // the unity axes are a mirrored version of the urdf ones, which flips the direction of rotation
+        transform.localRotation = _initialRotation * Quaternion.AngleAxis(-value * Mathf.Rad2Deg, axis);
+        break;
+      case "PRISMATIC":
+        transform.localPosition = _initialPosition + _initialRotation * axis * value;
+        break;
+    }
+  }
 }
@@ -1,11 +1,15 @@
 using System;
 using System.Collections.Generic;
+using System.Collections.Concurrent;
 using UnityEngine;
 using Newtonsoft.Json;
+using Newtonsoft.Json.Linq;
 using System.Linq;
 using System.Data;
 using System.IO;
 using System.IO.Compression;
+using System.Runtime.InteropServices;
+using UnityEngine.Rendering;
 
 public class Main : MonoBehaviour
 {
@@ -13,13 +17,66 @@ public class Main : MonoBehaviour
 
     [SerializeField] private WSConnection _connection;
     [SerializeField] private Material _defaultMaterial;
+    [SerializeField] private bool _colliders = false; // ask the server for the collision shapes of every spawned entity
 
     private List<Entity> _entities;
     private List<GameObject> _spawnedEntities = new List<GameObject>();
     private bool loaded = false; // TODO just temp
 
+    // received on worker threads and turned into game objects in Update
+    private ConcurrentQueue<(GeometryData, byte[])> _receivedGeometries = new ConcurrentQueue<(GeometryData, byte[])>();
+    private ConcurrentQueue<(TextureData, byte[])> _receivedTextures = new ConcurrentQueue<(TextureData, byte[])>();
+    private ConcurrentQueue<Entity> _streamedEntities = new ConcurrentQueue<Entity>();
+    private ConcurrentQueue<MeshMessage> _streamedMeshes = new ConcurrentQueue<MeshMessage>();
+    private ConcurrentQueue<EntityDiff> _receivedDiffs = new ConcurrentQueue<EntityDiff>();
+    private ConcurrentQueue<ShapeMessage> _receivedShapes = new ConcurrentQueue<ShapeMessage>();
+    private ConcurrentDictionary<int, JObject> _queryResults = new ConcurrentDictionary<int, JObject>(); // by the id of the query, read as the result type of its command
+    private ConcurrentDictionary<int, ErrorMessage> _queryErrors = new ConcurrentDictionary<int, ErrorMessage>(); // by the id of the query the server could not answer
+
+    private Dictionary<string, Mesh> _geometries = new Dictionary<string, Mesh>(); // shared by every mesh referencing it
+    private Dictionary<string, Texture2D> _textures = new Dictionary<string, Texture2D>(); // shared by every material referencing it
+    private Dictionary<string, List<Material>> _pendingTextures = new Dictionary<string, List<Material>>(); // materials created before their texture arrived
+    private List<MeshMessage> _pendingMeshes = new List<MeshMessage>();
+    private Dictionary<string, GameObject> _visualObjects = new Dictionary<string, GameObject>();
+    private Dictionary<string, Entity> _entityModels = new Dictionary<string, Entity>(); // what is spawned, diffs apply to it
+    private List<EntityDiff> _pendingDiffs = new List<EntityDiff>();
+    private Dictionary<string, GameObject> _linkObjects = new Dictionary<string, GameObject>(); // colliders are attached to the links
+    private Dictionary<string, ShapeMessage> _entityShapes = new Dictionary<string, ShapeMessage>(); // added again when an entity is spawned again
+    private List<ShapeMessage> _pendingShapes = new List<ShapeMessage>();
+    private Mesh _cylinder;
+
+    private List<JointLayout> _jointLayout; // what the indices of the UPDATE frames refer to
+    private Dictionary<string, JointController> _jointControllers = new Dictionary<string, JointController>();
+
     void Update() {
-        if (loaded) spawn_robots("panda_arm_hand");
+        bool spawn = loaded; // read first, the geometries of the DATA are queued before loaded is set
+
+        while (_receivedGeometries.TryDequeue(out var received)) {
+            var (geometry, buffer) = received;
+            _geometries[geometry.Key] = create_mesh(geometry, buffer);
+        }
+
+        while (_receivedTextures.TryDequeue(out var received)) {
+            var (data, buffer) = received;
+            _textures[data.Key] = create_texture(data, buffer);
+            if (!_pendingTextures.Remove(data.Key, out List<Material> materials)) continue;
+            foreach (Material material in materials.Where(material => material != null)) material.mainTexture = _textures[data.Key];
+        }
+
+        if (spawn) spawn_robots("panda_arm_hand");
+
+        while (_streamedEntities.TryDequeue(out Entity entity)) spawn_entity(entity);
+
+        // the callbacks run in any order, so a MESH can arrive before its ENTITY or GEOMETRY and has to wait
+        while (_streamedMeshes.TryDequeue(out MeshMessage message)) _pendingMeshes.Add(message);
+        _pendingMeshes.RemoveAll(pending => try_create_meshes(pending));
+
+        // diffs build on each other, so they are applied in order once their geometries arrived
+        while (_receivedDiffs.TryDequeue(out EntityDiff diff)) _pendingDiffs.Add(diff);
+        while (_pendingDiffs.Count > 0 && try_apply_diff(_pendingDiffs[0])) _pendingDiffs.RemoveAt(0);
+
+        while (_receivedShapes.TryDequeue(out ShapeMessage shapes)) _pendingShapes.Add(shapes);
+        _pendingShapes.RemoveAll(pending => try_create_colliders(pending));
     }
 
 
@@ -27,51 +84,265 @@ public class Main : MonoBehaviour
     void Start()
     {
         _connection.subscribe("DATA", process_entity);
+        _connection.subscribe("ENTITY", process_streamed_entity);
+        _connection.subscribe("MESH", process_streamed_mesh);
+        _connection.subscribe("GEOMETRY", process_geometry);
+        _connection.subscribe("TEXTURE", process_texture);
+        _connection.subscribe("DIFF", process_diff);
+        _connection.subscribe("SHAPE", process_shapes);
+        _connection.subscribe("RESULT", process_result);
+        _connection.subscribe("ERR", process_error);
+        _connection.subscribe("JOINTS", (data, buffer) => _jointLayout = JsonConvert.DeserializeObject<List<JointLayout>>(data));
+        _connection.subscribeBinary("UPDATE", apply_update);
     }
 
 
 
-    void process_entity(string data)
+    void process_entity(string data, byte[] buffer)
     {
         try {
-            _entities = JsonConvert.DeserializeObject<List<Entity>>(data);
+            var package = JsonConvert.DeserializeObject<Package>(data);
+            foreach (var geometry in package.Geometries.Values) _receivedGeometries.Enqueue((geometry, buffer));
+            _entities = package.Entities;
             _connection.Send(MessageType.MSG, "Model loaded sucessfully");
             loaded = true;
         }  catch (Exception ex) { Error(ex.Message); }
         
     }
 
-    Mesh create_mesh(MeshData data) {
-        
+    void process_streamed_entity(string data, byte[] buffer)
+    {
+        try {
+            _streamedEntities.Enqueue(JsonConvert.DeserializeObject<Entity>(data));
+        }  catch (Exception ex) { Error(ex.Message); }
+    }
+
+    void process_streamed_mesh(string data, byte[] buffer)
+    {
+        try {
+            _streamedMeshes.Enqueue(JsonConvert.DeserializeObject<MeshMessage>(data));
+        }  catch (Exception ex) { Error(ex.Message); }
+    }
+
+    void process_geometry(string data, byte[] buffer)
+    {
+        try {
+            _receivedGeometries.Enqueue((JsonConvert.DeserializeObject<GeometryData>(data), buffer));
+        }  catch (Exception ex) { Error(ex.Message); }
+    }
+
+    void process_texture(string data, byte[] buffer)
+    {
+        try {
+            _receivedTextures.Enqueue((JsonConvert.DeserializeObject<TextureData>(data), buffer));
+        }  catch (Exception ex) { Error(ex.Message); }
+    }
+
+    void process_diff(string data, byte[] buffer)
+    {
+        try {
+            _receivedDiffs.Enqueue(JsonConvert.DeserializeObject<EntityDiff>(data));
+        }  catch (Exception ex) { Error(ex.Message); }
+    }
+
+    void process_shapes(string data, byte[] buffer)
+    {
+        try {
+            _receivedShapes.Enqueue(JsonConvert.DeserializeObject<ShapeMessage>(data));
+        }  catch (Exception ex) { Error(ex.Message); }
+    }
+
+    void process_result(string data, byte[] buffer)
+    {
+        try {
+            var result = JObject.Parse(data);
+            _queryResults[(int)result["id"]] = result;
+        }  catch (Exception ex) { Error(ex.Message); }
+    }
+
+    void process_error(string data, byte[] buffer)
+    {
+        try {
+            var error = JsonConvert.DeserializeObject<ErrorMessage>(data);
+            if (error.Id is int id) _queryErrors[id] = error;
+            Debug.LogWarning($"Server could not handle {error.Message} {error.Command}: {error.Error}");
+        }  catch (Exception ex) { Debug.LogError(ex.Message); }
+    }
+
+    void apply_update(byte[] frame)
+    {
+        var layout = _jointLayout;
+        if (layout == null) return;
+
+        // uint32 tick, uint16 entity count, per entity uint16 index, uint16 joint count, the joint indices and float32 positions.
+        // The tick wraps around to 0 after uint.MaxValue, compare ticks with unchecked (int)(a - b) instead of a < b
+        using var reader = new BinaryReader(new MemoryStream(frame)); // little endian, as sent
+        reader.ReadUInt32();
+        int entities = reader.ReadUInt16();
+        for (int e = 0; e < entities; e++) {
+            var entity = layout[reader.ReadUInt16()];
+            var joints = new ushort[reader.ReadUInt16()];
+            for (int i = 0; i < joints.Length; i++) joints[i] = reader.ReadUInt16();
+
+            for (int i = 0; i < joints.Length; i++) {
+                float value = reader.ReadSingle();
+                if (_jointControllers.TryGetValue($"{entity.Entity}/{entity.Joints[joints[i]]}", out var controller) && controller != null) controller.SetPosition(value);
+            }
+        }
+    }
 
+    Mesh create_mesh(GeometryData data, byte[] buffer) {
         
+        if (data.Buffer != null) return create_mesh(data.Buffer, buffer, data.Quantization);
+        
+        Quantization q = data.Quantization;
         var mesh =  new Mesh
         {
-            vertices = data.Vertices.Select(v => new Vector3(v[0], v[1], v[2])).ToArray(),
-            normals = data.Normals.Select(v => new Vector3(v[0], v[1], v[2])).ToArray(),
+            vertices = data.Vertices.Select(v => q == null ? new Vector3(v[0], v[1], v[2]) : decode_position(q, v[0], v[1], v[2])).ToArray(),
+            normals = data.Normals.Select(v => q == null ? new Vector3(v[0], v[1], v[2]) : decode_normal(v[0], v[1])).ToArray(),
             triangles = data.Indices
         };
+        if (data.Uvs != null) mesh.uv = data.Uvs.Select(uv => new Vector2(uv[0], uv[1])).ToArray();
 
         mesh.Optimize();  
 
         return mesh;
     }
 
+    Mesh create_mesh(MeshBuffer buffer, byte[] data, Quantization q) {
+
+        // the buffer layout matches Vector3 and the index formats, so the arrays are reinterpreted without parsing
+        var bytes = new ReadOnlySpan<byte>(data);
+        var mesh = new Mesh();
+
+        if (q == null) {
+            mesh.SetVertices(MemoryMarshal.Cast<byte, Vector3>(bytes.Slice(buffer.VertexOffset, buffer.VertexCount * 12)).ToArray());
+            mesh.SetNormals(MemoryMarshal.Cast<byte, Vector3>(bytes.Slice(buffer.NormalOffset, buffer.VertexCount * 12)).ToArray());
+        } else {
+            var positions = MemoryMarshal.Cast<byte, short>(bytes.Slice(buffer.VertexOffset, buffer.VertexCount * 6));
+            var codes = MemoryMarshal.Cast<byte, short>(bytes.Slice(buffer.NormalOffset, buffer.VertexCount * 4));
+            var vertices = new Vector3[buffer.VertexCount];
+            var normals = new Vector3[buffer.VertexCount];
+            for (int i = 0; i < buffer.VertexCount; i++) {
+                vertices[i] = decode_position(q, positions[3 * i], positions[3 * i + 1], positions[3 * i + 2]);
+                normals[i] = decode_normal(codes[2 * i], codes[2 * i + 1]);
+            }
+            mesh.SetVertices(vertices);
+            mesh.SetNormals(normals);
+        }
+
+        if (buffer.UvOffset is int uvOffset) mesh.SetUVs(0, MemoryMarshal.Cast<byte, Vector2>(bytes.Slice(uvOffset, buffer.VertexCount * 8)).ToArray());
+
+        if (buffer.IndexFormat == "UInt32") {
+            mesh.indexFormat = IndexFormat.UInt32;
+            mesh.SetIndices(MemoryMarshal.Cast<byte, int>(bytes.Slice(buffer.IndexOffset, buffer.IndexCount * 4)).ToArray(), MeshTopology.Triangles, 0);
+        } else {
+            mesh.SetIndices(MemoryMarshal.Cast<byte, ushort>(bytes.Slice(buffer.IndexOffset, buffer.IndexCount * 2)).ToArray(), MeshTopology.Triangles, 0);
+        }
+
+        mesh.Optimize();
+
+        return mesh;
+    }
+
 
-    void create_visual(GameObject parent, Visual visual) {
+    // png or jpg, decoded by unity whatever the format
+    Texture2D create_texture(TextureData data, byte[] buffer) {
+
+        byte[] image = data.Data;
+        if (data.Buffer != null) {
+            image = new byte[data.Buffer.Length];
+            System.Buffer.BlockCopy(buffer, data.Buffer.Offset, image, 0, data.Buffer.Length);
+        }
+
+        var texture = new Texture2D(2, 2) { name = data.Key };
+        if (!texture.LoadImage(image)) Error($"Texture {data.Key} ({data.Format}) could not be decoded");
+        return texture;
+    }
+
+    static Vector3 decode_position(Quantization q, float x, float y, float z) {
+        return new Vector3(q.Origin[0] + x * q.Step[0], q.Origin[1] + y * q.Step[1], q.Origin[2] + z * q.Step[2]);
+    }
+
+    // inverse of the octahedral encoding, the lower half of the sphere is folded over the diagonals
+    static Vector3 decode_normal(float codeX, float codeY) {
+        float x = codeX / short.MaxValue, y = codeY / short.MaxValue;
+        float z = 1 - Mathf.Abs(x) - Mathf.Abs(y);
+        float fold = Mathf.Max(-z, 0);
+        x -= x >= 0 ? fold : -fold;
+        y -= y >= 0 ? fold : -fold;
+        return new Vector3(x, y, z).normalized;
+    }
+
+    void create_visual(GameObject parent, Visual visual, Entity entity) {
 
         GameObject visuals = new GameObject("Visuals");
         visuals.transform.SetParent(parent.transform);
+        _visualObjects[$"{entity.Name}/{visual.Name}"] = visuals; // streamed meshes are attached later
+
+        create_meshes(visuals, visual.Meshes, visual.Texture);
         
+        visuals.transform.localPosition = new Vector3(visual.Position[0], visual.Position[1],visual.Position[2]);
+        visuals.transform.localEulerAngles = new Vector3(visual.Rotation[0], visual.Rotation[1], visual.Rotation[2]) * Mathf.Rad2Deg;      
+    }
+
+    bool try_create_meshes(MeshMessage message) {
+
+        if (!_visualObjects.TryGetValue($"{message.Entity}/{message.Visual}", out GameObject visuals)) return false;
+        if (message.Meshes.Any(missing_geometry)) return false;
+
+        foreach (Transform child in visuals.transform) Destroy(child.gameObject); // a new level of detail replaces the old meshes
+        Visual visual = null;
+        if (_entityModels.TryGetValue(message.Entity, out Entity entity) && entity.Visuals.TryGetValue(message.Visual, out visual)) visual.Meshes = message.Meshes;
+        create_meshes(visuals, message.Meshes, visual?.Texture);
+        return true;
+    }
+
+    bool try_apply_diff(EntityDiff diff) {
+
+        if (!_entityModels.TryGetValue(diff.Entity, out Entity entity)) return false;
+        var visuals = diff.Visuals.Added.Values.Concat(diff.Visuals.Changed.Values).ToList();
+        if (visuals.Any(visual => visual.Meshes.Any(missing_geometry))) return false;
+
+        entity.StartLink = diff.StartLink;
+        apply_items(entity.Links, diff.Links);
+        apply_items(entity.Joints, diff.Joints);
+        apply_items(entity.Visuals, diff.Visuals);
+
+        // a changed hierarchy is spawned again, changed visuals alone are replaced in place
+        if (diff.Links.Changed.Count + diff.Links.Added.Count + diff.Links.Removed.Count > 0 || diff.Joints.Changed.Count + diff.Joints.Added.Count + diff.Joints.Removed.Count > 0 || diff.Visuals.Added.Count + diff.Visuals.Removed.Count > 0) {
+            spawn_entity(entity);
+            return true;
+        }
+
+        foreach (Visual visual in visuals) {
+            if (!_visualObjects.TryGetValue($"{entity.Name}/{visual.Name}", out GameObject obj)) continue;
+            foreach (Transform child in obj.transform) Destroy(child.gameObject);
+            create_meshes(obj, visual.Meshes, visual.Texture);
+            obj.transform.localPosition = new Vector3(visual.Position[0], visual.Position[1], visual.Position[2]);
+            obj.transform.localEulerAngles = new Vector3(visual.Rotation[0], visual.Rotation[1], visual.Rotation[2]) * Mathf.Rad2Deg;
+        }
+        return true;
+    }
 
-        for (int i = 0; i < visual.Meshes.Count; i++) {
-            MeshData mesh = visual.Meshes[i];
+    bool missing_geometry(MeshData mesh) => mesh.Geometry != null && !_geometries.ContainsKey(mesh.Geometry);
+
+    static void apply_items<T>(Dictionary<string, T> items, ItemDiff<T> diff) {
+        foreach (var item in diff.Added.Concat(diff.Changed)) items[item.Key] = item.Value;
+        foreach (string name in diff.Removed) items.Remove(name);
+    }
+
+    // texture is the one of the visual, for the meshes whose material has none
+    void create_meshes(GameObject visuals, List<MeshData> meshes, string texture = null) {
+
+        for (int i = 0; i < meshes.Count; i++) {
+            MeshData mesh = meshes[i];
 
             GameObject obj = new GameObject(mesh.Name);
 
 
-            var renderer = obj.AddComponent<MeshRenderer>();
-            obj.AddComponent<MeshFilter>().mesh = create_mesh(mesh); 
+            MeshRenderer renderer = mesh.Primitive != null ? create_primitive(obj, mesh.Primitive) : obj.AddComponent<MeshRenderer>();
+            if (mesh.Primitive == null) obj.AddComponent<MeshFilter>().sharedMesh = _geometries[mesh.Geometry]; 
 
             if (mesh.Material != null) {
                 Material mat = new Material(Shader.Find("Standard"));
@@ -79,6 +350,19 @@ public class Main : MonoBehaviour
                 mat.SetColor("_Color",new Color(mesh.Material.Diffuse[0] / 255, mesh.Material.Diffuse[1] / 255, mesh.Material.Diffuse[2] / 255, mesh.Material.Diffuse[3] / 255));
                 mat.SetColor("_SpecColor", new Color(mesh.Material.Specular[0] / 255, mesh.Material.Specular[1] / 255, mesh.Material.Specular[2] / 255, mesh.Material.Specular[3] / 255));
                 mat.SetColor("_EmissionColor", new Color(mesh.Material.Ambient[0] / 255, mesh.Material.Ambient[1] / 255, mesh.Material.Ambient[2] / 255, mesh.Material.Ambient[3] / 255));
+
+                string key = mesh.Material.Texture ?? texture;
+                if (key != null) {
+                    if (mesh.Material.Texture != null) {
+                        mat.mainTextureOffset = new Vector2(mesh.Material.TextureOffset[0], mesh.Material.TextureOffset[1]);
+                        mat.mainTextureScale = new Vector2(mesh.Material.TextureScale[0], mesh.Material.TextureScale[1]);
+                    }
+                    if (_textures.TryGetValue(key, out Texture2D loaded)) mat.mainTexture = loaded;
+                    else {
+                        if (!_pendingTextures.TryGetValue(key, out List<Material> pending)) _pendingTextures[key] = pending = new List<Material>();
+                        pending.Add(mat);
+                    }
+                }
                 
                 renderer.material = mat;
             }
@@ -87,20 +371,116 @@ public class Main : MonoBehaviour
             obj.transform.localPosition = new Vector3(mesh.Position[0], mesh.Position[1], mesh.Position[2]);
             obj.transform.localEulerAngles = new Vector3(mesh.Rotation[0], mesh.Rotation[1], mesh.Rotation[2])  * Mathf.Rad2Deg;
 
-            obj.transform.SetParent(visuals.transform);
+            obj.transform.SetParent(visuals.transform, false);
         }
+    }
+    // a unity primitive under obj sized like the urdf one, the unity cylinder has height 2 along y instead of z
+    MeshRenderer create_primitive(GameObject obj, PrimitiveData primitive) {
+
+        PrimitiveType type = primitive.Type switch { "BOX" => PrimitiveType.Cube, "SPHERE" => PrimitiveType.Sphere, _ => PrimitiveType.Cylinder };
+        GameObject shape = GameObject.CreatePrimitive(type);
+        Destroy(shape.GetComponent<Collider>()); // the colliders come as SHAPE
+        shape.transform.SetParent(obj.transform, false);
+
+        switch (primitive.Type) {
+            case "BOX":
+                shape.transform.localScale = new Vector3(primitive.Size[0], primitive.Size[1], primitive.Size[2]);
+                break;
+            case "SPHERE":
+                shape.transform.localScale = Vector3.one * 2 * primitive.Size[0];
+                break;
+            default:
+                shape.transform.localEulerAngles = new Vector3(90, 0, 0);
+                shape.transform.localScale = new Vector3(2 * primitive.Size[0], primitive.Size[1] / 2, 2 * primitive.Size[0]);
+                break;
+        }
+        return shape.GetComponent<MeshRenderer>();
+    }
 
-        
-        visuals.transform.localPosition = new Vector3(visual.Position[0], visual.Position[1],visual.Position[2]);
-        visuals.transform.localEulerAngles = new Vector3(visual.Rotation[0], visual.Rotation[1], visual.Rotation[2]) * Mathf.Rad2Deg;      
+    bool try_create_colliders(ShapeMessage message) {
+
+        if (!_entityModels.ContainsKey(message.Entity)) return false;
+        if (message.Shapes.Any(shape => shape.Hulls.Any(hull => !_geometries.ContainsKey(hull.Geometry)))) return false;
+        _entityShapes[message.Entity] = message;
+
+        // a new message replaces the shapes of the entity
+        var collisionObjects = new Dictionary<string, GameObject>();
+        foreach (var link in _linkObjects.Where(item => item.Key.StartsWith($"{message.Entity}/") && item.Value != null)) {
+            var old = link.Value.transform.Find("Collision");
+            if (old != null) Destroy(old.gameObject);
+        }
+
+        foreach (Shape shape in message.Shapes) {
+            if (!_linkObjects.TryGetValue($"{message.Entity}/{shape.Link}", out GameObject link) || link == null) continue;
+
+            if (!collisionObjects.TryGetValue(shape.Link, out GameObject collisions)) {
+                collisions = new GameObject("Collision");
+                collisions.transform.SetParent(link.transform, false);
+                collisionObjects[shape.Link] = collisions;
+            }
+
+            GameObject obj = new GameObject(shape.Name);
+            obj.transform.SetParent(collisions.transform, false);
+            obj.transform.localPosition = new Vector3(shape.Position[0], shape.Position[1], shape.Position[2]);
+            obj.transform.localEulerAngles = new Vector3(shape.Rotation[0], shape.Rotation[1], shape.Rotation[2]) * Mathf.Rad2Deg;
+
+            switch (shape.Type) {
+                case "BOX":
+                    obj.AddComponent<BoxCollider>().size = new Vector3(shape.Size[0], shape.Size[1], shape.Size[2]);
+                    break;
+                case "SPHERE":
+                    obj.AddComponent<SphereCollider>().radius = shape.Size[0];
+                    break;
+                case "CYLINDER": // unity has no cylinder collider, a convex mesh scaled to radius and length does
+                    obj.transform.localScale = new Vector3(2 * shape.Size[0], shape.Size[1], 2 * shape.Size[0]);
+                    var cylinder = obj.AddComponent<MeshCollider>();
+                    cylinder.sharedMesh = cylinder_mesh();
+                    cylinder.convex = true;
+                    break;
+                case "HULLS":
+                    obj.transform.localScale = new Vector3(shape.Size[0], shape.Size[1], shape.Size[2]);
+                    foreach (MeshData hull in shape.Hulls) {
+                        GameObject hullObj = new GameObject(hull.Name);
+                        hullObj.transform.SetParent(obj.transform, false);
+                        var collider = hullObj.AddComponent<MeshCollider>();
+                        collider.sharedMesh = _geometries[hull.Geometry];
+                        collider.convex = true;
+                    }
+                    break;
+            }
+        }
+        return true;
     }
+
+    // unit cylinder along y (diameter and height 1) with 16 sides, built once
+    Mesh cylinder_mesh() {
+        if (_cylinder != null) return _cylinder;
+
+        const int sides = 16;
+        var vertices = new Vector3[2 * sides];
+        var triangles = new List<int>();
+        for (int i = 0; i < sides; i++) {
+            float angle = 2 * Mathf.PI * i / sides;
+            vertices[i] = new Vector3(0.5f * Mathf.Cos(angle), -0.5f, 0.5f * Mathf.Sin(angle));
+            vertices[sides + i] = new Vector3(vertices[i].x, 0.5f, vertices[i].z);
+            int next = (i + 1) % sides;
+            triangles.AddRange(new[] { i, sides + i, next, next, sides + i, sides + next });
+            if (i > 0 && next > 0) triangles.AddRange(new[] { 0, i, next, sides, sides + next, sides + i }); // the caps as fans
+        }
+
+        _cylinder = new Mesh { vertices = vertices, triangles = triangles.ToArray() };
+        _cylinder.RecalculateNormals();
+        return _cylinder;
+    }
+
     GameObject create_link(GameObject parent, Link link, Entity entity) {
 
         GameObject jointObj = new GameObject(link.Name);
         jointObj.transform.SetParent(parent.transform);
+        _linkObjects[$"{entity.Name}/{link.Name}"] = jointObj;
 
         if (!string.IsNullOrEmpty(link.VisualName)) {
-            create_visual(jointObj, entity.Visuals[link.VisualName]); 
+            create_visual(jointObj, entity.Visuals[link.VisualName], entity); 
         }
 
         var joints = entity.Joints.Values.Where(joint => joint.ParentLink == link.Name);
@@ -127,10 +507,21 @@ public class Main : MonoBehaviour
         controller.minRot = joint.MinRot * Mathf.Rad2Deg;
         controller.axis = new Vector3(joint.Axis[0], joint.Axis[1], joint.Axis[2]);
         controller.type = joint.Type;
+        _jointControllers[$"{entity.Name}/{joint.Name}"] = controller;
 
         return linkObj;
     }
 
+    GameObject create_entity(Entity entity) {
+
+        GameObject entityObj = new GameObject(entity.Name);
+        create_link(entityObj, entity.Links[entity.StartLink], entity);
+
+        if (entity.Position != null) entityObj.transform.localPosition = new Vector3(entity.Position[0], entity.Position[1], entity.Position[2]);
+        if (entity.Rotation != null) entityObj.transform.localEulerAngles = new Vector3(entity.Rotation[0], entity.Rotation[1], entity.Rotation[2]) * Mathf.Rad2Deg;
+        return entityObj;
+    }
+
     void spawn_robots(string name) {
 
       loaded = false;
@@ -141,14 +532,82 @@ public class Main : MonoBehaviour
       try {
         foreach (Entity robot in _entities) {
 
-            GameObject robotObj = new GameObject(robot.Name);
-            create_link(robotObj, robot.Links[robot.StartLink], robot);
-            _spawnedEntities.Add(robotObj);
+            _entityModels[robot.Name] = robot;
+            _spawnedEntities.Add(create_entity(robot));
+            add_colliders(robot.Name);
         }
       } catch (Exception ex) { Error(ex.Message); }
         
     }
 
+    void spawn_entity(Entity entity) {
+
+      // a streamed entity replaces the one with the same name, its meshes follow as MESH messages
+      foreach (var robot in _spawnedEntities.Where(robot => robot.name == entity.Name).ToList()) {
+        Destroy(robot);
+        _spawnedEntities.Remove(robot);
+      }
+
+      try {
+        _entityModels[entity.Name] = entity;
+        _spawnedEntities.Add(create_entity(entity));
+      } catch (Exception ex) { Error(ex.Message); }
+
+      add_colliders(entity.Name);
+    }
+
+    // the colliders of a spawned entity, the ones received before or asked for once
+    void add_colliders(string entity) {
+        if (_entityShapes.TryGetValue(entity, out ShapeMessage shapes)) _pendingShapes.Add(shapes);
+        else if (_colliders) request_collision(entity);
+    }
+
+    // asks the server for a visual of an entity at another level of detail, 0 is full detail, it arrives as MESH
+    public void request_lod(string entity, string visual, int level) {
+        _connection.Send(MessageType.CMD, JsonConvert.SerializeObject(new { command = "lod", entity, visual, level }));
+    }
+
+    // asks the server for the collision shapes of an entity, or of every entity without one, they arrive as SHAPE
+    public void request_collision(string entity = null) {
+        _connection.Send(MessageType.CMD, entity == null ? JsonConvert.SerializeObject(new { command = "collision" }) : JsonConvert.SerializeObject(new { command = "collision", entity }));
+    }
+
+    // casts rays against the links of every entity, the answer is taken with try_get_result<QueryResult>(id)
+    public void raycast(int id, Vector3[] origins, Vector3[] directions, float maxDistance = float.PositiveInfinity) {
+        var command = new Dictionary<string, object> { ["command"] = "raycast", ["id"] = id, ["origins"] = points(origins), ["directions"] = points(directions) };
+        if (!float.IsPositiveInfinity(maxDistance)) command["max_distance"] = maxDistance;
+        _connection.Send(MessageType.CMD, JsonConvert.SerializeObject(command));
+    }
+
+    // the closest points on the links of every entity, the answer is taken with try_get_result<QueryResult>(id)
+    public void nearest(int id, Vector3[] positions, float maxDistance = float.PositiveInfinity) {
+        var command = new Dictionary<string, object> { ["command"] = "nearest", ["id"] = id, ["points"] = points(positions) };
+        if (!float.IsPositiveInfinity(maxDistance)) command["max_distance"] = maxDistance;
+        _connection.Send(MessageType.CMD, JsonConvert.SerializeObject(command));
+    }
+
+    // solves the joint positions of an entity that bring link to every target, the answer is taken with try_get_result<IKResult>(id).
+    // apply moves the entity to the solution of the last target, so dragging a target moves the robot
+    public void solve_ik(int id, string entity, string link, Vector3[] targets, Quaternion[] rotations = null, bool apply = false) {
+        var command = new Dictionary<string, object> { ["command"] = "ik", ["id"] = id, ["entity"] = entity, ["link"] = link, ["targets"] = points(targets), ["apply"] = apply };
+        if (rotations != null) command["rotations"] = rotations.Select(rotation => new float[] { rotation.x, rotation.y, rotation.z, rotation.w }).ToArray();
+        _connection.Send(MessageType.CMD, JsonConvert.SerializeObject(command));
+    }
+
+    public bool try_get_result<T>(int id, out T result) {
+        result = default;
+        if (!_queryResults.TryRemove(id, out JObject json)) return false;
+        result = json.ToObject<T>();
+        return true;
+    }
+
+    // why the server could not answer the query with id, the result for it never arrives then
+    public bool try_get_error(int id, out ErrorMessage error) => _queryErrors.TryRemove(id, out error);
+
+    static float[][] points(Vector3[] vectors) {
+        return vectors.Select(vector => new float[] { vector.x, vector.y, vector.z }).ToArray(); // Vector3 itself does not serialize
+    }
+
     private void Error(string message) {
         if (_connection != null) _connection.Send(MessageType.ERR, message);
         Debug.LogError(message);
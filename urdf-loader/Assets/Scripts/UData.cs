@@ -9,11 +9,63 @@ public class MeshData
     public List<float> Rotation { get; set; }
     public List<float> Scale { get; set; }
 
+    public List<float> Color { get; set; }
+    public MatData Material {get; set; } 
+
+    // key of the GeometryData holding the arrays, meshes with the same content share it, null for a primitive
+    public string Geometry { get; set; }
+
+    public PrimitiveData Primitive { get; set; } // set instead of Geometry when the client asked for native primitives
+}
+
+[Serializable]
+public class PrimitiveData
+{
+    // shape built by the client in the frame of the mesh, Size is the box size, [radius] of a sphere or [radius, length]
+    // of a cylinder along z
+    public string Type { get; set; } // "BOX", "SPHERE" or "CYLINDER"
+    public List<float> Size { get; set; }
+}
+
+[Serializable]
+public class GeometryData
+{
+    public string Key { get; set; }
     public int[] Indices { get; set; }
     public List<List<float>> Vertices { get; set; }
     public List<List<float>> Normals { get; set; }
-    public List<float> Color { get; set; }
-    public MatData Material {get; set; } 
+    public List<List<float>> Uvs { get; set; } // null for meshes without a texture
+
+    // set instead of Indices, Vertices and Normals when the server sends binary meshes
+    public MeshBuffer Buffer { get; set; }
+
+    // set when vertices are int16 steps of a grid and normals octahedral int16 pairs, in json and in the buffer
+    public Quantization Quantization { get; set; }
+}
+
+[Serializable]
+public class Quantization
+{
+    // vertex = Origin + q * Step
+    public float[] Origin { get; set; }
+    public float[] Step { get; set; }
+
+    // largest distance (meters) and angle (radians) a decoded vertex or normal is off
+    public float PositionError { get; set; }
+    public float NormalError { get; set; }
+}
+
+[Serializable]
+public class MeshBuffer
+{
+    // byte offsets into the received BUFFER, vertices and normals are packed little endian float32 xyz (see Quantization for int16)
+    public int VertexOffset { get; set; }
+    public int NormalOffset { get; set; }
+    public int IndexOffset { get; set; }
+    public int? UvOffset { get; set; } // float32 uv pairs, null for meshes without a texture
+    public int VertexCount { get; set; }
+    public int IndexCount { get; set; }
+    public string IndexFormat { get; set; } // "UInt16" or "UInt32"
 }
 
 [Serializable]
@@ -25,6 +77,30 @@ public class MatData
     public List<float> Ambient{ get; set;}
     
     public List<float> Diffuse{ get; set;}
+
+    // key of the TextureData of the diffuse map, uvs map into it as uv * TextureScale + TextureOffset (a region of an atlas)
+    public string Texture { get; set; }
+    public List<float> TextureOffset { get; set; }
+    public List<float> TextureScale { get; set; }
+}
+
+[Serializable]
+public class TextureData
+{
+    // encoded image ("png" or "jpg") that materials refer to by Key, sent once per connection before them
+    public string Key { get; set; }
+    public string Format { get; set; }
+    public int Width { get; set; }
+    public int Height { get; set; }
+    public byte[] Data { get; set; }
+    public TextureBuffer Buffer { get; set; } // set instead of Data when the image is in the received BUFFER
+}
+
+[Serializable]
+public class TextureBuffer
+{
+    public int Offset { get; set; }
+    public int Length { get; set; }
 }
 
 [Serializable]
@@ -41,6 +117,7 @@ public class Visual
 
     public List<MeshData> Meshes { get; set; }
 
+    public string Texture { get; set; } // key of the TextureData of the urdf material, for meshes without one of their own
 }
 
 
@@ -70,11 +147,20 @@ public class Link
     public List<float> Rotation { get; set; }
 }
 
+[Serializable]
+public class Package
+{
+    public List<Entity> Entities { get; set; }
+    public Dictionary<string, GeometryData> Geometries { get; set; }
+}
+
 [Serializable]
 public class Entity
 {
     public string Name { get; set; }
     public bool Manipulable { get; set; }
+    public List<float> Position { get; set; } // placement in the scene
+    public List<float> Rotation { get; set; }
 
     public string StartLink { get; set; }
     public Dictionary<string, Joint> Joints { get; set; }
@@ -82,4 +168,105 @@ public class Entity
     public Dictionary<string, Link> Links { get; set; }
 
     public Dictionary<string, Visual> Visuals { get; set; } 
-}
\ No newline at end of file
+}
+
+[Serializable]
+public class MeshMessage
+{
+    // meshes of one visual, streamed after the entity itself
+    public string Entity { get; set; }
+    public string Visual { get; set; }
+    public List<MeshData> Meshes { get; set; }
+}
+
+[Serializable]
+public class Shape
+{
+    // collision shape in the frame of its link, Size is the box extents, [radius] of a sphere, [radius, length] of a
+    // cylinder along y or the scale of the hulls
+    public string Name { get; set; }
+    public string Link { get; set; }
+    public string Type { get; set; } // "BOX", "SPHERE", "CYLINDER" or "HULLS"
+    public List<float> Position { get; set; }
+    public List<float> Rotation { get; set; }
+    public List<float> Size { get; set; }
+    public List<MeshData> Hulls { get; set; } // convex, their geometries are sent as GEOMETRY before
+}
+
+[Serializable]
+public class ShapeMessage
+{
+    public string Entity { get; set; }
+    public List<Shape> Shapes { get; set; }
+}
+
+[Serializable]
+public class QueryLink
+{
+    public string Entity { get; set; }
+    public string Link { get; set; }
+}
+
+[Serializable]
+public class QueryResult
+{
+    // answer to a raycast or nearest CMD, Link indexes Links, -1 (and Distance -1) where nothing was hit or near enough
+    public int Id { get; set; }
+    public string Command { get; set; }
+    public List<QueryLink> Links { get; set; }
+    public int[] Link { get; set; }
+    public float[] Distance { get; set; }
+    public float[][] Point { get; set; }
+    public float[][] Normal { get; set; } // raycast only, facing the ray
+}
+
+[Serializable]
+public class ErrorMessage
+{
+    // answer to a message the server could not handle, Id and Command are those of the CMD (null for other messages)
+    public int? Id { get; set; }
+    public string Command { get; set; }
+    public string Message { get; set; } // type of the message, e.g. "CMD" or "UPDATE"
+    public string Error { get; set; }
+}
+
+[Serializable]
+public class IKResult
+{
+    // answer to an ik CMD, the joint positions reaching every target, Converged is false where they only got closest
+    public int Id { get; set; }
+    public string Command { get; set; }
+    public string Entity { get; set; }
+    public List<string> Joints { get; set; }
+    public float[][] Positions { get; set; }
+    public float[] PositionError { get; set; }
+    public float[] RotationError { get; set; }
+    public bool[] Converged { get; set; }
+}
+
+[Serializable]
+public class JointLayout
+{
+    // the joints of an entity in the order UPDATE frames index them
+    public string Entity { get; set; }
+    public List<string> Joints { get; set; }
+}
+
+[Serializable]
+public class ItemDiff<T>
+{
+    public Dictionary<string, T> Added { get; set; }
+    public Dictionary<string, T> Changed { get; set; }
+    public List<string> Removed { get; set; }
+}
+
+[Serializable]
+public class EntityDiff
+{
+    // what changed in an entity after the server reloaded its files, visuals reference geometries sent before
+    public string Entity { get; set; }
+    public string StartLink { get; set; }
+    public ItemDiff<Link> Links { get; set; }
+    public ItemDiff<Joint> Joints { get; set; }
+    public ItemDiff<Visual> Visuals { get; set; }
+}
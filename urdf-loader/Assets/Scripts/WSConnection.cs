@@ -1,4 +1,7 @@
+using System;
 using System.Collections.Generic;
+using System.IO;
+using System.IO.Compression;
 using UnityEngine;
 using NativeWebSocket;
 using System.Net;
@@ -12,7 +15,6 @@ public enum MessageType
 {
     CMD,
     MSG,
-    DAT,
     ERR
 }
 
@@ -29,18 +31,47 @@ public class WSConnection : MonoBehaviour
     }
 
 
-    public delegate void Subscriber(string message);
+    // buffer is the BUFFER received right before the message, null if there was none
+    public delegate void Subscriber(string message, byte[] buffer);
+    public delegate void BinarySubscriber(byte[] data);
 
     public int port;
+    public int triangleBudget = 0; // asks the server for meshes of at most this many triangles, 0 for full detail
+    public bool compression = true; // asks the server to deflate large messages, worth it over wifi
+    public int textureSize = 0; // asks the server for textures of at most this many pixels on a side, 0 for its largest
+    public bool nativePrimitives = true; // asks the server for boxes, spheres and cylinders by their size instead of as meshes
 
     private Dictionary<string, Subscriber> subscribers = new Dictionary<string, Subscriber>();
+    private Dictionary<string, BinarySubscriber> binarySubscribers = new Dictionary<string, BinarySubscriber>();
 
 
     private WebSocket _webSocket = null;
     private string _connectedIP = null;
     private ClientState _clientState = ClientState.Disconnected;
 
-    private string _buffer = "";
+    // Every websocket message is one frame, a header followed by a chunk of the payload (see framing.py), little endian:
+    // uint8 type (index in TYPES), uint8 flags, uint16 reserved, uint32 message id, uint32 chunk index, uint64 payload length.
+    // Every chunk but the last one of a message has CHUNK_SIZE bytes, flags DEFLATE marks a raw deflate compressed payload
+    const int HEADER_SIZE = 20;
+    const byte DEFLATE = 1;
+    const int CHUNK_SIZE = 1 << 20;
+    const int MAX_INFLATED = 1 << 30; // a compressed message inflating to more is dropped, a small frame can not make the client allocate without bound
+    static readonly string[] TYPES = { "ENTITY", "MESH", "SHAPE", "UPDATE", "BEACON", "SPAWN", "DATA", "BUFFER", "GEOMETRY", "JOINTS", "CMD", "DIFF", "MSG", "ERR", "RESULT", "TEXTURE" };
+
+    private class PartialMessage
+    {
+        public string Type;
+        public byte Flags;
+        public byte[] Payload; // allocated once at the announced length
+        public int Offset = 0;
+        public uint NextChunk = 0;
+    }
+
+    private Dictionary<uint, PartialMessage> _partialMessages = new Dictionary<uint, PartialMessage>();
+    private uint _messageId = 0;
+    private byte[] _attachment = null; // completed BUFFER waiting for the message it belongs to
+
+    static string BUFFER_HEADER = "BUFFER";
 
 
     // Start is called before the first frame update
@@ -49,24 +80,30 @@ public class WSConnection : MonoBehaviour
 
     public void unsubscribe(string header) => subscribers.Remove(header);
 
+    // binary messages get the raw payload, their callbacks are invoked on the main thread before any later message is dispatched
+    public void subscribeBinary(string header, BinarySubscriber callback) => binarySubscribers.Add(header, callback);
 
-    // Action for object messages and text messages
+    public void unsubscribeBinary(string header) => binarySubscribers.Remove(header);
 
-    static string HEADER_SEPERATOR = ":::";
 
     public void Send(MessageType type, string text)
     {
+        byte[] payload = System.Text.Encoding.UTF8.GetBytes(text);
+        byte code = (byte)Array.IndexOf(TYPES, type.ToString());
+        uint id = _messageId++;
 
-        string header = type switch
+        uint chunk = 0;
+        for (int offset = 0; chunk == 0 || offset < payload.Length; offset += CHUNK_SIZE, chunk++)
         {
-            MessageType.CMD => "CMD",
-            MessageType.DAT => "DAT",
-            MessageType.MSG => "MSG",
-            MessageType.ERR => "ERR",
-            _ => "INV"
-        };
-
-        _webSocket.SendText(header + HEADER_SEPERATOR  + text);
+            int length = Math.Min(CHUNK_SIZE, payload.Length - offset);
+            byte[] frame = new byte[HEADER_SIZE + length];
+            frame[0] = code;
+            BitConverter.TryWriteBytes(new Span<byte>(frame, 4, 4), id);
+            BitConverter.TryWriteBytes(new Span<byte>(frame, 8, 4), chunk);
+            BitConverter.TryWriteBytes(new Span<byte>(frame, 12, 8), (ulong)payload.Length);
+            System.Buffer.BlockCopy(payload, offset, frame, HEADER_SIZE, length);
+            _webSocket.Send(frame);
+        }
     }
 
 
@@ -128,7 +165,13 @@ public class WSConnection : MonoBehaviour
 
     private IEnumerator TestWebSockets(string ipAddress)
     {
-        WebSocket testWebSocket = new WebSocket($"ws://{ipAddress}:{port}");
+        var options = new List<string>(); // no format option, the messages come as json (format=binary is only read by python clients)
+        if (triangleBudget > 0) options.Add($"budget={triangleBudget}");
+        if (compression) options.Add("compression=deflate");
+        if (textureSize > 0) options.Add($"texture={textureSize}");
+        if (nativePrimitives) options.Add("primitives=native");
+        string query = options.Count > 0 ? "/?" + string.Join("&", options) : "";
+        WebSocket testWebSocket = new WebSocket($"ws://{ipAddress}:{port}{query}");
 
         Task connectTask = testWebSocket.Connect();
 
@@ -168,32 +211,100 @@ public class WSConnection : MonoBehaviour
     }
 
     private void OnWSMessage(byte[] bytes) {
-        
-        string msg = System.Text.Encoding.UTF8.GetString(bytes);
 
-        _buffer += msg;
-        
-        if (!msg.EndsWith("</>")) return;
+        if (bytes.Length < HEADER_SIZE || bytes[0] >= TYPES.Length) {
+            Debug.LogWarning($"Invalid frame of {bytes.Length} bytes, it will be ignored");
+            return;
+        }
+
+        string type = TYPES[bytes[0]];
+        byte flags = bytes[1];
+        uint id = BitConverter.ToUInt32(bytes, 4);
+        uint chunk = BitConverter.ToUInt32(bytes, 8);
+        ulong size = BitConverter.ToUInt64(bytes, 12);
+        int length = bytes.Length - HEADER_SIZE;
+
+        if (chunk == 0) {
+            if ((ulong)length == size) { // the whole message in one frame
+                byte[] payload = new byte[length];
+                System.Buffer.BlockCopy(bytes, HEADER_SIZE, payload, 0, length);
+                Dispatch(type, flags, payload);
+                return;
+            }
+            if (size > int.MaxValue) {
+                Debug.LogWarning($"Message {id} of {size} bytes is too large, it will be ignored");
+                return;
+            }
+            _partialMessages[id] = new PartialMessage { Type = type, Flags = flags, Payload = new byte[size] };
+        }
+
+        if (!_partialMessages.TryGetValue(id, out PartialMessage message) || message.NextChunk != chunk || message.Offset + length > message.Payload.Length) {
+            Debug.LogWarning($"Chunk {chunk} of message {id} is out of order, the message will be ignored");
+            _partialMessages.Remove(id);
+            return;
+        }
+
+        System.Buffer.BlockCopy(bytes, HEADER_SIZE, message.Payload, message.Offset, length);
+        message.Offset += length;
+        message.NextChunk++;
+
+        if (message.Offset < message.Payload.Length) return;
+        _partialMessages.Remove(id);
+        Dispatch(message.Type, message.Flags, message.Payload);
+    }
 
-        _buffer = _buffer.Substring(0, _buffer.Length - "</>".Length);
-        string []split = _buffer.Split(HEADER_SEPERATOR);
-        _buffer = "";
+    private void Dispatch(string type, byte flags, byte[] payload) {
 
-        if (split.Length != 2) {
-            Debug.LogWarning($"Invalid message formatting {msg}, this message will be ignored");
+        if (flags == DEFLATE) {
+            payload = Inflate(payload);
+            if (payload == null) {
+                Debug.LogWarning($"Message {type} does not inflate or inflates to more than {MAX_INFLATED} bytes, it will be ignored");
+                return;
+            }
+        }
+        else if (flags != 0) {
+            Debug.LogWarning($"Message {type} has an unknown codec {flags}, it will be ignored");
             return;
         }
 
+        if (type == BUFFER_HEADER) {
+            _attachment = payload; // belongs to the next text message
+            return;
+        }
 
+        if (binarySubscribers.TryGetValue(type, out BinarySubscriber binarySubscriber)) {
+            binarySubscriber.Invoke(payload);
+            return;
+        }
 
-        string header = split[0];
-        string content = split[1];
+        if (!subscribers.TryGetValue(type, out Subscriber subscriber)) {
+            Debug.LogWarning($"Invalid message header received {type}");
+            return;
+        }
 
-        if (!subscribers.ContainsKey(header)) Debug.LogWarning($"Invalid message header received {header}"); // error
-        else Task.Run(() => subscribers[header].Invoke(content)); // call callback 
+        string content = System.Text.Encoding.UTF8.GetString(payload);
+        byte[] attachment = _attachment; // paired here, the callbacks themselves run in any order
+        _attachment = null;
+        Task.Run(() => subscriber.Invoke(content, attachment)); // call callback 
     }
 
    
+    // null once the output passes MAX_INFLATED (before it is all inflated) or for a broken stream, like framing.decompress(limit=...)
+    private static byte[] Inflate(byte[] payload) {
+        using var output = new MemoryStream((int)Math.Min((long)payload.Length * 4, MAX_INFLATED));
+        using var deflate = new DeflateStream(new MemoryStream(payload), CompressionMode.Decompress);
+        byte[] block = new byte[1 << 16];
+        try {
+            int read;
+            while ((read = deflate.Read(block, 0, block.Length)) > 0) {
+                if (output.Length + read > MAX_INFLATED) return null;
+                output.Write(block, 0, read);
+            }
+        }
+        catch (InvalidDataException) { return null; }
+        return output.ToArray();
+    }
+
     private static List<string> GetTestIPList()
     {
         List<string> ipSearchList = new List<string>();